@@ -221,11 +221,11 @@ class DarumaFellOverApp(object):
     def on_turn_around(self):
         # サーボモータを回転
         self.node_manager.send_command("servo", { "angle": 90 })
-        time.sleep(1.0)
 
         self.face("very-happy.png")
         
         # 人の動きの検出を開始
+        # サーボモータの回転中と揺れが収まるまでの間はノードが検出を停止する
         self.node_manager.send_command("motion", { "command": "start" })
         self.current_time = time.monotonic()
         self.wait_time = random.uniform(4.0, 8.0)
@@ -44,6 +44,7 @@ class FollowHumanFaceApp(object):
             "webcam": {
                 "camera_id": 0,
                 "interval": 3.0,
+                "track_interval": 0.2,
                 "frame_width": 320,
                 "frame_height": 240
             }
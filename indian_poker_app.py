@@ -217,9 +217,11 @@ class IndianPokerApp(object):
             time.sleep(wait_time)
             self.node_manager.send_command("motor", { "command": "stop" })
         elif sequence_type == 2:
-            self.node_manager.send_command("servo", { "angle": 15 })
-            time.sleep(wait_time)
-            self.node_manager.send_command("servo", { "angle": 0 })
+            self.node_manager.send_command("servo", {
+                "command": "trajectory", "keyframes": [
+                    { "angle": 15, "time": 0.3 },
+                    { "angle": 15, "time": 0.3 + wait_time },
+                    { "angle": 0, "time": 0.6 + wait_time }] })
         
     def input(self):
         """ノードからアプリケーションへのメッセージを処理"""
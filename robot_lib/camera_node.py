@@ -0,0 +1,168 @@
+# coding: utf-8
+# camera_node.py
+
+import cv2
+import functools
+import multiprocessing as mp
+import time
+
+from data_sender_node import DataSenderNode
+from frame_grabber import configure_capture, decode_frame, is_encoded_frame
+from frame_ring import FrameRing, EncodedFrameRing, SharedFrameReader
+
+class CameraNode(DataSenderNode):
+    """
+    カメラで撮影した画像を共有メモリに書き込み続けるクラス
+    """
+
+    def __init__(self, process_manager, msg_queue,
+                 camera_id, frame_width, frame_height, slots=4,
+                 fourcc=None, capture_fps=None, exposure=None,
+                 raw_mjpeg=False, preview_scale=None):
+        """コンストラクタ"""
+        super().__init__(process_manager, msg_queue)
+
+        # カメラのID
+        self.camera_id = camera_id
+        # 画像の横幅と縦幅
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        # 撮影形式(FOURCC), フレームレート, 露出("auto"または露出時間)
+        self.fourcc = fourcc
+        self.capture_fps = capture_fps
+        self.exposure = exposure
+        # MJPGの画像をデコードせずに共有するかどうか
+        # デコードは縮小したグレースケール画像の作成時と, カラー画像を読み出すノードでのみ行う
+        self.raw_mjpeg = raw_mjpeg
+        # 縮小したグレースケール画像の縮小率(Noneの場合は作成しない)
+        self.preview_scale = preview_scale
+
+        # 撮影した画像のリングバッファ(共有メモリ上に保持)
+        if raw_mjpeg:
+            # デコードされていない画像データを保持(デコード済みの画像が得られた場合にも対応)
+            self.frame_ring = EncodedFrameRing(frame_width * frame_height * 3, slots)
+        else:
+            self.frame_ring = FrameRing(frame_width, frame_height, 3, slots)
+
+        # 縮小したグレースケール画像のリングバッファ
+        if preview_scale is not None:
+            # JPEGの縮小デコードと同じく端数は切り上げ
+            self.preview_width = -(-frame_width // preview_scale)
+            self.preview_height = -(-frame_height // preview_scale)
+            self.preview_ring = FrameRing(self.preview_width, self.preview_height, 1, slots)
+        else:
+            self.preview_width = None
+            self.preview_height = None
+            self.preview_ring = None
+
+        # ビデオ撮影デバイス(ノードのプロセス内で作成)
+        self.video_capture = None
+
+    def initialize_state_dict(self):
+        """ノードの状態を格納するディクショナリを初期化"""
+        super().initialize_state_dict()
+
+        # 撮影した画像の枚数
+        self.state_dict["frames"] = 0
+        # 撮影のフレームレート(毎秒)
+        self.state_dict["fps"] = 0.0
+        # 撮影に失敗した回数
+        self.state_dict["errors"] = 0
+
+    def create_reader(self, timeout=1.0, copy=False, stream="color"):
+        """
+        画像を読み出すためのインスタンスを作成(cv2.VideoCaptureの代わりに使用)
+        stream: color(元の解像度のカラー画像)またはgray(縮小したグレースケール画像)
+        """
+
+        if stream == "gray":
+            if self.preview_ring is None:
+                raise ValueError("CameraNode::create_reader(): " +
+                                 "preview_scale is not configured for gray stream")
+            return SharedFrameReader(self.preview_ring, timeout, copy)
+
+        if stream != "color":
+            raise ValueError("CameraNode::create_reader(): " +
+                             "unknown stream: {0}".format(stream))
+
+        if self.raw_mjpeg:
+            # カラー画像を読み出すノードのプロセス内でデコード
+            decoder = functools.partial(
+                decode_frame, shape=(self.frame_height, self.frame_width, 3))
+            return SharedFrameReader(self.frame_ring, timeout, copy, decoder)
+
+        return SharedFrameReader(self.frame_ring, timeout, copy)
+
+    def get_stream_size(self, stream="color"):
+        """読み出す画像の横幅と縦幅を取得"""
+        if stream == "gray":
+            return self.preview_width, self.preview_height
+        return self.frame_width, self.frame_height
+
+    def open_capture(self):
+        """ビデオ撮影デバイスの作成"""
+        self.video_capture = cv2.VideoCapture(self.camera_id)
+        configure_capture(self.video_capture, self.frame_width, self.frame_height,
+                          self.fourcc, self.capture_fps, self.exposure, self.raw_mjpeg)
+
+    def write_frame(self, frame, timestamp):
+        """撮影した画像をリングバッファに書き込み"""
+
+        encoded = is_encoded_frame(frame)
+
+        # 設定した解像度で撮影されなかった場合は縮小または拡大
+        if not encoded and frame.shape[:2] != (self.frame_height, self.frame_width):
+            frame = cv2.resize(frame, (self.frame_width, self.frame_height))
+
+        # 縮小したグレースケール画像を作成(JPEGの場合は縮小しながらデコード)
+        # 元の画像と同じ通し番号になるように先に書き込む
+        if self.preview_ring is not None:
+            preview = decode_frame(frame, True, self.preview_scale)
+            if preview.shape[:2] != (self.preview_height, self.preview_width):
+                preview = cv2.resize(preview, (self.preview_width, self.preview_height),
+                                     interpolation=cv2.INTER_AREA)
+            self.preview_ring.write(preview, timestamp)
+
+        self.frame_ring.write(frame, timestamp)
+
+    def update(self):
+        """撮影した画像を共有メモリに書き込み"""
+
+        # 1つのプロセスのみがビデオ撮影デバイスを使用するように,
+        # ノードのプロセス内でビデオ撮影デバイスを作成
+        self.open_capture()
+
+        # フレームレートを計算するための撮影枚数と時刻
+        frames = 0
+        errors = 0
+        last_frames = 0
+        last_time = time.monotonic()
+
+        try:
+            while True:
+                # 撮影した動画を取り込み
+                ret, frame = self.video_capture.read()
+                timestamp = time.monotonic()
+
+                if not ret or frame is None:
+                    errors += 1
+                    self.state_dict["errors"] = errors
+                    time.sleep(0.1)
+                    continue
+
+                self.write_frame(frame, timestamp)
+                frames += 1
+
+                # 1秒ごとにフレームレートを更新
+                if timestamp - last_time >= 1.0:
+                    self.state_dict["frames"] = frames
+                    self.state_dict["fps"] = (frames - last_frames) / (timestamp - last_time)
+                    last_frames = frames
+                    last_time = timestamp
+
+        except KeyboardInterrupt:
+            # プロセスが割り込まれた場合
+            print("CameraNode::update(): KeyboardInterrupt occurred")
+        finally:
+            # ビデオ撮影デバイスの解放
+            self.video_capture.release()
@@ -13,6 +13,8 @@ import time
 import zlib
 
 from command_receiver_node import CommandReceiverNode, UnknownCommandException
+from frame_grabber import open_latest_frame_grabber
+from frame_ring import is_frame_valid
 
 class CardDetectionNode(CommandReceiverNode):
     """
@@ -23,7 +25,8 @@ class CardDetectionNode(CommandReceiverNode):
     SERVER_PORT = 12345
     
     def __init__(self, process_manager, msg_queue, server_host,
-                 camera_id, frame_width, frame_height):
+                 camera_id, frame_width, frame_height, video_capture=None,
+                 capture_config=None):
         """コンストラクタ"""
         super().__init__(process_manager, msg_queue)
 
@@ -47,10 +50,14 @@ class CardDetectionNode(CommandReceiverNode):
         self.frame_height = frame_height
         
         # ビデオ撮影デバイスのパラメータの設定
-        self.video_capture = cv2.VideoCapture(camera_id)
-        self.video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        self.video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
-        self.video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
+        # カメラのノードが画像を共有する場合はリングバッファから読み出す
+        # それ以外の場合は画像を取り込み続けるスレッドから最新の画像を読み出す
+        # (capture_configで撮影形式や読み出す画像の形式を指定)
+        if video_capture is not None:
+            self.video_capture = video_capture
+        else:
+            self.video_capture = open_latest_frame_grabber(
+                camera_id, frame_width, frame_height, **(capture_config or {}))
 
         # キャプチャする画像のサイズを送信
         msg_size = struct.calcsize("!I")
@@ -124,20 +131,19 @@ class CardDetectionNode(CommandReceiverNode):
     def detect(self):
         """カードの検出"""
 
-        # 画像データを読み捨て
-        ret, frame0 = self.video_capture.read()
-
-        # 画像データを作成
+        # 最新の画像データを取得
         ret, frame = self.video_capture.read()
 
         # 画像がキャプチャできなかった場合はエラー
         if frame is None:
-            if frame0 is not None:
-                frame = frame0
-            else:
-                return []
+            return []
 
+        # 色の変換で作成した画像を使用し, 変換中に共有メモリ上の画像が上書きされた場合はエラー
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if not is_frame_valid(self.video_capture):
+            print("CardDetectionNode::detect(): frame was overwritten during processing")
+            return []
+
         ret, frame = cv2.imencode(".png", frame, [int(cv2.IMWRITE_PNG_COMPRESSION), 5])
         frame_data = pickle.dumps(frame)
         frame_data = zlib.compress(frame_data)
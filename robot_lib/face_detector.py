@@ -0,0 +1,193 @@
+# coding: utf-8
+# face_detector.py
+
+import cv2
+import os
+import pathlib
+
+def find_model_file(file_name, data_dir=None):
+    """モデルのファイルのパスを取得(相対パスの場合はカレントディレクトリ, robot_lib, OpenCVのデータの順に探索)"""
+
+    file_path = pathlib.Path(file_name)
+
+    if file_path.is_absolute() or file_path.exists():
+        return str(file_path)
+
+    candidates = [pathlib.Path(os.path.dirname(os.path.abspath(__file__))) / file_path]
+    if data_dir is not None:
+        candidates.append(pathlib.Path(data_dir) / file_path)
+
+    for candidate in candidates:
+        if candidate.exists():
+            return str(candidate)
+
+    raise FileNotFoundError("find_model_file(): model file not found: {0}"
+                            .format(file_name))
+
+class FaceDetector(object):
+    """
+    画像から顔を検出するクラスの基底クラス
+    """
+
+    def detect(self, frame, min_size=None, max_size=None):
+        """
+        画像から顔を検出して矩形領域(x, y, w, h)のリストを返す
+        min_sizeとmax_sizeで検出する顔の大きさ(w, h)を制限できる
+        """
+        raise NotImplementedError()
+
+class CascadeFaceDetector(FaceDetector):
+    """
+    カスケード分類器を用いて顔を検出するクラス
+    """
+
+    def __init__(self, cascade_file_path, scale_factor=1.1,
+                 min_neighbors=5, min_size=(15, 15)):
+        """コンストラクタ"""
+
+        # 分類器のファイルのパス
+        data_dir = getattr(getattr(cv2, "data", None), "haarcascades", None)
+        self.cascade_file_path = find_model_file(cascade_file_path, data_dir)
+        # カスケード分類器
+        self.cascade_classifier = cv2.CascadeClassifier(self.cascade_file_path)
+
+        if self.cascade_classifier.empty():
+            raise ValueError("CascadeFaceDetector::__init__(): " +
+                             "failed to load cascade classifier: {0}"
+                             .format(self.cascade_file_path))
+
+        # 探索する顔の大きさの拡大率
+        self.scale_factor = scale_factor
+        # 顔と判定するために必要な近傍の検出結果の個数
+        self.min_neighbors = min_neighbors
+        # 検出する顔の最小の大きさ
+        self.min_size = tuple(min_size)
+
+    def detect(self, frame, min_size=None, max_size=None):
+        """画像から顔を検出"""
+
+        # カスケード分類器はグレースケール画像を使用
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        faces = self.cascade_classifier.detectMultiScale(
+            frame, scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=tuple(min_size or self.min_size),
+            maxSize=tuple(max_size or (0, 0)))
+
+        return [tuple(int(v) for v in face) for face in faces]
+
+class HaarFaceDetector(CascadeFaceDetector):
+    """
+    Haar-like特徴のカスケード分類器を用いて顔を検出するクラス
+    """
+
+    def __init__(self, cascade_file_path="haarcascade_frontalface_default.xml", **kwargs):
+        """コンストラクタ"""
+        super().__init__(cascade_file_path, **kwargs)
+
+class LbpFaceDetector(CascadeFaceDetector):
+    """
+    LBP特徴のカスケード分類器を用いて顔を検出するクラス
+    (Haar-like特徴よりも精度は低いが高速)
+    """
+
+    def __init__(self, cascade_file_path="lbpcascade_frontalface_improved.xml", **kwargs):
+        """コンストラクタ"""
+        super().__init__(cascade_file_path, **kwargs)
+
+class DnnFaceDetector(FaceDetector):
+    """
+    ニューラルネットワーク(YuNet)を用いて顔を検出するクラス
+    (OpenCV 4.5.4以降のcv2.FaceDetectorYNを使用)
+    """
+
+    def __init__(self, model_file_path="face_detection_yunet_2023mar.onnx",
+                 score_threshold=0.6, nms_threshold=0.3, top_k=50):
+        """コンストラクタ"""
+
+        # モデルのファイルのパス
+        self.model_file_path = find_model_file(model_file_path)
+        # 顔と判定するスコアの閾値
+        self.score_threshold = score_threshold
+        # 重複する検出結果を除去する際の重なりの閾値
+        self.nms_threshold = nms_threshold
+        # 検出する顔の最大の個数
+        self.top_k = top_k
+
+        # 入力画像の大きさは画像ごとに設定
+        self.input_size = (320, 320)
+        self.face_detector = cv2.FaceDetectorYN.create(
+            self.model_file_path, "", self.input_size,
+            score_threshold, nms_threshold, top_k)
+
+    def detect(self, frame, min_size=None, max_size=None):
+        """画像から顔を検出"""
+
+        # ニューラルネットワークはカラー画像を使用
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+        frame_height, frame_width = frame.shape[:2]
+        if (frame_width, frame_height) != self.input_size:
+            self.input_size = (frame_width, frame_height)
+            self.face_detector.setInputSize(self.input_size)
+
+        _, results = self.face_detector.detect(frame)
+
+        if results is None:
+            return []
+
+        faces = []
+
+        for result in results:
+            # 各行の先頭4つの値が矩形領域, 残りは目や鼻などの位置とスコア
+            x, y, w, h = (int(v) for v in result[:4])
+
+            if min_size is not None and (w < min_size[0] or h < min_size[1]):
+                continue
+            if max_size is not None and (w > max_size[0] or h > max_size[1]):
+                continue
+
+            # 画像の外にはみ出した矩形領域を切り詰める
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + w, frame_width), min(y + h, frame_height)
+            faces.append((x0, y0, x1 - x0, y1 - y0))
+
+        return faces
+
+# 設定で指定できる顔検出器の種類
+FACE_DETECTORS = {
+    "haar": HaarFaceDetector,
+    "lbp": LbpFaceDetector,
+    "dnn": DnnFaceDetector
+}
+
+def create_face_detector(config_dict, fallback_backend=None):
+    """
+    設定に従って顔検出器を作成
+    fallback_backendを指定した場合は, モデルのファイルが見つからないなどの理由で
+    顔検出器を作成できなかったときに, 警告を表示して代わりの顔検出器を作成
+    """
+
+    config_dict = dict(config_dict)
+    backend = config_dict.pop("backend", "haar")
+
+    if backend not in FACE_DETECTORS:
+        raise ValueError("create_face_detector(): " +
+                         "unknown backend: {0}, available backends: {1}"
+                         .format(backend, ", ".join(FACE_DETECTORS)))
+
+    try:
+        return FACE_DETECTORS[backend](**config_dict)
+    except (FileNotFoundError, ValueError, AttributeError, cv2.error) as e:
+        if fallback_backend is None or fallback_backend == backend:
+            raise
+
+        # 顔検出器ごとに引数が異なるため, 代わりの顔検出器は既定の設定で作成
+        print("create_face_detector(): failed to create {0} face detector: {1}"
+              .format(backend, e))
+        print("create_face_detector(): using {0} face detector instead"
+              .format(fallback_backend))
+        return FACE_DETECTORS[fallback_backend]()
@@ -0,0 +1,244 @@
+# coding: utf-8
+# frame_grabber.py
+
+import cv2
+import numpy as np
+import threading
+import time
+
+# 縮小してデコードする際にJPEGのデコーダに指定するフラグ(縮小率ごと)
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def configure_capture(video_capture, frame_width, frame_height,
+                      fourcc=None, capture_fps=None, exposure=None, raw_mjpeg=False):
+    """ビデオ撮影デバイスの撮影形式, 解像度, フレームレート, 露出を設定"""
+
+    # 撮影形式は解像度とフレームレートの組み合わせを決めるため最初に設定
+    # USBカメラは高い解像度ではMJPGを指定しないとYUYVの低いフレームレートになる場合がある
+    if fourcc is not None:
+        video_capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+
+    video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
+    video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
+
+    if capture_fps is not None:
+        video_capture.set(cv2.CAP_PROP_FPS, capture_fps)
+
+    if exposure == "auto":
+        # V4L2では0.75が自動露出, 0.25が手動露出を表す
+        video_capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0.75)
+    elif exposure is not None:
+        video_capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0.25)
+        video_capture.set(cv2.CAP_PROP_EXPOSURE, exposure)
+
+    # MJPGの画像をデコードせずに取得(必要な形式と解像度で読み出し側がデコード)
+    if raw_mjpeg:
+        video_capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+    # 実際に設定された値はカメラによって異なるため表示
+    fourcc_value = int(video_capture.get(cv2.CAP_PROP_FOURCC))
+    print("configure_capture(): format: {0}, resolution: {1}x{2}, fps: {3}"
+          .format("".join(chr((fourcc_value >> (8 * i)) & 0xFF) for i in range(4)),
+                  int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                  video_capture.get(cv2.CAP_PROP_FPS)))
+
+def is_encoded_frame(data):
+    """デコードされていないJPEGの画像データであるかどうか"""
+    data = data.reshape(-1) if data.ndim < 3 and data.shape[0] == 1 else data
+    return data.ndim == 1 and data.size > 2 and data[0] == 0xFF and data[1] == 0xD8
+
+def decode_frame(data, gray=False, scale=1, shape=None):
+    """
+    撮影した画像データを指定された形式の画像に変換
+    JPEGの画像データは縮小しながらデコードするため, デコード済みの画像を縮小するよりも高速
+    shapeを指定した場合は, 1次元に並べられたデコード済みの画像データも受け付ける
+    """
+
+    if is_encoded_frame(data):
+        flags = REDUCED_GRAYSCALE_FLAGS[scale] if gray else REDUCED_COLOR_FLAGS[scale]
+        return cv2.imdecode(data.reshape(-1), flags)
+
+    if data.ndim == 1 and shape is not None:
+        data = data.reshape(shape)
+
+    if scale != 1:
+        data = cv2.resize(data, None, fx=1.0 / scale, fy=1.0 / scale,
+                          interpolation=cv2.INTER_AREA)
+    if gray and data.ndim == 3:
+        data = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+
+    return data
+
+class LatestFrameGrabber(object):
+    """
+    ビデオ撮影デバイスから画像を取り込み続け, 最新の画像のみを読み出すクラス
+    (cv2.VideoCaptureの代わりに使用できる)
+    """
+
+    def __init__(self, video_capture, timeout=1.0, retry_interval=0.1,
+                 stream="color", preview_scale=1):
+        """コンストラクタ"""
+
+        if stream not in ("color", "gray"):
+            raise ValueError("LatestFrameGrabber::__init__(): " +
+                             "unknown stream: {0}".format(stream))
+        if preview_scale not in REDUCED_GRAYSCALE_FLAGS:
+            raise ValueError("LatestFrameGrabber::__init__(): " +
+                             "preview_scale must be 1, 2, 4 or 8: {0}".format(preview_scale))
+
+        # ビデオ撮影デバイス
+        self.video_capture = video_capture
+        # 読み出す画像の形式
+        # color: 元の解像度のカラー画像, gray: preview_scaleで縮小したグレースケール画像
+        self.stream = stream
+        self.preview_scale = preview_scale if stream == "gray" else 1
+        # 新たな画像を待機する最大の時間(秒)
+        self.timeout = timeout
+        # 画像の取り込みに失敗した場合に再試行するまでの時間(秒)
+        self.retry_interval = retry_interval
+
+        # 取り込んだ画像の通し番号(画像のデコードは読み出し時にのみ行う)
+        self.grab_seq = 0
+        # 最後に読み出した画像の通し番号
+        self.last_seq = 0
+        # 最後に画像を取り込んだ時刻
+        self.last_grab_time = None
+        # 画像の取り込みに失敗した回数
+        self.grab_errors = 0
+        # 画像を取り込み中であるかどうか
+        # (取り込み中にデコードするとデバイスのバッファが壊れるため, 同時には実行しない)
+        self.grabbing = False
+        # 画像の読み出しを待機している回数
+        # 新しい画像を待機している間は取り込みを止めず, 取り込み済みの画像を
+        # 読み出す(retrieve())までの間のみ次の画像の取り込みを待たせる
+        self.read_requests = 0
+
+        self.condition = threading.Condition()
+        # 画像を取り込むスレッド
+        # forkされた子プロセスには引き継がれないため, 最初の読み出し時に開始
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        """画像を取り込むスレッドを開始"""
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self.grab_frames, daemon=True)
+        self.thread.start()
+
+    def grab_frames(self):
+        """画像を取り込み続ける(スレッドで実行)"""
+
+        while self.running:
+            with self.condition:
+                # 読み出しを待機している要求に取り込み済みの新しい画像がある場合は,
+                # その画像が読み出されるまで次の画像を取り込まない
+                # (新しい画像を待機している場合にも取り込みを止めると互いに待ち続ける)
+                self.condition.wait_for(
+                    lambda: not self.has_pending_retrieve() or not self.running)
+                if not self.running:
+                    break
+                self.grabbing = True
+
+            # デバイスのバッファに溜まった画像を取り出し, デコードせずに破棄
+            ret = self.video_capture.grab()
+
+            with self.condition:
+                self.grabbing = False
+                if ret:
+                    self.grab_seq += 1
+                    self.last_grab_time = time.monotonic()
+                else:
+                    self.grab_errors += 1
+                self.condition.notify_all()
+
+            if not ret:
+                time.sleep(self.retry_interval)
+
+    def has_pending_retrieve(self):
+        """読み出しを待機している要求に取り込み済みの新しい画像があるかどうか"""
+        return self.read_requests > 0 and self.grab_seq > self.last_seq
+
+    def isOpened(self):
+        """画像を読み出せるかどうか"""
+        return self.video_capture.isOpened()
+
+    def read(self):
+        """最後に取り込んだ画像をデコードして読み出し"""
+
+        self.start()
+
+        with self.condition:
+            self.read_requests += 1
+
+            try:
+                # 前回読み出した画像より新しい画像が取り込まれるまで待機
+                if not self.condition.wait_for(
+                    lambda: self.grab_seq > self.last_seq and not self.grabbing,
+                    self.timeout):
+                    return False, None
+
+                # 取り込み済みの最新の画像のみをデコード
+                ret, frame = self.video_capture.retrieve()
+                self.last_seq = self.grab_seq
+
+            finally:
+                self.read_requests -= 1
+                self.condition.notify_all()
+
+        if not ret or frame is None:
+            return False, None
+
+        # 読み出す形式に変換(JPEGの画像データの場合は縮小しながらデコード)
+        # 変換は次の画像の取り込みを妨げないようにロックの外で行う
+        return True, decode_frame(frame, self.stream == "gray", self.preview_scale)
+
+    def set(self, prop_id, value):
+        """カメラのパラメータの設定"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.grabbing)
+            return self.video_capture.set(prop_id, value)
+
+    def get(self, prop_id):
+        """カメラのパラメータの取得"""
+        return self.video_capture.get(prop_id)
+
+    def release(self):
+        """画像を取り込むスレッドを停止してビデオ撮影デバイスを解放"""
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.timeout)
+
+        self.video_capture.release()
+
+def open_latest_frame_grabber(camera_id, frame_width, frame_height,
+                              fourcc=None, capture_fps=None, exposure=None,
+                              raw_mjpeg=False, stream="color", preview_scale=1):
+    """ビデオ撮影デバイスを作成して最新の画像のみを読み出すインスタンスを返す"""
+
+    video_capture = cv2.VideoCapture(camera_id)
+    # スレッドが画像を取り込み続けるため, デバイスのバッファは最小限とする
+    configure_capture(video_capture, frame_width, frame_height,
+                      fourcc, capture_fps, exposure, raw_mjpeg)
+
+    return LatestFrameGrabber(video_capture, stream=stream, preview_scale=preview_scale)
@@ -0,0 +1,95 @@
+# coding: utf-8
+# frame_rate_scheduler.py
+
+import time
+
+class FrameRateScheduler(object):
+    """
+    画像の処理を目標のフレームレートで実行するための時刻を管理するクラス
+    """
+
+    def __init__(self, target_fps):
+        """コンストラクタ"""
+
+        # 目標のフレームレート(毎秒)と1フレームの周期(秒)
+        self.target_fps = None
+        self.period = None
+        self.set_target_fps(target_fps)
+
+        # 次のフレームの開始時刻
+        self.next_time = None
+        # 処理したフレームの数と, 処理が間に合わずに飛ばしたフレームの数
+        self.frames = 0
+        self.dropped_frames = 0
+        # 直近の1秒間で計測したフレームレート(毎秒)
+        self.fps = 0.0
+        # フレームレートを計測する区間の開始時刻とフレームの数
+        self.window_start_time = None
+        self.window_frames = 0
+
+    def set_target_fps(self, target_fps):
+        """目標のフレームレートを設定"""
+
+        if target_fps <= 0:
+            raise ValueError("FrameRateScheduler::set_target_fps(): " +
+                             "target_fps must be positive: {0}".format(target_fps))
+
+        period = 1.0 / target_fps
+
+        # 待機中のフレームの開始時刻を新しい周期に合わせる
+        if getattr(self, "next_time", None) is not None:
+            self.next_time += period - self.period
+
+        self.target_fps = target_fps
+        self.period = period
+
+    def reset(self):
+        """処理を中断した後に再開する場合に, 次のフレームの開始時刻を破棄"""
+        self.next_time = None
+        self.window_start_time = None
+        self.window_frames = 0
+
+    def wait(self):
+        """次のフレームの開始時刻まで待機(処理が間に合わなかったフレームは飛ばす)"""
+
+        current_time = time.monotonic()
+
+        if self.next_time is None:
+            self.next_time = current_time
+        elif current_time < self.next_time:
+            time.sleep(self.next_time - current_time)
+            current_time = time.monotonic()
+        else:
+            # 前回の処理が長引いた場合は, 遅れを取り戻すために続けて処理せずに
+            # 過ぎてしまったフレームを飛ばして次の周期に合わせる
+            missed = int((current_time - self.next_time) / self.period)
+            self.dropped_frames += missed
+            self.next_time += missed * self.period
+
+        self.next_time += self.period
+        self.update_fps(current_time)
+
+        return current_time
+
+    def update_fps(self, current_time):
+        """フレームレートを更新"""
+
+        self.frames += 1
+
+        if self.window_start_time is None:
+            self.window_start_time = current_time
+            self.window_frames = 0
+            return
+
+        self.window_frames += 1
+        elapsed = current_time - self.window_start_time
+
+        if elapsed >= 1.0:
+            self.fps = self.window_frames / elapsed
+            self.window_start_time = current_time
+            self.window_frames = 0
+
+    def get_stats(self):
+        """フレームレートと飛ばしたフレームの数を取得"""
+        return { "target_fps": self.target_fps, "fps": self.fps,
+                 "frames": self.frames, "dropped_frames": self.dropped_frames }
@@ -0,0 +1,216 @@
+# coding: utf-8
+# frame_ring.py
+
+import multiprocessing as mp
+import numpy as np
+import time
+
+class FrameRing(object):
+    """
+    カメラの画像を共有メモリ上のリングバッファに保持するクラス
+    """
+
+    def __init__(self, frame_width, frame_height, channels=3, slots=4):
+        """コンストラクタ"""
+
+        # 画像の横幅, 縦幅, チャネル数
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.channels = channels
+        # リングバッファに保持する画像の枚数
+        # 読み出した画像は, 書き込み側がslots - 1枚の画像を書き込むまで上書きされない
+        self.slots = slots
+
+        # 以下はforkによって各ノードのプロセスに引き継がれるため,
+        # ノードの実行を開始する前に作成しておく必要がある
+        self.frame_shape = (frame_height, frame_width, channels) \
+            if channels > 1 else (frame_height, frame_width)
+        frame_size = frame_width * frame_height * channels
+
+        # 画像データ
+        self.buffer = mp.RawArray("B", frame_size * slots)
+        # 各スロットに書き込まれた画像の通し番号(書き込み中は0)
+        self.slot_seqs = mp.RawArray("Q", slots)
+        # 各スロットの画像を撮影した時刻(time.monotonic()の値)
+        self.slot_timestamps = mp.RawArray("d", slots)
+        # 最後に書き込まれた画像の通し番号(1から始まり, 0は画像が無いことを表す)
+        self.latest_seq = mp.RawValue("Q", 0)
+        # 新たな画像の書き込みを通知するための条件変数
+        self.condition = mp.Condition(mp.Lock())
+
+        # 共有メモリをコピーせずに参照する配列
+        self.frames = np.frombuffer(self.buffer, dtype=np.uint8).reshape(
+            (slots,) + self.frame_shape)
+
+    def write(self, frame, timestamp=None):
+        """画像を書き込み(書き込むプロセスは1つのみ)"""
+
+        seq = self.latest_seq.value + 1
+        slot = seq % self.slots
+
+        # 書き込み中であることを示してから画像をコピー
+        self.slot_seqs[slot] = 0
+        self.store(slot, frame)
+        self.slot_timestamps[slot] = timestamp if timestamp is not None else time.monotonic()
+        self.slot_seqs[slot] = seq
+
+        # 画像を待機している読み出し側に通知
+        with self.condition:
+            self.latest_seq.value = seq
+            self.condition.notify_all()
+
+        return seq
+
+    def store(self, slot, frame):
+        """画像をスロットにコピー"""
+        self.frames[slot] = frame
+
+    def get_latest_seq(self):
+        """最後に書き込まれた画像の通し番号を取得"""
+        return self.latest_seq.value
+
+    def wait(self, last_seq, timeout=None):
+        """通し番号last_seqより新しい画像が書き込まれるまで待機"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.latest_seq.value > last_seq, timeout)
+
+    def get(self, seq):
+        """
+        指定された通し番号の画像を取得(コピーせずに参照し, 上書きされた場合はNone)
+        参照した画像は書き込み側がslots - 1枚の画像を書き込むと上書きされるため,
+        使用した後にis_valid()で上書きされていないことを確認する必要がある
+        """
+
+        slot = seq % self.slots
+        frame = self.load(slot)
+        timestamp = self.slot_timestamps[slot]
+
+        if seq == 0 or self.slot_seqs[slot] != seq:
+            return None, None
+
+        # 他のプロセスと共有している画像を書き換えないように読み出し専用とする
+        frame.flags.writeable = False
+        return frame, timestamp
+
+    def load(self, slot):
+        """スロットの画像を参照"""
+        return self.frames[slot]
+
+    def is_valid(self, seq):
+        """指定された通し番号の画像がまだ上書きされていないかどうか"""
+        return seq != 0 and self.slot_seqs[seq % self.slots] == seq
+
+class EncodedFrameRing(FrameRing):
+    """
+    デコードされていない画像データ(JPEGなど)を共有メモリ上のリングバッファに保持するクラス
+    """
+
+    def __init__(self, max_size, slots=4):
+        """コンストラクタ"""
+
+        # 各スロットは1行max_size列の配列とし, 画像データの長さを別に保持
+        super().__init__(max_size, 1, 1, slots)
+        self.max_size = max_size
+        # 各スロットの画像データの長さ(バイト)
+        self.slot_sizes = mp.RawArray("I", slots)
+
+    def store(self, slot, frame):
+        """画像データをスロットにコピー"""
+
+        data = frame.reshape(-1)
+
+        if data.size > self.max_size:
+            raise ValueError("EncodedFrameRing::store(): " +
+                             "frame size {0} exceeds the maximum size {1}"
+                             .format(data.size, self.max_size))
+
+        self.frames[slot, 0, :data.size] = data
+        self.slot_sizes[slot] = data.size
+
+    def load(self, slot):
+        """スロットの画像データを参照"""
+        return self.frames[slot, 0, :self.slot_sizes[slot]]
+
+class SharedFrameReader(object):
+    """
+    共有メモリ上のリングバッファから画像を読み出すクラス
+    (cv2.VideoCaptureの代わりに使用できる)
+    """
+
+    def __init__(self, frame_ring, timeout=1.0, copy=False, decoder=None):
+        """コンストラクタ"""
+
+        # 画像のリングバッファ
+        self.frame_ring = frame_ring
+        # 画像データを画像に変換する関数(デコードされていない画像データを読み出す場合)
+        self.decoder = decoder
+        # 新たな画像を待機する最大の時間(秒)
+        self.timeout = timeout
+        # 画像をコピーして返すかどうか
+        self.copy = copy
+        # 最後に読み出した画像の通し番号と撮影時刻
+        self.last_seq = 0
+        self.last_timestamp = None
+
+    def isOpened(self):
+        """画像を読み出せるかどうか"""
+        return True
+
+    def read(self):
+        """
+        前回読み出した画像より新しい画像を読み出し
+        copyがFalseの場合は共有メモリ上の画像をコピーせずに返すため, 処理に時間を要して
+        (slots - 1)枚分の撮影の周期を超えると, 処理中に画像が上書きされる場合がある
+        処理の後にis_valid()を呼び出し, 上書きされていた場合は処理の結果を破棄すること
+        """
+
+        # 新たな画像が書き込まれるまで待機
+        if not self.frame_ring.wait(self.last_seq, self.timeout):
+            return False, None
+
+        seq = self.frame_ring.get_latest_seq()
+        frame, timestamp = self.frame_ring.get(seq)
+
+        if frame is None:
+            return False, None
+
+        self.last_seq = seq
+        self.last_timestamp = timestamp
+
+        # デコード中に上書きされないように画像データ(画像よりも小さい)をコピーしてからデコード
+        # デコードした画像は新たなメモリ上に作成されるため, 画像はコピーしない
+        if self.decoder is not None:
+            data = frame.copy()
+            if not self.frame_ring.is_valid(seq):
+                return False, None
+            frame = self.decoder(data)
+            return frame is not None, frame
+
+        return True, frame.copy() if self.copy else frame
+
+    def is_valid(self):
+        """最後に読み出した画像が上書きされていないかどうか(コピーした画像は常にTrue)"""
+        if self.copy or self.decoder is not None:
+            return True
+        return self.frame_ring.is_valid(self.last_seq)
+
+    def set(self, prop_id, value):
+        """カメラのパラメータの設定(カメラのノードで設定するため何もしない)"""
+        return False
+
+    def get(self, prop_id):
+        """カメラのパラメータの取得(未対応)"""
+        return 0.0
+
+    def release(self):
+        """解放(カメラのノードが解放するため何もしない)"""
+        pass
+
+def is_frame_valid(video_capture):
+    """
+    最後に読み出した画像が処理の間に上書きされていないかどうか
+    (画像をコピーせずに返すSharedFrameReader以外では常にTrue)
+    """
+    is_valid = getattr(video_capture, "is_valid", None)
+    return is_valid() if is_valid is not None else True
@@ -0,0 +1,201 @@
+# coding: utf-8
+# i2c_bus.py
+
+import contextlib
+import multiprocessing as mp
+import os
+import smbus
+import time
+
+class I2cBus(object):
+    """
+    複数のノードのプロセスで共有されるI2Cデータバスを管理するクラス
+    """
+
+    # 要求の優先度(値が小さいほど優先される)
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+    PRIORITY_LEVELS = 3
+
+    # I2Cのアドレスの個数(7ビット)
+    ADDR_NUM = 128
+    # データバスの解放を同時に待機できるプロセス(スレッド)の最大数
+    MAX_WAITERS = 32
+    # データバスを使用中のプロセスや待機中のプロセスが終了していないかを確認する間隔(秒)
+    LIVENESS_CHECK_INTERVAL = 0.5
+
+    def __init__(self, bus_number=1):
+        """コンストラクタ"""
+
+        # I2Cデータバスの番号(/dev/i2c-1の1に対応)
+        self.bus_number = bus_number
+        # I2Cデータバス(/dev/i2c-1)は各プロセスで個別にオープン
+        # 通信先のアドレスはオープンしたファイルごとに保持されるため,
+        # forkで引き継いだファイルを複数のプロセスで使用すると,
+        # 他のプロセスが設定したアドレスのデバイスと誤って通信する場合がある
+        self.i2c = None
+        # I2CデータバスをオープンしたプロセスのID
+        self.i2c_pid = None
+
+        # 以下はforkによって各ノードのプロセスに引き継がれるため,
+        # ノードの実行を開始する前に作成しておく必要がある
+
+        # データバスの排他制御に用いる条件変数
+        self.condition = mp.Condition(mp.Lock())
+        # データバスを使用中のプロセスのID(使用中でない場合は0)
+        # 通信中にプロセスが強制終了された場合(terminate()など)に解放できるように記録
+        self.owner_pid = mp.RawValue("i", 0)
+        # データバスの解放を待機しているプロセスのIDと要求の優先度(空きは0)
+        # 待機中に強制終了されたプロセスの要求を取り除けるように, 個数ではなくIDを記録
+        self.waiter_pids = mp.RawArray("i", I2cBus.MAX_WAITERS)
+        self.waiter_priorities = mp.RawArray("i", I2cBus.MAX_WAITERS)
+
+        # 各アドレスのデバイスとの通信に要した時間の合計(秒)
+        self.bus_time = mp.RawArray("d", I2cBus.ADDR_NUM)
+        # 各アドレスのデバイスとの通信の回数
+        self.transactions = mp.RawArray("L", I2cBus.ADDR_NUM)
+        # 各アドレスのデバイスとの通信でデータバスの解放を待った時間の合計(秒)
+        self.wait_time = mp.RawArray("d", I2cBus.ADDR_NUM)
+
+        print("I2cBus::__init__(): initialization succeeded")
+
+    def __del__(self):
+        """デストラクタ"""
+        # このプロセスでオープンしたI2Cデータバス(/dev/i2c-1)をクローズ
+        if self.i2c is not None and self.i2c_pid == os.getpid():
+            self.i2c.close()
+
+    def get_i2c(self):
+        """このプロセスで使用するI2Cデータバスを取得(初回の呼び出し時にオープン)"""
+
+        if self.i2c is None or self.i2c_pid != os.getpid():
+            self.i2c = smbus.SMBus(self.bus_number)
+            self.i2c_pid = os.getpid()
+
+        return self.i2c
+
+    @staticmethod
+    def is_process_alive(pid):
+        """指定されたIDのプロセスが実行中であるかどうか(終了済みで回収されていない場合も除く)"""
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+        # 強制終了された子プロセスは親プロセスに回収されるまでゾンビとして残る
+        try:
+            with open("/proc/{0}/stat".format(pid), "r") as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except (OSError, IndexError):
+            return True
+
+    def reclaim(self):
+        """終了したプロセスが使用中のデータバスを解放し, 待機中の要求を取り除く(ロック内で呼び出す)"""
+
+        reclaimed = False
+
+        owner_pid = self.owner_pid.value
+        if owner_pid != 0 and not I2cBus.is_process_alive(owner_pid):
+            print("I2cBus::reclaim(): bus was held by terminated process {0}"
+                  .format(owner_pid))
+            self.owner_pid.value = 0
+            reclaimed = True
+
+        for i in range(I2cBus.MAX_WAITERS):
+            pid = self.waiter_pids[i]
+            if pid != 0 and not I2cBus.is_process_alive(pid):
+                self.waiter_pids[i] = 0
+                reclaimed = True
+
+        if reclaimed:
+            self.condition.notify_all()
+
+    def can_acquire(self, priority):
+        """指定された優先度の要求がデータバスを使用できるかどうか"""
+        # 使用中でなく, より優先度の高い要求が待機していなければ使用できる
+        return self.owner_pid.value == 0 and \
+            not any(self.waiter_pids[i] != 0 and self.waiter_priorities[i] < priority
+                    for i in range(I2cBus.MAX_WAITERS))
+
+    def wait_for(self, predicate):
+        """条件を満たすまで待機し, 一定時間ごとに終了したプロセスの要求を取り除く(ロック内で呼び出す)"""
+        while not self.condition.wait_for(predicate, I2cBus.LIVENESS_CHECK_INTERVAL):
+            self.reclaim()
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """データバスを使用できるまで待機"""
+
+        pid = os.getpid()
+
+        with self.condition:
+            # 待機中の要求を記録する空きを確保
+            self.wait_for(lambda: 0 in self.waiter_pids[:])
+            slot = self.waiter_pids[:].index(0)
+            self.waiter_pids[slot] = pid
+            self.waiter_priorities[slot] = priority
+
+            try:
+                self.wait_for(lambda: self.can_acquire(priority))
+            finally:
+                self.waiter_pids[slot] = 0
+
+            self.owner_pid.value = pid
+
+    def release(self, addr=None, bus_time=0.0, wait_time=0.0):
+        """データバスを解放"""
+
+        with self.condition:
+            # 通信に要した時間を記録(他のプロセスと競合しないようにロック内で更新)
+            if addr is not None:
+                self.bus_time[addr] += bus_time
+                self.wait_time[addr] += wait_time
+                self.transactions[addr] += 1
+
+            self.owner_pid.value = 0
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def transaction(self, addr, priority=PRIORITY_NORMAL):
+        """データバスを占有して指定されたアドレスのデバイスと通信"""
+
+        wait_start_time = time.monotonic()
+        self.acquire(priority)
+        start_time = time.monotonic()
+
+        try:
+            yield self.get_i2c()
+        finally:
+            self.release(addr, time.monotonic() - start_time,
+                         start_time - wait_start_time)
+
+    def write_byte_data(self, addr, reg, value, priority=PRIORITY_NORMAL):
+        """指定されたレジスタに1バイトのデータを書き込み"""
+        with self.transaction(addr, priority) as i2c:
+            i2c.write_byte_data(addr, reg, value)
+
+    def read_byte_data(self, addr, reg, priority=PRIORITY_NORMAL):
+        """指定されたレジスタから1バイトのデータを読み出し"""
+        with self.transaction(addr, priority) as i2c:
+            return i2c.read_byte_data(addr, reg)
+
+    def write_block_data(self, addr, reg, data, priority=PRIORITY_NORMAL):
+        """指定されたレジスタから連続する複数のレジスタに1回の通信で書き込み"""
+        with self.transaction(addr, priority) as i2c:
+            i2c.write_i2c_block_data(addr, reg, list(data))
+
+    def read_block_data(self, addr, reg, length, priority=PRIORITY_NORMAL):
+        """指定されたレジスタから連続する複数のレジスタを1回の通信で読み出し"""
+        with self.transaction(addr, priority) as i2c:
+            return i2c.read_i2c_block_data(addr, reg, length)
+
+    def get_counters(self):
+        """各アドレスのデバイスとの通信の統計を取得"""
+        with self.condition:
+            return { addr: { "transactions": self.transactions[addr],
+                             "bus_time": self.bus_time[addr],
+                             "wait_time": self.wait_time[addr] }
+                     for addr in range(I2cBus.ADDR_NUM) if self.transactions[addr] > 0 }
@@ -0,0 +1,212 @@
+# coding: utf-8
+# mapping_node.py
+
+import collections
+import math
+import multiprocessing as mp
+import numpy as np
+import time
+
+from data_sender_node import DataSenderNode
+from occupancy_grid import OccupancyGrid
+
+class MappingNode(DataSenderNode):
+    """
+    超音波センサの計測値とロボットの位置から占有格子地図を作成するクラス
+    """
+
+    def __init__(self, process_manager, msg_queue, occupancy_grid,
+                 interval=0.1, max_range=150.0, beam_width=30.0, beam_rays=5,
+                 servo_addr=None, servo_center=90.0):
+        """コンストラクタ"""
+        super().__init__(process_manager, msg_queue)
+
+        # 占有格子地図(共有メモリ上に保持)
+        # アプリケーションや他のノードはプロセス間通信を行わずに参照できる
+        self.grid = occupancy_grid
+        # 地図を更新する間隔(秒)
+        self.interval = interval
+        # 地図の更新に用いる計測値の最大の距離(センチメートル)
+        self.max_range = max_range
+        # 超音波センサの指向角(度)と, 指向角の範囲に広げる光線の本数
+        self.beam_width = beam_width
+        self.beam_rays = beam_rays
+        # サーボモータに取り付けられた超音波センサのアドレス
+        self.servo_addr = servo_addr
+        # 超音波センサが正面を向くときのサーボモータの角度(度)
+        self.servo_center = servo_center
+
+        # ロボットの位置(センチメートル)と向き(ラジアン)
+        # 地図の中心を原点とし, 初期状態ではx軸の正の向きを向いている
+        self.pose = mp.RawArray("d", 3)
+        # 計測した時刻のロボットの位置と向きを求めるために保持する, 直近の位置と向きの個数
+        # 保持している最も古い時刻より前の計測値は地図の更新に使用しない
+        self.pose_history_size = 32
+        # 直近の位置と向きの履歴((時刻, x, y, 向き)のタプル, ノードのプロセス内で作成)
+        self.pose_history = None
+
+        # 以下はNodeManager::connect_nodes()により設定される
+        # モータのノードと共有する左右のモータの速度(SharedMotorState)
+        self.motor_state = None
+        # モータの速度を車輪の回転速度(センチメートル毎秒)に変換する関数
+        self.speed_converter = None
+        # 左右の車輪の間の距離(センチメートル)
+        self.distance_between_wheels = None
+        # 超音波センサの計測値の履歴
+        self.range_history = None
+        # 各超音波センサの向き(度, 正面が0で左が正)
+        self.sensor_bearings = {}
+        # サーボモータのノードの状態(サーボモータの角度の参照に使用)
+        self.servo_state = None
+
+    def initialize_state_dict(self):
+        """ノードの状態を格納するディクショナリを初期化"""
+        super().initialize_state_dict()
+
+        # ロボットの位置と向き
+        self.state_dict["pose"] = { "x": 0.0, "y": 0.0, "theta": 0.0 }
+        # 地図が更新された回数
+        self.state_dict["updates"] = 0
+
+    def set_sources(self, motor_state, speed_converter, distance_between_wheels,
+                    range_history, sensor_bearings=None, servo_state=None):
+        """地図の作成に用いる他のノードの状態を設定"""
+        self.motor_state = motor_state
+        self.speed_converter = speed_converter
+        self.distance_between_wheels = distance_between_wheels
+        self.range_history = range_history
+        self.sensor_bearings = sensor_bearings or {}
+        self.servo_state = servo_state
+
+    def get_pose(self):
+        """ロボットの位置と向きを取得"""
+        return self.pose[0], self.pose[1], self.pose[2]
+
+    def integrate_pose(self, dt):
+        """指令された左右の車輪の回転速度からロボットの位置と向きを更新"""
+
+        speed_left, speed_right = self.motor_state.get_speeds()
+        left_velocity = self.speed_converter(speed_left)
+        right_velocity = self.speed_converter(speed_right)
+        velocity = (left_velocity + right_velocity) / 2.0
+        angle_velocity = (right_velocity - left_velocity) / self.distance_between_wheels
+
+        x, y, theta = self.get_pose()
+        # 移動している間の平均の向きに進んだとみなす
+        mid_theta = theta + angle_velocity * dt / 2.0
+        x += velocity * math.cos(mid_theta) * dt
+        y += velocity * math.sin(mid_theta) * dt
+        theta = math.atan2(math.sin(theta + angle_velocity * dt),
+                           math.cos(theta + angle_velocity * dt))
+
+        self.pose[0], self.pose[1], self.pose[2] = x, y, theta
+
+    def record_pose(self, current_time):
+        """現在のロボットの位置と向きを履歴に追加"""
+        x, y, theta = self.get_pose()
+        self.pose_history.append((current_time, x, y, theta))
+
+    def interpolate_pose(self, timestamps):
+        """
+        位置と向きの履歴を線形補間して, 各時刻のロボットの位置と向きを取得
+        履歴の最も古い時刻より前の時刻はNaNとする
+        """
+
+        history = np.array(self.pose_history, dtype=np.float64)
+        times = history[:, 0]
+        # 向きは-πからπの範囲で不連続となるため, 連続となるように直してから補間
+        thetas = np.unwrap(history[:, 3])
+
+        x = np.interp(timestamps, times, history[:, 1])
+        y = np.interp(timestamps, times, history[:, 2])
+        theta = np.interp(timestamps, times, thetas)
+
+        stale = timestamps < times[0]
+        x[stale], y[stale], theta[stale] = np.nan, np.nan, np.nan
+        return x, y, theta
+
+    def get_sensor_bearings(self, addr_list):
+        """各超音波センサのロボットに対する向き(ラジアン)を取得"""
+        bearings = np.array([self.sensor_bearings.get(addr, 0.0) for addr in addr_list])
+
+        # サーボモータに取り付けられた超音波センサはサーボモータの角度だけ回転
+        if self.servo_state is not None and self.servo_addr in addr_list:
+            bearings[addr_list.index(self.servo_addr)] += \
+                self.servo_state["angle"] - self.servo_center
+
+        return np.radians(bearings)
+
+    def update_map(self, last_count):
+        """前回の更新以降の計測値で地図を更新"""
+
+        count = self.range_history.get_count()
+        new_samples = min(count - last_count, self.range_history.capacity - 1)
+
+        if new_samples <= 0:
+            return count
+
+        ranges, timestamps = self.range_history.get_window(new_samples)
+        ranges = np.array(ranges, dtype=np.float64)
+        timestamps = np.array(timestamps, dtype=np.float64)
+
+        # 各計測値を計測した時刻のロボットの位置と向き
+        # 移動中に古い計測値を現在の位置から投影すると障害物が引き伸ばされるため,
+        # 履歴より古い計測値(処理が遅れた場合など)は使用しない
+        x, y, theta = self.interpolate_pose(timestamps)
+        ranges[np.isnan(x)] = np.nan
+
+        # 各計測値の光線の向き(超音波センサの指向角の範囲に光線を広げる)
+        bearings = self.get_sensor_bearings(self.range_history.addr_list)
+        spread = np.radians(np.linspace(-self.beam_width / 2.0, self.beam_width / 2.0,
+                                        self.beam_rays)) if self.beam_rays > 1 else np.zeros(1)
+        angles = theta[:, :, np.newaxis] + bearings[:, np.newaxis, np.newaxis] + \
+            spread[np.newaxis, np.newaxis, :]
+        ranges = np.broadcast_to(ranges[:, :, np.newaxis], angles.shape)
+        x = np.broadcast_to(x[:, :, np.newaxis], angles.shape)
+        y = np.broadcast_to(y[:, :, np.newaxis], angles.shape)
+
+        # 全ての光線でまとめて地図を更新
+        self.grid.update_rays(x.ravel(), y.ravel(), angles.ravel(), ranges.ravel(),
+                              self.max_range)
+        return count
+
+    def update(self):
+        """入力を処理して状態を更新"""
+
+        # 前回の更新までに処理した計測値の個数
+        last_count = self.range_history.get_count()
+        last_time = time.monotonic()
+
+        # 位置と向きの履歴を作成し, 開始時の位置と向きを追加
+        self.pose_history = collections.deque(maxlen=self.pose_history_size)
+        self.record_pose(last_time)
+
+        try:
+            while True:
+                time.sleep(self.interval)
+
+                current_time = time.monotonic()
+                self.integrate_pose(current_time - last_time)
+                self.record_pose(current_time)
+                last_time = current_time
+
+                last_count = self.update_map(last_count)
+
+                x, y, theta = self.get_pose()
+                self.state_dict["pose"] = { "x": x, "y": y, "theta": theta }
+                self.state_dict["updates"] = self.grid.update_count.value
+
+        except KeyboardInterrupt:
+            # プロセスが割り込まれた場合
+            print("MappingNode::update(): KeyboardInterrupt occurred")
+
+    def is_free_ahead(self, distance, width, threshold=0.0):
+        """ロボットの前方の矩形の範囲に障害物が無いと観測されているかどうか"""
+
+        x, y, theta = self.get_pose()
+        # 前方の矩形を囲む座標軸に平行な矩形で判定
+        corners = [(0.0, -width / 2.0), (0.0, width / 2.0),
+                   (distance, -width / 2.0), (distance, width / 2.0)]
+        xs = [x + cx * math.cos(theta) - cy * math.sin(theta) for cx, cy in corners]
+        ys = [y + cx * math.sin(theta) + cy * math.cos(theta) for cx, cy in corners]
+        return self.grid.is_region_free(min(xs), min(ys), max(xs), max(ys), threshold)
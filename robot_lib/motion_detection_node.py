@@ -3,40 +3,137 @@
 
 import cv2
 import multiprocessing as mp
+import numpy as np
 import time
 import queue
 
 from command_receiver_node import CommandReceiverNode, UnknownCommandException
+from frame_grabber import open_latest_frame_grabber
+from frame_ring import is_frame_valid
+from frame_rate_scheduler import FrameRateScheduler
 
 class MotionDetectionNode(CommandReceiverNode):
     """
     人の動きを検出するクラス
     """
 
+    # 背景のモデルの種類
+    # first-frame: 検出の開始時の画像を背景とする
+    # running-average: 画像の移動平均を背景とする(照明の緩やかな変化に追従)
+    # mog2, knn: OpenCVの背景差分(カメラの細かな振動や照明の変化に強い)
+    BACKGROUND_MODELS = ("first-frame", "running-average", "mog2", "knn")
+    # 検出結果の出力方法
+    # contour: 面積が閾値以上の輪郭がある場合に動きの検出を通知
+    # grid: 格子の各セルの動きの量と, 最も大きな動きの領域を毎回通知
+    OUTPUT_MODES = ("contour", "grid")
+    # 背景差分の作成時に最初の画像を学習させる回数
+    BACKGROUND_WARMUP_FRAMES = 10
+
     def __init__(self, process_manager, msg_queue,
                  camera_id, interval, frame_width, frame_height,
-                 contour_area_min):
+                 contour_area_min, video_capture=None,
+                 background_model="first-frame", learning_rate=0.05,
+                 scale=0.5, roi=None, threshold=40, blur_size=15,
+                 output_mode="contour", grid_size=(6, 8), fps=None,
+                 capture_config=None):
         """コンストラクタ"""
         super().__init__(process_manager, msg_queue)
 
         # ビデオ撮影デバイスの作成
         self.camera_id = camera_id
         self.interval = interval
+        # 人の動きを検出する周期を管理(目標のフレームレートの既定値は間隔の逆数)
+        self.scheduler = FrameRateScheduler(fps if fps is not None else 1.0 / interval)
         self.frame_width = frame_width
         self.frame_height = frame_height
 
-        self.video_capture = cv2.VideoCapture(camera_id)
-        self.video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        self.video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
-        self.video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
+        # ビデオ撮影デバイスのパラメータの設定
+        # カメラのノードが画像を共有する場合はリングバッファから読み出す
+        # それ以外の場合は画像を取り込み続けるスレッドから最新の画像を読み出す
+        # (capture_configで撮影形式や読み出す画像の形式を指定)
+        if video_capture is not None:
+            self.video_capture = video_capture
+        else:
+            self.video_capture = open_latest_frame_grabber(
+                camera_id, frame_width, frame_height, **(capture_config or {}))
         
         # 人の動きを検出中であるかどうか
         self.is_tracking = False
         # 人の動きを検出するための基準画像
         self.first_frame = None
-        # 輪郭の面積の閾値
+        # 輪郭の面積の閾値(縮小後の画像における面積)
         self.contour_area_min = contour_area_min
 
+        if background_model not in MotionDetectionNode.BACKGROUND_MODELS:
+            raise ValueError("MotionDetectionNode::__init__(): " +
+                             "unknown background model: {0}".format(background_model))
+
+        # 背景のモデル
+        self.background_model = background_model
+        # 背景のモデルを更新する割合(running-average, mog2, knnで使用)
+        self.learning_rate = learning_rate
+        # 画像の縮小率
+        self.scale = scale
+        # 人の動きを検出する範囲(x, y, w, h)(Noneの場合は画像全体)
+        self.roi = tuple(roi) if roi is not None else None
+        # 差分をノイズとみなす閾値
+        self.threshold = threshold
+        # 平滑化に用いるガウシアンフィルタの大きさ(奇数)
+        self.blur_size = blur_size
+
+        if output_mode not in MotionDetectionNode.OUTPUT_MODES:
+            raise ValueError("MotionDetectionNode::__init__(): " +
+                             "unknown output mode: {0}".format(output_mode))
+
+        # 検出結果の出力方法
+        self.output_mode = output_mode
+        # 動きの量を集計する格子の行数と列数
+        self.grid_size = tuple(grid_size)
+
+        # 格子の各セルが1画素以上となることを確認(切り出しと縮小の後の画像の大きさで判定)
+        if output_mode == "grid":
+            processed_width, processed_height = self.get_processed_size()
+            rows, cols = self.grid_size
+
+            if not (0 < rows <= processed_height and 0 < cols <= processed_width):
+                raise ValueError("MotionDetectionNode::__init__(): " +
+                                 "grid_size {0} does not fit the processed frame {1}x{2}"
+                                 .format(self.grid_size, processed_width, processed_height))
+
+        # 背景の画像(running-averageで使用)
+        self.background = None
+        # 背景差分のインスタンス(mog2, knnで使用)
+        self.background_subtractor = None
+        # 処理した画像の枚数
+        self.frame_count = 0
+
+        # 以下はNodeManager::connect_nodes()により設定される
+        # サーボモータのノードの状態と, モータのノードと共有する左右のモータの速度
+        # (ロボット自身の動きの判定に使用)
+        self.servo_state = None
+        self.motor_state = None
+        # サーボモータやモータが動いた後, 揺れが収まるまで検出を停止する時間(秒)
+        self.settle_time = 0.8
+
+    def initialize_state_dict(self):
+        """ノードの状態を格納するディクショナリを初期化"""
+        super().initialize_state_dict()
+
+        # 処理した画像の枚数
+        self.state_dict["frames"] = 0
+        # 1枚の画像の処理に要した時間とCPU時間(秒)
+        self.state_dict["process_time"] = 0.0
+        self.state_dict["cpu_time"] = 0.0
+        # 人の動きを検出したフレームレート(毎秒)と, 処理が間に合わずに飛ばした画像の数
+        self.state_dict["fps"] = 0.0
+        self.state_dict["dropped_frames"] = 0
+        # 格子の各セルで動きのある画素の割合(gridの場合のみ)
+        self.state_dict["heatmap"] = None
+        # 最も大きな動きの領域の矩形(x, y, w, h)(gridの場合のみ)
+        self.state_dict["motion_box"] = None
+        # ロボット自身が動いているために検出を停止しているかどうか
+        self.state_dict["paused"] = False
+
     def __del__(self):
         """デストラクタ"""
 
@@ -58,10 +155,17 @@ class MotionDetectionNode(CommandReceiverNode):
                         break
                 
                 if self.is_tracking:
+                    # 次の画像を処理する時刻まで待機
+                    self.scheduler.wait()
                     # 撮影した動画から人の動きを検出
                     self.detect_motion()
 
-                time.sleep(self.interval)
+                    self.state_dict["fps"] = self.scheduler.fps
+                    self.state_dict["dropped_frames"] = self.scheduler.dropped_frames
+                else:
+                    # 検出を再開したときに停止中のフレームを飛ばしたとみなさないように破棄
+                    self.scheduler.reset()
+                    time.sleep(self.interval)
 
         except KeyboardInterrupt:
             # プロセスが割り込まれた場合
@@ -87,8 +191,8 @@ class MotionDetectionNode(CommandReceiverNode):
         elif cmd["command"] == "end":
             # 人の動きの検出を終了
             self.is_tracking = False
-            # 基準の画像を破棄
-            self.first_frame = None
+            # 基準の画像と背景のモデルを破棄
+            self.reset_background()
             # 命令の実行終了をアプリケーションに伝達
             self.send_message("motion", { "command": cmd["command"], "state": "done" })
         else:
@@ -98,41 +202,217 @@ class MotionDetectionNode(CommandReceiverNode):
         # 命令の実行を完了
         self.command_queue.task_done()
         
+    def set_actuator_states(self, servo_state=None, motor_state=None, settle_time=0.8):
+        """ロボット自身の動きの判定に用いるサーボモータのノードの状態とモータの速度を設定"""
+        self.servo_state = servo_state
+        self.motor_state = motor_state
+        self.settle_time = settle_time
+
+    def is_ego_moving(self):
+        """サーボモータやモータが動いているか, 動いた直後で揺れが収まっていないかどうか"""
+
+        current_time = time.monotonic()
+
+        if self.servo_state is not None:
+            last_move_time = self.servo_state["last_move_time"]
+            if self.servo_state["moving"] or (last_move_time is not None and \
+                current_time - last_move_time < self.settle_time):
+                return True
+
+        if self.motor_state is not None:
+            last_move_time = self.motor_state.get_last_move_time()
+            if self.motor_state.is_moving() or \
+                (last_move_time is not None and current_time - last_move_time < self.settle_time):
+                return True
+
+        return False
+
+    def reset_background(self):
+        """背景のモデルを破棄(次の画像から作り直す)"""
+        self.first_frame = None
+        self.background = None
+        self.background_subtractor = None
+
+    def get_processed_size(self):
+        """切り出しと縮小を行った後の画像の横幅と縦幅を取得"""
+
+        width, height = (self.roi[2], self.roi[3]) if self.roi is not None \
+            else (self.frame_width, self.frame_height)
+
+        if self.scale != 1.0:
+            width, height = int(round(width * self.scale)), int(round(height * self.scale))
+
+        return width, height
+
+    def preprocess(self, frame):
+        """人の動きを検出する範囲を切り出して縮小し, 平滑化したグレースケール画像に変換"""
+
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            frame = frame[y:y + h, x:x + w]
+
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                               interpolation=cv2.INTER_AREA)
+
+        # 縮小したグレースケール画像を読み出す場合は変換済み
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        frame = cv2.GaussianBlur(frame, (self.blur_size, self.blur_size), 0)
+        return frame
+
+    def compute_foreground(self, frame):
+        """背景のモデルと比較して, 動きのある部分を255とする二値画像を計算"""
+
+        if self.background_model == "first-frame":
+            # 基準の画像を設定
+            if self.first_frame is None:
+                self.first_frame = frame
+                return None
+
+            # 基準の画像と現在の画像との差分を計算
+            frame_delta = cv2.absdiff(self.first_frame, frame)
+
+        elif self.background_model == "running-average":
+            # 背景の画像を設定
+            if self.background is None:
+                self.background = frame.astype("float32")
+                return None
+
+            # 背景の画像と現在の画像との差分を計算してから背景の画像を更新
+            frame_delta = cv2.absdiff(cv2.convertScaleAbs(self.background), frame)
+            cv2.accumulateWeighted(frame, self.background, self.learning_rate)
+
+        else:
+            # 背景差分のインスタンスを作成
+            if self.background_subtractor is None:
+                if self.background_model == "mog2":
+                    self.background_subtractor = cv2.createBackgroundSubtractorMOG2(
+                        detectShadows=False)
+                else:
+                    self.background_subtractor = cv2.createBackgroundSubtractorKNN(
+                        detectShadows=False)
+                # 最初の画像で背景を学習(複数の画像から背景を学習するため繰り返し与える)
+                for _ in range(MotionDetectionNode.BACKGROUND_WARMUP_FRAMES):
+                    self.background_subtractor.apply(frame)
+                return None
+
+            return self.background_subtractor.apply(frame, learningRate=self.learning_rate)
+
+        # 差分が小さいものはノイズと考えて無視
+        return cv2.threshold(frame_delta, self.threshold, 255, cv2.THRESH_BINARY)[1]
+
     def detect_motion(self):
         """撮影した動画から人の動きを検出"""
 
-        # 画像データを読み捨て
-        ret, frame = self.video_capture.read()
+        # ロボット自身が動いている間は, 背景のモデルを破棄して検出を停止
+        # 動きが収まった後の最初の画像から背景のモデルを作り直す
+        if self.is_ego_moving():
+            if not self.state_dict["paused"]:
+                self.reset_background()
+                self.state_dict["paused"] = True
+            return
+
+        self.state_dict["paused"] = False
 
-        # 画像データを取得
+        # 最新の画像データを取得
         ret, frame = self.video_capture.read()
-        frame = cv2.resize(frame, None, fx=0.5, fy=0.5)
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame = cv2.GaussianBlur(frame, (15, 15), 0)
-        
-        # 基準の画像を設定
-        if self.first_frame is None:
-            self.first_frame = frame
+
+        # 画像がキャプチャできなかった場合は何もしない
+        if frame is None:
+            return
+
+        start_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+
+        frame = self.preprocess(frame)
+
+        # 前処理(新たな画像を作成)の間に共有メモリ上の画像が上書きされた場合は何もしない
+        if not is_frame_valid(self.video_capture):
+            print("MotionDetectionNode::detect_motion(): frame was overwritten during processing")
+            return
+
+        frame_delta = self.compute_foreground(frame)
+
+        # 背景のモデルを作成した場合
+        if frame_delta is None:
+            return
+
+        # 格子に集計する場合は, 画素の割合が変わらないように差分を広げない
+        # (最も大きな動きの領域は連結成分から求めるため輪郭を形成する必要も無い)
+        if self.output_mode == "grid":
+            self.detect_motion_grid(frame_delta, start_time, start_cpu_time)
             return
 
-        # 基準の画像と現在の画像との差分を計算
-        frame_delta = cv2.absdiff(self.first_frame, frame)
-        # 差分が小さいものはノイズと考えて無視
-        frame_delta = cv2.threshold(frame_delta, 40, 255, cv2.THRESH_BINARY)[1]
         # 差分が一定値以上の部分を広げて輪郭を形成
         frame_delta = cv2.dilate(frame_delta, None, iterations=2)
-        
+
         # 輪郭を差分画像から取り出し
-        contours = cv2.findContours(frame_delta.copy(),
+        # OpenCVのバージョンによって戻り値の個数が異なる(3.xは3つ, 2.xと4.x以降は2つ)
+        contours = cv2.findContours(frame_delta,
                                     cv2.RETR_EXTERNAL,
-                                    cv2.CHAIN_APPROX_SIMPLE)
-        contours = contours[1]
+                                    cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+        motion_detected = any(cv2.contourArea(contour) >= self.contour_area_min
+                              for contour in contours)
+
+        self.update_cost(start_time, start_cpu_time)
+
+        if motion_detected:
+            # 人の動きが検出されたことをアプリケーションに伝達
+            self.send_message("motion", { "state": "motion-detected" })
+
+    def compute_heatmap(self, frame_delta):
+        """二値画像を格子に分割し, 各セルで動きのある画素の割合を計算"""
+
+        rows, cols = self.grid_size
+        height, width = frame_delta.shape[:2]
+        cell_height, cell_width = height // rows, width // cols
+
+        # 割り切れない端の画素を除き, 各セルの画素の和をまとめて計算
+        cells = (frame_delta[:rows * cell_height, :cols * cell_width] > 0).reshape(
+            rows, cell_height, cols, cell_width)
+        return cells.sum(axis=(1, 3), dtype=np.int32) / float(cell_height * cell_width)
+
+    def compute_motion_box(self, frame_delta):
+        """最も大きな動きの領域の矩形と面積(縮小後の画像における面積)を計算"""
+
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats(frame_delta, connectivity=8)
+
+        # ラベル0は背景
+        if num_labels <= 1:
+            return None, 0
+
+        label = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        x, y, w, h, area = (int(v) for v in stats[label])
+
+        # 元の画像の座標に変換
+        offset_x, offset_y = self.roi[:2] if self.roi is not None else (0, 0)
+        box = (int(x / self.scale) + offset_x, int(y / self.scale) + offset_y,
+               int(w / self.scale), int(h / self.scale))
+        return box, area
+
+    def detect_motion_grid(self, frame_delta, start_time, start_cpu_time):
+        """動きの量の格子と最も大きな動きの領域を計算してアプリケーションに伝達"""
+
+        heatmap = self.compute_heatmap(frame_delta)
+        motion_box, area = self.compute_motion_box(frame_delta)
+
+        self.update_cost(start_time, start_cpu_time)
+
+        self.state_dict["heatmap"] = heatmap
+        self.state_dict["motion_box"] = motion_box
+
+        self.send_message("motion", { "state": "motion-grid",
+                                      "heatmap": heatmap, "box": motion_box })
 
-        for contour in contours:
-            if cv2.contourArea(contour) < self.contour_area_min:
-                continue
-            else:
-                # 人の動きが検出されたことをアプリケーションに伝達
-                self.send_message("motion", { "state": "motion-detected" })
-                break
+        if area >= self.contour_area_min:
+            # 人の動きが検出されたことをアプリケーションに伝達
+            self.send_message("motion", { "state": "motion-detected", "box": motion_box })
 
+    def update_cost(self, start_time, start_cpu_time):
+        """1枚の画像の処理に要した時間とCPU時間を記録"""
+        self.frame_count += 1
+        self.state_dict["frames"] = self.frame_count
+        self.state_dict["process_time"] = time.perf_counter() - start_time
+        self.state_dict["cpu_time"] = time.thread_time() - start_cpu_time
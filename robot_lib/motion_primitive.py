@@ -0,0 +1,99 @@
+# coding: utf-8
+# motion_primitive.py
+
+import collections
+import hashlib
+import json
+
+class MotionPrimitive(object):
+    """
+    SPIのデータ列と待ち時間に変換済みのモータの命令列を表すクラス
+    """
+
+    def __init__(self, key, steps):
+        """コンストラクタ"""
+
+        # 命令列を識別するキー
+        self.key = key
+        # 各ステップは(左の速度, 右の速度, 待ち時間, 左のデータ列, 右のデータ列)のタプル
+        # 速度を変更しないモータの速度とデータ列にはNoneが格納される
+        self.steps = steps
+        # 命令列の実行に要する時間(秒)
+        self.duration = sum(step[2] for step in steps)
+
+    def final_speeds(self, speed_left, speed_right):
+        """命令列を実行した後の左右のモータの速度を計算"""
+        for step in self.steps:
+            speed_left = step[0] if step[0] is not None else speed_left
+            speed_right = step[1] if step[1] is not None else speed_right
+        return speed_left, speed_right
+
+class MotionPrimitiveCache(object):
+    """
+    変換済みのモータの命令列を保持するLRUキャッシュのクラス
+    """
+
+    @staticmethod
+    def normalize_value(value):
+        """命令列に含まれる値をJSONに変換できる型に変換(NumPyの数値などに対応)"""
+
+        if isinstance(value, dict):
+            return { str(k): MotionPrimitiveCache.normalize_value(v) for k, v in value.items() }
+        if isinstance(value, (list, tuple)):
+            return [MotionPrimitiveCache.normalize_value(v) for v in value]
+        if isinstance(value, (str, bool)) or value is None:
+            return value
+
+        # NumPyの整数や浮動小数点数などはPythonの数値に変換
+        # 整数値を持つ浮動小数点数も同じIDとなるように, 整数に変換できるものは整数とする
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("MotionPrimitiveCache::normalize_value(): " +
+                             "value cannot be used in a sequence: {0!r}".format(value))
+
+        return int(number) if number.is_integer() else number
+
+    @staticmethod
+    def compute_id(sequence):
+        """命令列のIDを計算"""
+        data = json.dumps(MotionPrimitiveCache.normalize_value(list(sequence)),
+                          sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+    def __init__(self, capacity=32):
+        """コンストラクタ"""
+
+        # キャッシュに保持する命令列の最大数
+        self.capacity = capacity
+        # 変換済みの命令列(最近使用されたものほど末尾に置かれる)
+        self.primitives = collections.OrderedDict()
+        # キャッシュのヒット数とミス数
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """指定されたキーを持つ命令列を取得(存在しない場合はNone)"""
+        primitive = self.primitives.get(key)
+
+        if primitive is None:
+            self.misses += 1
+            return None
+
+        # 最近使用された命令列として末尾に移動
+        self.primitives.move_to_end(key)
+        self.hits += 1
+        return primitive
+
+    def put(self, primitive):
+        """命令列をキャッシュに追加"""
+        self.primitives[primitive.key] = primitive
+        self.primitives.move_to_end(primitive.key)
+
+        # 最も長い間使用されていない命令列を破棄
+        while len(self.primitives) > self.capacity:
+            self.primitives.popitem(last=False)
+
+    def get_counters(self):
+        """キャッシュの状態を取得"""
+        return { "size": len(self.primitives), "hits": self.hits, "misses": self.misses }
@@ -1,8 +1,10 @@
 # coding: utf-8
 # motor_l6470.py
 
+import multiprocessing as mp
 import struct
 import sys
+import threading
 import time
 import wiringpi as wp
 
@@ -20,13 +22,59 @@ class MotorL6470(object):
     # SPIのクロック周波数
     L6470_SPI_SPEED = 10 ** 6
 
-    def __init__(self, spi_channel, speed=L6470_SPI_SPEED):
+    # レジスタ名とレジスタアドレス, レジスタのバイト数
+    REGISTERS = {
+        "ABS_POS": (0x01, 3),
+        "MAX_SPEED": (0x07, 2),
+        "KVAL_HOLD": (0x09, 1),
+        "KVAL_RUN": (0x0A, 1),
+        "KVAL_ACC": (0x0B, 1),
+        "KVAL_DEC": (0x0C, 1),
+        "ST_SLP": (0x0E, 1),
+        "FN_SLP_DEC": (0x10, 1),
+        "OCD_TH": (0x13, 1),
+        "STALL_TH": (0x14, 1),
+        "FS_SPD": (0x15, 2),
+        "STEP_MODE": (0x16, 1)
+    }
+
+    # 1ステップあたりのマイクロステップ数とSTEP_MODEレジスタのSTEP_SELの値
+    STEP_MODES = { 1: 0x00, 2: 0x01, 4: 0x02, 8: 0x03,
+                   16: 0x04, 32: 0x05, 64: 0x06, 128: 0x07 }
+
+    def __init__(self, spi_channel, speed=L6470_SPI_SPEED,
+                 microsteps=128, full_step_speed=None):
         """コンストラクタ"""
-        print("MotorL6470::__init__(): channel: {0}, speed: {1}"
-              .format(spi_channel, speed))
+        print("MotorL6470::__init__(): channel: {0}, speed: {1}, microsteps: {2}"
+              .format(spi_channel, speed, microsteps))
+
+        if microsteps not in MotorL6470.STEP_MODES:
+            raise MotorInitFailedException(
+                "MotorL6470::__init__(): " +
+                "microsteps must be one of {0}: {1}"
+                .format(sorted(MotorL6470.STEP_MODES.keys()), microsteps))
         
         # 使用するSPIチャネル
         self.channel = spi_channel
+        # 1ステップあたりのマイクロステップ数
+        # L6470の速度のレジスタはフルステップ単位であり, マイクロステップ数には依存しない
+        # 位置のレジスタ(ABS_POS)はマイクロステップ単位である
+        self.microsteps = microsteps
+        # フルステップ駆動に切り替わる速度(FS_SPDレジスタの値, Noneの場合は既定値)
+        self.full_step_speed = full_step_speed
+        # SPI通信を排他制御するためのロック
+        # 状態監視のスレッドとコマンドの送信とが混在しないようにする
+        self.lock = threading.RLock()
+
+        # 最後に書き込んだレジスタの値(シャドウレジスタ)
+        self.register_shadow = {}
+        # 最後に送信した回転のコマンド(4バイト)
+        # モータのノードのプロセスとアプリケーションのプロセスとで共有する
+        self.run_shadow = mp.RawArray("B", 4)
+        # 最後に送信した回転のコマンドが有効かどうか
+        self.run_shadow_valid = mp.RawValue("b", 0)
+        # 送信したコマンドと省略したコマンドの回数
+        self.transaction_counters = { "issued": 0, "elided": 0 }
 
         # SPIチャネルはwiringpi::wiringPiSPISetup()関数の呼び出しによって,
         # 初期化済みであると仮定する
@@ -46,7 +94,7 @@ class MotorL6470(object):
             print("MotorL6470::read_byte(): " +
                   "could not receive the byte data")
 
-        return data
+        return retdata
         
     def write_byte(self, data):
         """1バイトのデータを書き込み"""
@@ -68,7 +116,7 @@ class MotorL6470(object):
             print("MotorL6470::read_bytes(): " +
                   "the number of bytes received is less than the desired one")
         
-        return data
+        return retdata
 
     def write_bytes(self, data, length_in_bytes):
         """指定されたバイト数のデータを書き込み"""
@@ -77,92 +125,210 @@ class MotorL6470(object):
         data = data.to_bytes(length_in_bytes, byteorder="big")
         wp.wiringPiSPIDataRW(self.channel, data)
 
-    def setup(self):
+    def setup(self, force=False):
         """モータのセットアップ"""
 
         print("MotorL6470::setup(): channel: {0}".format(self.channel))
 
-        # レジスタアドレス(MAX_SPEEDレジスタ)
-        self.write_byte(0x07)
-        
         # 最大回転スピード値(10ビット)
         # 初期値は0x41
-        self.write_byte(0x00)
-        self.write_byte(0x25)
+        self.set_param("MAX_SPEED", 0x0025, force)
 
-        # レジスタアドレス(KVAL_HOLDレジスタ)
-        self.write_byte(0x09)
         # モータ停止中の電圧(8ビット)
-        self.write_byte(0xFF)
-
-        # レジスタアドレス(KVAL_RUNレジスタ)
-        self.write_byte(0x0A)
+        self.set_param("KVAL_HOLD", 0xFF, force)
         # モータ定速回転中の電圧(8ビット)
-        self.write_byte(0xFF)
-
-        # レジスタアドレス(KVAL_ACCレジスタ)
-        self.write_byte(0x0B)
+        self.set_param("KVAL_RUN", 0xFF, force)
         # モータ加速中の電圧(8ビット)
-        self.write_byte(0xFF)
-
-        # レジスタアドレス(KVAL_DECレジスタ)
-        self.write_byte(0x0C)
+        self.set_param("KVAL_ACC", 0xFF, force)
         # モータ減速中の電圧(8ビット)
-        self.write_byte(0x40)
+        self.set_param("KVAL_DEC", 0x40, force)
 
-        # レジスタアドレス(OCD_THレジスタ)
-        self.write_byte(0x13)
         # オーバーカレントスレッショルド(4ビット)
         # 最大値の6Aに設定
-        self.write_byte(0x0F)
-
-        # レジスタアドレス(STALL_THレジスタ)
-        self.write_byte(0x14)
+        self.set_param("OCD_TH", 0x0F, force)
         # ストール電流スレッショルド(4ビット)
         # 最大値の4Aに設定
-        self.write_byte(0x7F)
+        self.set_param("STALL_TH", 0x7F, force)
 
-        # レジスタアドレス(ST_SLPレジスタ)
-        self.write_byte(0x0E)
         # スタートスロープ
-        self.write_byte(0x00)
-
-        # レジスタアドレス(FN_SLP_DECレジスタ)
-        self.write_byte(0x10)
+        self.set_param("ST_SLP", 0x00, force)
         # デセラレーションファイナルスロープ
-        self.write_byte(0x29)
+        self.set_param("FN_SLP_DEC", 0x29, force)
+
+        # マイクロステップ数(電源投入時の既定値は1/128ステップ)
+        self.set_step_mode(self.microsteps, force)
+
+        # フルステップ駆動に切り替わる速度(10ビット)
+        if self.full_step_speed is not None:
+            self.set_param("FS_SPD", self.full_step_speed, force)
+
+    def set_step_mode(self, microsteps, force=False):
+        """1ステップあたりのマイクロステップ数を設定"""
+
+        # 同期出力は使用しない
+        value = MotorL6470.STEP_MODES[microsteps]
+
+        if not force and self.register_shadow.get("STEP_MODE") == value:
+            self.transaction_counters["elided"] += 1
+            return False
+
+        # STEP_MODEレジスタはブリッジが高インピーダンスのときのみ書き込み可能
+        with self.lock:
+            # ブリッジを直ちに高インピーダンスに設定(HardHiZコマンド)
+            self.write_byte(0xA8)
+            self.invalidate_run_shadow()
+            self.set_param("STEP_MODE", value, force=True)
+
+        self.microsteps = microsteps
+        return True
+
+    def get_position(self):
+        """モータの現在位置(マイクロステップ単位)を取得"""
+
+        # ABS_POSレジスタは22ビットの2の補数表現
+        value = self.get_param("ABS_POS") & 0x3FFFFF
+
+        if value & 0x200000:
+            value -= 0x400000
+
+        return value
+
+    def set_param(self, name, value, force=False):
+        """レジスタに値を書き込み(値が変化しない場合は書き込みを省略)"""
+
+        # レジスタアドレスとレジスタのバイト数
+        address, length_in_bytes = MotorL6470.REGISTERS[name]
+
+        # 前回書き込んだ値と同じであれば省略
+        if not force and self.register_shadow.get(name) == value:
+            self.transaction_counters["elided"] += 1
+            return False
+
+        with self.lock:
+            # レジスタアドレス(SetParamコマンド)を送信
+            self.write_byte(address)
+
+            # レジスタの値を上位バイトから1バイトずつ送信
+            for i in reversed(range(length_in_bytes)):
+                self.write_byte((value >> (8 * i)) & 0xFF)
+
+        self.register_shadow[name] = value
+        self.transaction_counters["issued"] += 1
+        return True
+
+    def get_param(self, name):
+        """レジスタの値を読み出し"""
+
+        # レジスタアドレスとレジスタのバイト数
+        address, length_in_bytes = MotorL6470.REGISTERS[name]
+        value = 0
+
+        with self.lock:
+            # レジスタアドレス(GetParamコマンド)を送信
+            self.write_byte(0x20 | address)
+
+            # レジスタの値を上位バイトから1バイトずつ受信
+            for i in range(length_in_bytes):
+                value = (value << 8) | self.read_byte()[0]
+
+        self.transaction_counters["issued"] += 1
+        return value
+
+    def invalidate_run_shadow(self):
+        """最後に送信した回転のコマンドを破棄(次回のコマンドは必ず送信される)"""
+        self.run_shadow_valid.value = 0
+
+    def resync(self):
+        """レジスタの値と回転のコマンドを強制的に再送信"""
+
+        print("MotorL6470::resync(): channel: {0}".format(self.channel))
+
+        with self.lock:
+            for name, value in list(self.register_shadow.items()):
+                self.set_param(name, value, force=True)
+
+            if self.run_shadow_valid.value:
+                self.write_payload(tuple(bytes([b]) for b in self.run_shadow))
+                self.transaction_counters["issued"] += 1
+
+    def get_transaction_counters(self):
+        """送信したコマンドと省略したコマンドの回数を取得"""
+        return dict(self.transaction_counters)
 
     def get_status(self):
         """モータの状態を取得"""
 
-        print("MotorL6470::get_status(): channel: {0}".format(self.channel))
+        # print("MotorL6470::get_status(): channel: {0}".format(self.channel))
         
-        # モータの状態取得のコマンドを送信
-        self.write_byte(0xD0)
+        with self.lock:
+            # モータの状態取得のコマンドを送信
+            self.write_byte(0xD0)
+
+            # モータの状態を取得
+            # L6470は1バイトごとにチップセレクトを解除する必要がある
+            data_high = self.read_byte()
+            data_low = self.read_byte()
 
-        # モータの状態を取得
-        data_bytes = self.read_bytes(2)
-        status = ((data_bytes[0] << 8) | data_bytes[1]) & 0xFFFF
+        status = ((data_high[0] << 8) | data_low[0]) & 0xFFFF
 
         return status
 
-    def run(self, speed):
+    def make_run_payload(self, speed):
+        """モータを所定の速度で回転させるためのSPIのデータ列を作成"""
+
+        # スピードが正であれば前進, 負であれば後進
+        cmd = 0x50 if speed < 0 else 0x51
+        speed = abs(speed)
+
+        # コマンドと回転速度(3バイト)を1バイトずつ送信するためのデータ列
+        return (cmd.to_bytes(1, byteorder="big"),
+                ((0x0F0000 & speed) >> 16).to_bytes(1, byteorder="big"),
+                ((0x00FF00 & speed) >> 8).to_bytes(1, byteorder="big"),
+                (0x0000FF & speed).to_bytes(1, byteorder="big"))
+
+    def write_payload(self, payload):
+        """作成済みのSPIのデータ列を1バイトずつ書き込み"""
+        with self.lock:
+            for data in payload:
+                wp.wiringPiSPIDataRW(self.channel, data)
+
+    def run(self, speed, payload=None, force=False):
         """モータを所定の速度で回転"""
         
         # print("MotorL6470::run(): channel: {0}, speed: {1}"
         #       .format(self.channel, speed))
         
-        # スピードが正であれば前進, 負であれば後進
-        cmd = 0x50 if speed < 0 else 0x51
-        speed = abs(speed)
+        # SPIのデータ列が作成済みでない場合は作成
+        if payload is None:
+            payload = self.make_run_payload(speed)
+
+        data = b"".join(payload)
+
+        with self.lock:
+            # 前回と同じ回転のコマンドであれば省略
+            if not force and self.run_shadow_valid.value and \
+                bytes(self.run_shadow) == data:
+                self.transaction_counters["elided"] += 1
+                return False
+
+            # モータ回転のコマンドとモータの回転速度を送信
+            self.write_payload(payload)
+
+            self.run_shadow[:] = data
+            self.run_shadow_valid.value = 1
+
+        self.transaction_counters["issued"] += 1
+        return True
+
+    def hardstop(self):
+        """モータを直ちに停止"""
 
-        # モータ回転のコマンドを送信
-        self.write_byte(cmd)
+        print("MotorL6470::hardstop(): channel: {0}".format(self.channel))
 
-        # モータの回転速度を送信
-        self.write_byte((0x0F0000 & speed) >> 16)
-        self.write_byte((0x00FF00 & speed) >> 8)
-        self.write_byte((0x0000FF & speed))
+        # モータ停止のコマンド(HardStopコマンド)を送信
+        with self.lock:
+            self.write_byte(0xB8)
+            self.invalidate_run_shadow()
 
     def softstop(self):
         """モータを減速させて停止"""
@@ -170,7 +336,9 @@ class MotorL6470(object):
         print("MotorL6470::softstop(): channel: {0}".format(self.channel))
 
         # モータ停止のコマンドを送信
-        self.write_byte(0xB0)
+        with self.lock:
+            self.write_byte(0xB0)
+            self.invalidate_run_shadow()
         
         while True:
             # モータの状態を取得
@@ -189,7 +357,9 @@ class MotorL6470(object):
         print("MotorL6470::softhiz(): channel: {0}".format(self.channel))
 
         # ブリッジを高インピーダンスに設定
-        self.write_byte(0xA0)
+        with self.lock:
+            self.write_byte(0xA0)
+            self.invalidate_run_shadow()
 
         while True:
             # モータの状態を取得
@@ -4,16 +4,30 @@
 import math
 import multiprocessing as mp
 import queue
+import threading
 import time
 
 from command_receiver_node import CommandReceiverNode, UnknownCommandException
+from motion_primitive import MotionPrimitive, MotionPrimitiveCache
+from motor_status_monitor import MotorStatusMonitor
+from safety_interlock import SafetyInterlockException
+from shared_motor_state import SharedMotorState
 
 class MotorNode(CommandReceiverNode):
     """
     ロボットのモータを操作するクラス
     """
+
+    # 速度変化のステップのリストに変換できるコマンド
+    PLANNABLE_COMMANDS = (
+        "set-speed", "set-left-speed", "set-right-speed",
+        "set-speed-imm", "set-left-speed-imm", "set-right-speed-imm",
+        "move-distance", "rotate0", "rotate1", "rotate2",
+        "pivot-turn", "spin-turn", "wait", "stop")
     
-    def __init__(self, process_manager, msg_queue, motor_left, motor_right):
+    def __init__(self, process_manager, msg_queue, motor_left, motor_right,
+                 status_monitor_interval=0.1, primitive_cache_size=32,
+                 avoidance_config=None):
         """コンストラクタ"""
         super().__init__(process_manager, msg_queue)
 
@@ -21,12 +35,69 @@ class MotorNode(CommandReceiverNode):
         self.motor_left = motor_left
         self.motor_right = motor_right
 
+        # モータの状態(STATUSレジスタ)を監視するクラス
+        # 監視の間隔にNoneまたは0を指定した場合は監視しない
+        if status_monitor_interval:
+            self.status_monitor = MotorStatusMonitor(
+                { "left": self.motor_left, "right": self.motor_right },
+                status_monitor_interval,
+                self.on_motor_status_event,
+                self.on_motor_status_counters)
+        else:
+            self.status_monitor = None
+
         # 車輪の直径(センチメートル)
         self.wheel_diameter = 9.8
         # 車輪と車輪との距離(センチメートル)
         self.distance_between_wheels = 21.3
-        # 1回転に要するステップ数
+        # 1回転に要するステップ数(フルステップ単位)
+        # モータドライバの速度はフルステップ単位で指定する
         self.steps_per_revolution = 200
+        # 1ステップあたりのマイクロステップ数
+        self.microsteps = self.motor_left.microsteps
+        # 1回転に要するマイクロステップ数(モータの位置はマイクロステップ単位)
+        self.microsteps_per_revolution = self.steps_per_revolution * self.microsteps
+
+        # 登録された命令列(IDと命令列のディクショナリ)
+        self.primitive_sequences = {}
+        # 命令列の名前とIDのディクショナリ
+        self.primitive_names = {}
+        # 変換済みの命令列のキャッシュ
+        self.primitive_cache = MotionPrimitiveCache(primitive_cache_size)
+
+        # 他のノードのプロセスと共有する左右のモータの速度
+        # ノードを停止(terminate())して再実行しても同じものを使用する
+        self.shared_state = SharedMotorState()
+
+        # 超音波センサのノードと共有する安全インターロック
+        # NodeManager::connect_nodes()により設定される
+        self.interlock = None
+        # 安全インターロックが作動したときの動作("stop"または"hardstop")
+        self.interlock_action = "stop"
+        # 安全インターロックが作動してからモータを停止させるまでの時間(秒)のリスト
+        self.interlock_latencies = []
+        # モータの速度の変更と安全インターロックによる停止とを排他制御するためのロック
+        self.actuation_lock = threading.Lock()
+
+        # 超音波センサのノードの状態(アドレスと距離情報のディクショナリ)
+        # NodeManager::connect_nodes()により設定される
+        self.range_state = None
+        # 障害物回避の設定
+        avoidance_config = avoidance_config or {}
+        # 各超音波センサの向き(アドレスと角度(度数法, 左向きが正)のディクショナリ)
+        self.sensor_bearings = avoidance_config.get("sensor_bearings", {})
+        # 前方の障害物とみなす超音波センサの向きの範囲(度数法)
+        self.forward_fov = avoidance_config.get("forward_fov", 45.0)
+        # ロボットを停止させる障害物までの距離(センチメートル)
+        self.stop_distance = avoidance_config.get("stop_distance", 15.0)
+        # 停止させる衝突までの時間(秒)
+        self.stop_ttc = avoidance_config.get("stop_ttc", 0.5)
+        # 減速を開始する衝突までの時間(秒)
+        self.slow_ttc = avoidance_config.get("slow_ttc", 2.0)
+        # 障害物から遠ざかる旋回の強さ(ラジアン毎秒 * センチメートル)
+        self.steer_gain = avoidance_config.get("steer_gain", 20.0)
+        # 制御ループの周期(秒)
+        self.control_interval = avoidance_config.get("control_interval", 0.05)
 
     def __del__(self):
         """デストラクタ"""
@@ -46,10 +117,47 @@ class MotorNode(CommandReceiverNode):
         # モータの状態をディクショナリに格納
         self.state_dict["speed_left"] = 0
         self.state_dict["speed_right"] = 0
+        # モータの状態監視のカウンタ
+        self.state_dict["status_counters"] = None
+        # 変換済みの命令列のキャッシュの状態
+        self.state_dict["primitive_cache"] = None
+        # 安全インターロックが作動した回数と停止までの時間(秒)
+        self.state_dict["interlock"] = None
+        # 送信したSPIのコマンドと省略したSPIのコマンドの回数
+        self.state_dict["spi_counters"] = None
+        # 左右の車輪の移動距離(センチメートル)
+        self.state_dict["odometry"] = None
+        # 最後にモータの速度を変更した時刻(time.monotonic()の値)
+        self.state_dict["last_move_time"] = None
+
+    def on_motor_status_event(self, event):
+        """モータのストールや異常が検出されたときに呼び出される"""
+        print("MotorNode::on_motor_status_event(): {0}".format(event))
+
+        # ブリッジが無効化されている可能性があるため, 次回の回転のコマンドは省略させない
+        motor = self.motor_left if event["motor"] == "left" else self.motor_right
+        motor.invalidate_run_shadow()
+
+        # ストールや異常の発生をアプリケーションに伝達
+        self.send_message("motor", event)
+
+    def on_motor_status_counters(self, counters):
+        """モータの状態監視のカウンタを更新"""
+        self.state_dict["status_counters"] = counters
 
     def process_command(self):
         """モータの命令を処理"""
         
+        # モータの状態の監視を開始
+        if self.status_monitor is not None:
+            self.status_monitor.start()
+
+        # 安全インターロックの監視を開始
+        if self.interlock is not None:
+            interlock_thread = threading.Thread(target=self.watch_interlock, args=())
+            interlock_thread.daemon = True
+            interlock_thread.start()
+
         try:
             while True:
                 # モータへの命令をキューから取り出し
@@ -66,18 +174,24 @@ class MotorNode(CommandReceiverNode):
                 # 命令の実行開始をアプリケーションに伝達
                 self.send_message("motor", { "command": cmd["command"], "state": "start" })
                 
+                # 命令の実行終了時のメッセージ
+                done_msg = { "command": cmd["command"], "state": "done" }
+
                 try:
                     # 複数のコマンドを連続実行させる場合
                     if cmd["command"] == "sequential":
                         # 各コマンドを順番に実行
-                        for single_cmd in cmd["sequence"]:
-                            self.execute_command(single_cmd)
+                        self.execute_sequence(cmd["sequence"])
+                    elif cmd["command"] == "define-primitive":
+                        # 命令列を変換して登録し, IDをアプリケーションに伝達
+                        done_msg["id"] = self.define_primitive(
+                            cmd.get("name"), cmd["sequence"])
                     else:
                         # 指定されたコマンドを実行
                         self.execute_command(cmd)
 
                     # 命令の実行終了をアプリケーションに伝達
-                    self.send_message("motor", { "command": cmd["command"], "state": "done" })
+                    self.send_message("motor", done_msg)
                 except (KeyError, ValueError, UnknownCommandException) as e:
                     print("MotorNode::process_command(): exception was thrown: {0}"
                           .format(e))
@@ -85,7 +199,20 @@ class MotorNode(CommandReceiverNode):
 
                     # 命令が無視されたことをアプリケーションに伝達
                     self.send_message("motor", { "command": cmd["command"], "state": "ignored" })
+                except SafetyInterlockException as e:
+                    print("MotorNode::process_command(): {0}".format(e))
+
+                    # 命令が安全インターロックにより中断されたことをアプリケーションに伝達
+                    self.send_message("motor", { "command": cmd["command"], "state": "interrupted" })
                 
+                # 左右の車輪の移動距離を更新
+                self.state_dict["odometry"] = self.get_odometry()
+
+                # SPIのコマンドの送信回数を更新
+                self.state_dict["spi_counters"] = {
+                    "left": self.motor_left.get_transaction_counters(),
+                    "right": self.motor_right.get_transaction_counters() }
+
                 # モータへの命令が完了
                 self.command_queue.task_done()
         
@@ -96,53 +223,27 @@ class MotorNode(CommandReceiverNode):
     def execute_command(self, cmd):
         """指定されたコマンドを実行"""
         # モータへの命令を実行
-        if cmd["command"] == "set-speed":
-            # 2つのモータの速度を設定(速度は階段状に変化)
-            self.set_speed(cmd["speed_left"], cmd["speed_right"],
-                           cmd["step_left"], cmd["step_right"],
-                           cmd["wait_time"])
-        elif cmd["command"] == "set-left-speed":
-            # 左側のモータの速度を設定(速度は階段状に変化)
-            self.set_left_speed(cmd["speed"], cmd["step"], cmd["wait_time"])
-        elif cmd["command"] == "set-right-speed":
-            # 右側のモータの速度を設定(速度は階段状に変化)
-            self.set_right_speed(cmd["speed"], cmd["step"], cmd["wait_time"])
-        elif cmd["command"] == "set-speed-imm":
-            # 2つのモータの速度を設定(即変更)
-            self.set_speed_immediately(cmd["speed_left"], cmd["speed_right"])
-        elif cmd["command"] == "set-left-speed-imm":
-            # 左側のモータの速度を設定(即変更)
-            self.set_left_speed_immediately(cmd["speed"])
-        elif cmd["command"] == "set-right-speed-imm":
-            # 右側のモータの速度を設定(即変更)
-            self.set_right_speed_immediately(cmd["speed"])
-        elif cmd["command"] == "move-distance":
-            # 現在の速度を保った状態で, 指定された距離(センチメートル)を移動
-            self.move_distance(cmd["distance"])
-        elif cmd["command"] == "rotate0":
-            # ロボットの中心速度, 旋回半径, 旋回角度を指定して回転
-            self.rotate0(cmd["center_velocity"], cmd["turning_radius"], cmd["turning_angle"])
-        elif cmd["command"] == "rotate1":
-            # ロボットの中心速度, 旋回角度, 時間を指定して回転
-            self.rotate1(cmd["center_velocity"], cmd["turning_angle"], cmd["rotate_time"])
-        elif cmd["command"] == "rotate2":
-            # 現在の速度を保った状態で, ロボットの旋回角度を指定して回転
-            self.rotate2(cmd["turning_angle"])
-        elif cmd["command"] == "pivot-turn":
-            # ロボットの信地旋回を行う(左のモータを停止)
-            self.pivot_turn(cmd["turning_angle"], cmd["rotate_time"])
-        elif cmd["command"] == "spin-turn":
-            # ロボットの超信地旋回を行う(左右のモータを互いに等速逆回転)
-            self.spin_turn(cmd["turning_angle"], cmd["rotate_time"])
-        elif cmd["command"] == "wait":
-            # 指定された時間だけ待機
-            time.sleep(cmd["seconds"])
-        elif cmd["command"] == "stop":
-            # 2つのモータを停止
-            self.stop()
-        elif cmd["command"] == "end":
+        if cmd["command"] == "end":
             # 2つのモータの使用を終了
             self.end()
+        elif cmd["command"] == "reset-interlock":
+            # 安全インターロックを解除
+            if self.interlock is not None:
+                self.interlock.clear()
+        elif cmd["command"] == "resync":
+            # レジスタの値と回転のコマンドを強制的に再送信
+            self.motor_left.resync()
+            self.motor_right.resync()
+        elif cmd["command"] == "avoid-drive":
+            # 超音波センサの距離に応じて減速・旋回しながら走行
+            self.avoid_drive(cmd["center_velocity"], cmd["seconds"])
+        elif cmd["command"] == "run-primitive":
+            # 登録済みの命令列を名前またはIDを指定して実行
+            self.run_primitive(cmd["name"] if "name" in cmd else cmd["id"])
+        elif cmd["command"] in MotorNode.PLANNABLE_COMMANDS:
+            # 速度変化のステップのリストに変換して実行
+            self.execute_plan(self.plan_command(
+                cmd, self.state_dict["speed_left"], self.state_dict["speed_right"]))
         else:
             # 不明のコマンドを受信した場合は例外をスロー
             raise UnknownCommandException(
@@ -178,6 +279,28 @@ class MotorNode(CommandReceiverNode):
         return self.convert_steps_per_second_to_speed(
             revolutions_per_second * self.steps_per_revolution)
 
+    def convert_speed_to_microsteps_per_second(self, speed):
+        """モータの速度を1秒間あたりのマイクロステップ数に変換"""
+        return self.convert_speed_to_steps_per_second(speed) * self.microsteps
+
+    def convert_microsteps_to_centimeters(self, microsteps):
+        """モータのマイクロステップ数を車輪の移動距離(センチメートル)に変換"""
+        return microsteps * (self.wheel_diameter * math.pi) / \
+            self.microsteps_per_revolution
+
+    def convert_centimeters_to_microsteps(self, centimeters):
+        """車輪の移動距離(センチメートル)をモータのマイクロステップ数に変換"""
+        return int(centimeters * self.microsteps_per_revolution / \
+            (self.wheel_diameter * math.pi))
+
+    def get_odometry(self):
+        """左右の車輪の移動距離(センチメートル)をモータの位置から計算"""
+        # 右側のモータは左側のモータとは逆向きに回転させている
+        return { "left": self.convert_microsteps_to_centimeters(
+                     self.motor_left.get_position()),
+                 "right": self.convert_microsteps_to_centimeters(
+                     -1 * self.motor_right.get_position()) }
+
     def calculate_turning_angle_velocity(self, left_velocity, right_velocity):
         """左右の車輪の回転速度(センチメートル毎秒)からロボットの旋回角速度を計算"""
         return (right_velocity - left_velocity) / self.distance_between_wheels
@@ -201,8 +324,279 @@ class MotorNode(CommandReceiverNode):
         return (turning_radius + self.distance_between_wheels / 2.0) * \
             turning_angle_velocity
 
-    def set_speed(self, speed_left, speed_right, step_left, step_right, wait_time):
-        """2つのモータの速度を設定(速度は階段状に変化)"""
+    def compile_steps(self, key, steps):
+        """速度変化のステップのリストをSPIのデータ列と待ち時間に変換"""
+
+        compiled_steps = []
+
+        for speed_left, speed_right, wait_time in steps:
+            # 右側のモータは左側のモータとは逆向きに回転させる
+            payload_left = self.motor_left.make_run_payload(speed_left) \
+                if speed_left is not None else None
+            payload_right = self.motor_right.make_run_payload(-1 * speed_right) \
+                if speed_right is not None else None
+            compiled_steps.append(
+                (speed_left, speed_right, wait_time, payload_left, payload_right))
+
+        return MotionPrimitive(key, compiled_steps)
+
+    def execute_primitive(self, primitive):
+        """変換済みの命令列を実行"""
+
+        # 安全インターロックが作動している場合は前進を伴う命令列を実行しない
+        tripped_at_start = self.interlock is not None and self.interlock.is_tripped()
+
+        if tripped_at_start and self.primitive_moves_forward(primitive):
+            raise SafetyInterlockException(
+                "MotorNode::execute_primitive(): " +
+                "safety interlock is active (only backward motion is allowed)")
+
+        for speed_left, speed_right, wait_time, payload_left, payload_right \
+            in primitive.steps:
+            # 安全インターロックによる停止と競合しないように排他制御
+            with self.actuation_lock:
+                # 実行中に安全インターロックが作動した場合は命令列を中断
+                if not tripped_at_start and self.interlock is not None and \
+                    self.interlock.is_tripped():
+                    raise SafetyInterlockException(
+                        "MotorNode::execute_primitive(): " +
+                        "interrupted by safety interlock")
+
+                # モータの速度を変更
+                if speed_left is not None:
+                    self.state_dict["speed_left"] = speed_left
+                    self.motor_left.run(speed_left, payload_left)
+                if speed_right is not None:
+                    self.state_dict["speed_right"] = speed_right
+                    self.motor_right.run(-1 * speed_right, payload_right)
+                if speed_left is not None or speed_right is not None:
+                    move_time = time.monotonic()
+                    self.state_dict["last_move_time"] = move_time
+                    self.shared_state.set_speeds(speed_left, speed_right, move_time)
+
+            if wait_time > 0:
+                if tripped_at_start or self.interlock is None:
+                    time.sleep(wait_time)
+                elif self.interlock.wait(wait_time):
+                    # 安全インターロックが作動した場合は直ちに待機を終了して命令列を中断
+                    raise SafetyInterlockException(
+                        "MotorNode::execute_primitive(): " +
+                        "interrupted by safety interlock")
+
+    def primitive_moves_forward(self, primitive):
+        """変換済みの命令列がロボットを前進させるかどうかを判定"""
+        speed_left = self.state_dict["speed_left"]
+        speed_right = self.state_dict["speed_right"]
+
+        for step in primitive.steps:
+            speed_left = step[0] if step[0] is not None else speed_left
+            speed_right = step[1] if step[1] is not None else speed_right
+
+            # ロボットの中心速度が正であれば前進
+            if speed_left + speed_right > 0:
+                return True
+
+        return False
+
+    def set_interlock(self, interlock, action="stop"):
+        """超音波センサのノードと共有する安全インターロックを設定"""
+        self.interlock = interlock
+        self.interlock_action = action
+
+    def watch_interlock(self):
+        """安全インターロックの作動を監視してモータを直ちに停止(別スレッドで実行)"""
+
+        while True:
+            # 安全インターロックが作動するまで待機
+            self.interlock.wait()
+
+            with self.actuation_lock:
+                if self.interlock_action == "hardstop":
+                    # モータを直ちに停止(HardStopコマンド)
+                    self.motor_left.hardstop()
+                    self.motor_right.hardstop()
+                else:
+                    # モータを減速させて停止(速度0の回転コマンド)
+                    self.motor_left.run(0, force=True)
+                    self.motor_right.run(0, force=True)
+
+                # 作動してからモータを停止させるまでの時間
+                latency = time.monotonic() - self.interlock.trip_time.value
+
+                move_time = time.monotonic()
+                self.state_dict["speed_left"] = 0
+                self.state_dict["speed_right"] = 0
+                self.state_dict["last_move_time"] = move_time
+                self.shared_state.set_speeds(0, 0, move_time)
+
+            # 停止までの時間の統計を更新
+            self.interlock_latencies.append(latency)
+            self.state_dict["interlock"] = {
+                "trips": len(self.interlock_latencies),
+                "last_latency": latency,
+                "max_latency": max(self.interlock_latencies),
+                "mean_latency": sum(self.interlock_latencies) / len(self.interlock_latencies) }
+
+            # モータを停止させた後にアプリケーションに伝達
+            trip_info = self.interlock.get_trip_info()
+            self.send_message("motor", { "state": "interlock-stopped",
+                                         "addr": trip_info["addr"],
+                                         "distance": trip_info["distance"],
+                                         "latency": latency })
+            print("MotorNode::watch_interlock(): motors stopped by safety interlock " +
+                  "(latency: {0:.3f} ms)".format(latency * 1000.0))
+
+            # 安全インターロックが解除されるまで待機
+            while self.interlock.is_tripped():
+                time.sleep(self.control_interval)
+
+            self.send_message("motor", { "state": "interlock-released" })
+
+    def plan_command(self, cmd, speed_left_0, speed_right_0):
+        """指定されたコマンドを速度変化のステップのリストに変換"""
+
+        if cmd["command"] == "set-speed":
+            return self.plan_set_speed(
+                speed_left_0, speed_right_0,
+                cmd["speed_left"], cmd["speed_right"],
+                cmd["step_left"], cmd["step_right"], cmd["wait_time"])
+        elif cmd["command"] == "set-left-speed":
+            return self.plan_single_motor_speed(
+                "left", speed_left_0, cmd["speed"], cmd["step"], cmd["wait_time"])
+        elif cmd["command"] == "set-right-speed":
+            return self.plan_single_motor_speed(
+                "right", speed_right_0, cmd["speed"], cmd["step"], cmd["wait_time"])
+        elif cmd["command"] == "set-speed-imm":
+            return [(cmd["speed_left"], cmd["speed_right"], 0)]
+        elif cmd["command"] == "set-left-speed-imm":
+            return self.plan_single_motor_speed_immediately("left", cmd["speed"])
+        elif cmd["command"] == "set-right-speed-imm":
+            return self.plan_single_motor_speed_immediately("right", cmd["speed"])
+        elif cmd["command"] == "move-distance":
+            return self.plan_move_distance(
+                speed_left_0, speed_right_0, cmd["distance"])
+        elif cmd["command"] == "rotate0":
+            return self.plan_rotate0(
+                speed_left_0, speed_right_0, cmd["center_velocity"],
+                cmd["turning_radius"], cmd["turning_angle"])
+        elif cmd["command"] == "rotate1":
+            return self.plan_rotate1(
+                speed_left_0, speed_right_0, cmd["center_velocity"],
+                cmd["turning_angle"], cmd["rotate_time"])
+        elif cmd["command"] == "rotate2":
+            return self.plan_rotate2(
+                speed_left_0, speed_right_0, cmd["turning_angle"])
+        elif cmd["command"] == "pivot-turn":
+            return self.plan_pivot_turn(
+                speed_left_0, speed_right_0, cmd["turning_angle"], cmd["rotate_time"])
+        elif cmd["command"] == "spin-turn":
+            return self.plan_spin_turn(
+                speed_left_0, speed_right_0, cmd["turning_angle"], cmd["rotate_time"])
+        elif cmd["command"] == "wait":
+            if cmd["seconds"] < 0:
+                raise ValueError("MotorNode::plan_command(): " +
+                                 "the argument 'seconds' must be positive or zero")
+            return [(None, None, cmd["seconds"])]
+        elif cmd["command"] == "stop":
+            return [(0, 0, 0)]
+        else:
+            # 不明のコマンドを受信した場合は例外をスロー
+            raise UnknownCommandException(
+                "MotorNode::plan_command(): unknown command: {0}"
+                .format(cmd["command"]))
+
+    def compile_sequence(self, key, sequence, speed_left_0, speed_right_0):
+        """命令列を現在の速度から実行する場合のSPIのデータ列と待ち時間に変換"""
+
+        steps = []
+        speed_left, speed_right = speed_left_0, speed_right_0
+
+        # 各コマンドの実行前の速度を追跡しながら変換
+        for cmd in sequence:
+            cmd_steps = self.plan_command(cmd, speed_left, speed_right)
+
+            for step_left, step_right, _ in cmd_steps:
+                speed_left = step_left if step_left is not None else speed_left
+                speed_right = step_right if step_right is not None else speed_right
+
+            steps.extend(cmd_steps)
+
+        return self.compile_steps(key, steps)
+
+    def define_primitive(self, name, sequence):
+        """命令列を名前付きで登録"""
+
+        if any(cmd["command"] not in MotorNode.PLANNABLE_COMMANDS for cmd in sequence):
+            raise UnknownCommandException(
+                "MotorNode::define_primitive(): " +
+                "sequence contains a command that cannot be compiled: {0}"
+                .format(sequence))
+
+        primitive_id = MotionPrimitiveCache.compute_id(sequence)
+
+        # 現在の速度から実行する場合の命令列を変換してキャッシュに追加
+        # 不正な命令列の場合は例外が送出されるため登録されない
+        speed_left_0 = self.state_dict["speed_left"]
+        speed_right_0 = self.state_dict["speed_right"]
+        self.primitive_cache.put(self.compile_sequence(
+            (primitive_id, speed_left_0, speed_right_0), sequence,
+            speed_left_0, speed_right_0))
+
+        # 命令列を登録
+        self.primitive_sequences[primitive_id] = list(sequence)
+
+        if name is not None:
+            self.primitive_names[name] = primitive_id
+
+        return primitive_id
+
+    def run_primitive(self, primitive_id):
+        """登録済みの命令列を実行"""
+
+        if primitive_id in self.primitive_names:
+            primitive_id = self.primitive_names[primitive_id]
+
+        if primitive_id not in self.primitive_sequences:
+            raise KeyError("MotorNode::run_primitive(): " +
+                           "unknown primitive: {0}".format(primitive_id))
+
+        self.execute_cached_sequence(primitive_id, self.primitive_sequences[primitive_id])
+
+    def execute_cached_sequence(self, primitive_id, sequence):
+        """命令列をキャッシュを介して変換して実行"""
+
+        # 変換済みの命令列は実行開始時の速度ごとに異なる
+        speed_left_0 = self.state_dict["speed_left"]
+        speed_right_0 = self.state_dict["speed_right"]
+        key = (primitive_id, speed_left_0, speed_right_0)
+
+        # キャッシュに存在しない場合は命令列を変換
+        primitive = self.primitive_cache.get(key)
+
+        if primitive is None:
+            primitive = self.compile_sequence(
+                key, sequence, speed_left_0, speed_right_0)
+            self.primitive_cache.put(primitive)
+
+        self.execute_primitive(primitive)
+        self.state_dict["primitive_cache"] = self.primitive_cache.get_counters()
+
+    def execute_sequence(self, sequence):
+        """複数のコマンドを順番に実行"""
+
+        # 変換できないコマンドを含む場合は各コマンドを順番に実行
+        if any(cmd["command"] not in MotorNode.PLANNABLE_COMMANDS for cmd in sequence):
+            for cmd in sequence:
+                self.execute_command(cmd)
+            return
+
+        # 名前の無い命令列は登録せずに, 変換済みの命令列をキャッシュにのみ保持して実行
+        # (登録すると命令列が異なるごとに登録され続けるため, キャッシュと共に破棄されるようにする)
+        self.execute_cached_sequence(MotionPrimitiveCache.compute_id(sequence), sequence)
+
+    def plan_set_speed(self, speed_left_0, speed_right_0,
+                       speed_left, speed_right, step_left, step_right, wait_time):
+        """2つのモータの速度を階段状に変化させるステップを作成"""
         
         if step_left <= 0:
             raise ValueError("MotorNode::set_speed(): " +
@@ -214,46 +608,51 @@ class MotorNode(CommandReceiverNode):
             raise ValueError("MotorNode::set_speed(): " +
                              "the argument 'wait_time' must be positive")
 
-        left_op = 1 if speed_left > self.state_dict["speed_left"] \
-                  else -1 if speed_left < self.state_dict["speed_left"] \
+        left_op = 1 if speed_left > speed_left_0 \
+                  else -1 if speed_left < speed_left_0 \
                   else 0
-        right_op = 1 if speed_right > self.state_dict["speed_right"] \
-                   else -1 if speed_right < self.state_dict["speed_right"] \
+        right_op = 1 if speed_right > speed_right_0 \
+                   else -1 if speed_right < speed_right_0 \
                    else 0
 
+        steps = []
+        current_left, current_right = speed_left_0, speed_right_0
+
         while True:
             # モータの速度変更の終了を判定
             left_done = \
-                self.state_dict["speed_left"] >= speed_left if left_op == 1 \
-                else self.state_dict["speed_left"] <= speed_right if left_op == -1 \
+                current_left >= speed_left if left_op == 1 \
+                else current_left <= speed_left if left_op == -1 \
                 else True
             right_done = \
-                self.state_dict["speed_right"] >= speed_right if right_op == 1 \
-                else self.state_dict["speed_right"] <= speed_right if right_op == -1 \
+                current_right >= speed_right if right_op == 1 \
+                else current_right <= speed_right if right_op == -1 \
                 else True
 
             if left_done and right_done:
                 break
             
             # モータの速度を段階的に変更
+            new_left, new_right = None, None
+
             if not left_done:
-                self.state_dict["speed_left"] = \
-                    min(self.state_dict["speed_left"] + step_left, speed_left) if left_op == 1 \
-                    else max(self.state_dict["speed_left"] - step_left, speed_left) if left_op == -1 \
-                    else self.state_dict["speed_left"]
-                self.motor_left.run(self.state_dict["speed_left"])
+                current_left = \
+                    min(current_left + step_left, speed_left) if left_op == 1 \
+                    else max(current_left - step_left, speed_left)
+                new_left = current_left
 
             if not right_done:
-                self.state_dict["speed_right"] = \
-                    min(self.state_dict["speed_right"] + step_right, speed_right) if right_op == 1 \
-                    else max(self.state_dict["speed_right"] - step_right, speed_right) if right_op == -1 \
-                    else self.state_dict["speed_right"]
-                self.motor_right.run(-1 * self.state_dict["speed_right"])
+                current_right = \
+                    min(current_right + step_right, speed_right) if right_op == 1 \
+                    else max(current_right - step_right, speed_right)
+                new_right = current_right
             
-            time.sleep(wait_time)
-    
-    def set_single_motor_speed(self, which, speed, step, wait_time):
-        """片方のモータの速度を設定(速度は階段状に変化)"""
+            steps.append((new_left, new_right, wait_time))
+
+        return steps
+
+    def plan_single_motor_speed(self, which, speed_0, speed, step, wait_time):
+        """片方のモータの速度を階段状に変化させるステップを作成"""
         if not (which == "left" or which == "right"):
             raise KeyError("MotorNode::set_single_motor_speed(): " +
                            "the argument 'which' must be set to 'left' or 'right'")
@@ -264,164 +663,131 @@ class MotorNode(CommandReceiverNode):
             raise ValueError("MotorNode::set_single_motor_speed(): " +
                              "the argument 'wait_time' must be positive")
 
-        key = "speed_left" if which == "left" else "speed_right"
-        motor = self.motor_left if which == "left" else self.motor_right
-        neg = 1 if which == "left" else -1
-        op = 1 if speed > self.state_dict[key] \
-             else -1 if speed < self.state_dict[key] \
+        op = 1 if speed > speed_0 \
+             else -1 if speed < speed_0 \
              else 0
 
+        steps = []
+        current = speed_0
+
         while True:
             # モータの速度変更の終了を判定
-            is_done = self.state_dict[key] >= speed if op == 1 \
-                      else self.state_dict[key] <= speed if op == -1 \
+            is_done = current >= speed if op == 1 \
+                      else current <= speed if op == -1 \
                       else True
 
             if is_done:
                 break
 
             # モータの速度を段階的に変更
-            self.state_dict[key] = \
-                min(self.state_dict[key] + step, speed) if op == 1 \
-                else max(self.state_dict[key] - step, speed) if op == -1 \
-                else self.state_dict[key]
-            motor.run(neg * self.state_dict[key])
+            current = min(current + step, speed) if op == 1 \
+                      else max(current - step, speed)
 
-            time.sleep(wait_time)
+            if which == "left":
+                steps.append((current, None, wait_time))
+            else:
+                steps.append((None, current, wait_time))
 
-    def set_left_speed(self, speed, step, wait_time):
-        """左側のモータの速度を設定(速度は階段状に変化)"""
-        self.set_single_motor_speed("left", speed, step, wait_time)
+        return steps
 
-    def set_right_speed(self, speed, step, wait_time):
-        """右側のモータの速度を設定(速度は階段状に変化)"""
-        self.set_single_motor_speed("right", speed, step, wait_time)
-
-    def set_speed_immediately(self, speed_left, speed_right):
-        """2つのモータの速度を設定(即変更)"""
-        self.state_dict["speed_left"] = speed_left
-        self.state_dict["speed_right"] = speed_right
-
-        self.motor_left.run(self.state_dict["speed_left"])
-        self.motor_right.run(-1 * self.state_dict["speed_right"])
-    
-    def set_single_motor_speed_immediately(self, which, speed):
-        """片方のモータの速度を設定(即変更)"""
+    def plan_single_motor_speed_immediately(self, which, speed):
+        """片方のモータの速度を即変更するステップを作成"""
         if not (which == "left" or which == "right"):
             raise KeyError("MotorNode::set_single_motor_speed_immediately(): " +
                            "the argument 'which' must be set to 'left' or 'right'")
         if speed < 0:
             raise ValueError("MotorNode::set_single_motor_speed_immediately(): " +
                              "the argument 'speed' must be positive or zero")
-        
-        key = "speed_left" if which == "left" else "speed_right"
-        motor = self.motor_left if which == "left" else self.motor_right
-        neg = 1 if which == "left" else -1
 
-        self.state_dict[key] = speed
-        motor.run(neg * self.state_dict[key])
-    
-    def set_left_speed_immediately(self, speed):
-        """左側のモータの速度を設定(即変更)"""
-        self.set_single_motor_speed_immediately("left", speed)
+        return [(speed, None, 0)] if which == "left" else [(None, speed, 0)]
 
-    def set_right_speed_immediately(self, speed):
-        """右側のモータの速度を設定(即変更)"""
-        self.set_single_motor_speed_immediately("right", speed)
-    
-    def move_distance(self, distance):
-        """現在の速度を保った状態で, 指定された距離(センチメートル)を移動"""
-        if self.state_dict["speed_left"] == 0 and self.state_dict["speed_right"] == 0:
+    def plan_move_distance(self, speed_left_0, speed_right_0, distance):
+        """現在の速度を保った状態で, 指定された距離(センチメートル)を移動するステップを作成"""
+        if speed_left_0 == 0 and speed_right_0 == 0:
             raise ValueError("MotorNode::move_distance(): " +
                              "at least one motor must be rotating")
         
         # 左右のモータの速度が同符号でない場合は例外を送出
-        if (self.state_dict["speed_left"] > 0 and self.state_dict["speed_right"] < 0) or \
-            (self.state_dict["speed_left"] < 0 and self.state_dict["speed_right"] > 0):
+        if (speed_left_0 > 0 and speed_right_0 < 0) or \
+            (speed_left_0 < 0 and speed_right_0 > 0):
             raise ValueError("MotorNode::move_distance(): " +
                              "the left and right speed should have the same sign")
 
         # 左右の車輪の回転速度(センチメートル毎秒)を計算
-        left_velocity = self.convert_speed_to_centimeters_per_second(
-            self.state_dict["speed_left"])
-        right_velocity = self.convert_speed_to_centimeters_per_second(
-            self.state_dict["speed_right"])
+        left_velocity = self.convert_speed_to_centimeters_per_second(speed_left_0)
+        right_velocity = self.convert_speed_to_centimeters_per_second(speed_right_0)
         # ロボットの中心速度(センチメートル毎秒)を計算
         center_velocity = self.calculate_center_velocity(
             left_velocity, right_velocity)
         # 所要時間を計算(負の速度を考慮)
-        required_time = math.abs(distance / center_velocity)
+        required_time = abs(distance / center_velocity)
         
-        time.sleep(required_time)
+        return [(None, None, required_time)]
 
-    def rotate0(self, center_velocity, turning_radius, turning_angle):
-        """ロボットの中心速度, 旋回半径, 旋回角度を指定して回転"""
+    def plan_rotate0(self, speed_left_0, speed_right_0,
+                     center_velocity, turning_radius, turning_angle):
+        """ロボットの中心速度, 旋回半径, 旋回角度を指定して回転するステップを作成"""
         if turning_radius <= 0:
             raise ValueError("MotorNode::rotate0(): " +
                              "the argument 'turning_radius' must be positive")
 
-        # 命令の実行前の左右のモータの速度を保存
-        left_speed_0 = self.state_dict["speed_left"]
-        right_speed_0 = self.state_dict["speed_right"]
-
         # ロボットの旋回角速度(ラジアン毎秒)を計算
         turning_angle_velocity = center_velocity / turning_radius
         # 回転に必要な時間を計算
         rotate_time = math.radians(turning_angle) / turning_angle_velocity
+
+        if rotate_time < 0:
+            raise ValueError("MotorNode::rotate0(): " +
+                             "the argument 'turning_angle' and 'center_velocity' " +
+                             "should have the same sign")
+
         # 左右の車輪の回転速度(センチメートル毎秒)を計算
-        left_velocity = (turning_radius - self.distance_between_wheels / 2.0) * \
-            turning_angle_velocity
-        right_velocity = (turning_radius + self.distance_between_wheels / 2.0) * \
-            turning_angle_velocity
+        left_velocity = self.calculate_left_velocity(
+            turning_radius, turning_angle_velocity)
+        right_velocity = self.calculate_right_velocity(
+            turning_radius, turning_angle_velocity)
         # 左右のモータの速度を計算
         left_speed = self.convert_centimeters_per_second_to_speed(left_velocity)
         right_speed = self.convert_centimeters_per_second_to_speed(right_velocity)
 
-        self.set_speed_immediately(left_speed, right_speed)
-        time.sleep(rotate_time)
-
-        # 以前の速度を復元
-        self.set_speed_immediately(left_speed_0, right_speed_0)
+        # 回転した後に以前の速度を復元
+        return [(left_speed, right_speed, rotate_time),
+                (speed_left_0, speed_right_0, 0)]
     
-    def rotate1(self, center_velocity, turning_angle, rotate_time):
-        """ロボットの中心速度, 旋回角度, 時間を指定して回転"""
+    def plan_rotate1(self, speed_left_0, speed_right_0,
+                     center_velocity, turning_angle, rotate_time):
+        """ロボットの中心速度, 旋回角度, 時間を指定して回転するステップを作成"""
         if rotate_time <= 0:
             raise ValueError("MotorNode::rotate1(): " +
                              "the argument 'rotate_time' must be positive")
 
-        # 命令の実行前の左右のモータの速度を保存
-        left_speed_0 = self.state_dict["speed_left"]
-        right_speed_0 = self.state_dict["speed_right"]
-
         # ロボットの旋回角速度(ラジアン毎秒)を計算
         turning_angle_velocity = math.radians(turning_angle) / rotate_time
         # ロボットの旋回半径(センチメートル)を計算
         turning_radius = center_velocity / turning_angle_velocity
         # 左右の車輪の回転速度(センチメートル毎秒)を計算
-        left_velocity = (turning_radius - self.distance_between_wheels / 2.0) * \
-            turning_angle_velocity
-        right_velocity = (turning_radius + self.distance_between_wheels / 2.0) * \
-            turning_angle_velocity
+        left_velocity = self.calculate_left_velocity(
+            turning_radius, turning_angle_velocity)
+        right_velocity = self.calculate_right_velocity(
+            turning_radius, turning_angle_velocity)
         # 左右のモータの速度を計算
         left_speed = self.convert_centimeters_per_second_to_speed(left_velocity)
         right_speed = self.convert_centimeters_per_second_to_speed(right_velocity)
 
-        self.set_speed_immediately(left_speed, right_speed)
-        time.sleep(rotate_time)
-
-        # 以前の速度を復元
-        self.set_speed_immediately(left_speed_0, right_speed_0)
+        # 回転した後に以前の速度を復元
+        return [(left_speed, right_speed, rotate_time),
+                (speed_left_0, speed_right_0, 0)]
 
-    def rotate2(self, turning_angle):
-        """現在の速度を保った状態で, ロボットの旋回角度を指定して回転"""
+    def plan_rotate2(self, speed_left_0, speed_right_0, turning_angle):
+        """現在の速度を保った状態で, ロボットの旋回角度を指定して回転するステップを作成"""
         # 左右のモータの速度が同符号でない場合は例外を送出
-        if (self.state_dict["speed_left"] > 0 and self.state_dict["speed_right"] < 0) or \
-            (self.state_dict["speed_left"] < 0 and self.state_dict["speed_right"] > 0):
+        if (speed_left_0 > 0 and speed_right_0 < 0) or \
+            (speed_left_0 < 0 and speed_right_0 > 0):
             raise ValueError("MotorNode::rotate2(): " +
                              "the left and right speed should have the same sign")
 
         # 左右の速度が殆ど同じ場合は回転できない
-        diff = math.abs(self.state_dict["speed_left"] - self.state_dict["speed_right"]) 
+        diff = abs(speed_left_0 - speed_right_0)
 
         if diff < 500:
             raise ValueError(
@@ -431,10 +797,8 @@ class MotorNode(CommandReceiverNode):
                 .format(diff))
 
         # 左右の車輪の回転速度(センチメートル毎秒)を計算
-        left_velocity = self.convert_speed_to_centimeters_per_second(
-            self.state_dict["speed_left"])
-        right_velocity = self.convert_speed_to_centimeters_per_second(
-            self.state_dict["speed_right"])
+        left_velocity = self.convert_speed_to_centimeters_per_second(speed_left_0)
+        right_velocity = self.convert_speed_to_centimeters_per_second(speed_right_0)
         # ロボットの旋回角速度(ラジアン毎秒)を計算
         turning_angle_velocity = self.calculate_turning_angle_velocity(
             left_velocity, right_velocity)
@@ -450,51 +814,186 @@ class MotorNode(CommandReceiverNode):
                 .format(rotate_time))
         
         # 現在の速度を保った状態で回転
-        time.sleep(rotate_time)
+        return [(None, None, rotate_time)]
 
-    def pivot_turn(self, turning_angle, rotate_time):
-        """ロボットの信地旋回を行う(左のモータを停止)"""
+    def plan_pivot_turn(self, speed_left_0, speed_right_0, turning_angle, rotate_time):
+        """ロボットの信地旋回を行うステップを作成(左のモータを停止)"""
         if rotate_time <= 0:
             raise ValueError("MotorNode::pivot_turn(): " +
                              "the argument 'rotate_time' must be positive")
 
-        # 命令の実行前の左右のモータの速度を保存
-        left_speed_0 = self.state_dict["speed_left"]
-        right_speed_0 = self.state_dict["speed_right"]
-
         # 右側の車輪の回転速度(センチメートル毎秒)を計算
         right_velocity = math.radians(turning_angle) * self.distance_between_wheels / rotate_time
         # モータの速度に変換
         right_speed = self.convert_centimeters_per_second_to_speed(right_velocity)
 
-        # 右側の車輪の速度を設定(左側の車輪は停止)
-        self.set_speed_immediately(0, right_speed)
-        time.sleep(rotate_time)
-
-        # 以前の速度を復元
-        self.set_speed_immediately(left_speed_0, right_speed_0)
+        # 右側の車輪の速度を設定(左側の車輪は停止)して, 回転した後に以前の速度を復元
+        return [(0, right_speed, rotate_time),
+                (speed_left_0, speed_right_0, 0)]
 
-    def spin_turn(self, turning_angle, rotate_time):
-        """ロボットの超信地旋回を行う(左右のモータを互いに等速逆回転)"""
+    def plan_spin_turn(self, speed_left_0, speed_right_0, turning_angle, rotate_time):
+        """ロボットの超信地旋回を行うステップを作成(左右のモータを互いに等速逆回転)"""
         if rotate_time <= 0:
             raise ValueError("MotorNode::spin_turn(): " +
                              "the argument 'rotate_time' must be positive")
 
-        # 命令の実行前の左右のモータの速度を保存
-        left_speed_0 = self.state_dict["speed_left"]
-        right_speed_0 = self.state_dict["speed_right"]
-
         # 左右の車輪の回転速度(センチメートル毎秒)を計算
         velocity = math.radians(turning_angle) * (self.distance_between_wheels / 2.0) / rotate_time
         # モータの速度に変換
         speed = self.convert_centimeters_per_second_to_speed(velocity)
 
-        # 左右の車輪を互いに等速逆回転
-        self.set_speed_immediately(-speed, speed)
-        time.sleep(rotate_time)
+        # 左右の車輪を互いに等速逆回転させて, 回転した後に以前の速度を復元
+        return [(-speed, speed, rotate_time),
+                (speed_left_0, speed_right_0, 0)]
 
-        # 以前の速度を復元
-        self.set_speed_immediately(left_speed_0, right_speed_0)
+    def execute_plan(self, steps):
+        """速度変化のステップのリストを変換して実行"""
+        self.execute_primitive(self.compile_steps(None, steps))
+
+    def set_speed(self, speed_left, speed_right, step_left, step_right, wait_time):
+        """2つのモータの速度を設定(速度は階段状に変化)"""
+        self.execute_plan(self.plan_set_speed(
+            self.state_dict["speed_left"], self.state_dict["speed_right"],
+            speed_left, speed_right, step_left, step_right, wait_time))
+    
+    def set_single_motor_speed(self, which, speed, step, wait_time):
+        """片方のモータの速度を設定(速度は階段状に変化)"""
+        key = "speed_left" if which == "left" else "speed_right"
+        self.execute_plan(self.plan_single_motor_speed(
+            which, self.state_dict[key], speed, step, wait_time))
+
+    def set_left_speed(self, speed, step, wait_time):
+        """左側のモータの速度を設定(速度は階段状に変化)"""
+        self.set_single_motor_speed("left", speed, step, wait_time)
+
+    def set_right_speed(self, speed, step, wait_time):
+        """右側のモータの速度を設定(速度は階段状に変化)"""
+        self.set_single_motor_speed("right", speed, step, wait_time)
+
+    def set_speed_immediately(self, speed_left, speed_right):
+        """2つのモータの速度を設定(即変更)"""
+        self.execute_plan([(speed_left, speed_right, 0)])
+    
+    def set_single_motor_speed_immediately(self, which, speed):
+        """片方のモータの速度を設定(即変更)"""
+        self.execute_plan(self.plan_single_motor_speed_immediately(which, speed))
+    
+    def set_left_speed_immediately(self, speed):
+        """左側のモータの速度を設定(即変更)"""
+        self.set_single_motor_speed_immediately("left", speed)
+
+    def set_right_speed_immediately(self, speed):
+        """右側のモータの速度を設定(即変更)"""
+        self.set_single_motor_speed_immediately("right", speed)
+    
+    def move_distance(self, distance):
+        """現在の速度を保った状態で, 指定された距離(センチメートル)を移動"""
+        self.execute_plan(self.plan_move_distance(
+            self.state_dict["speed_left"], self.state_dict["speed_right"], distance))
+
+    def rotate0(self, center_velocity, turning_radius, turning_angle):
+        """ロボットの中心速度, 旋回半径, 旋回角度を指定して回転"""
+        self.execute_plan(self.plan_rotate0(
+            self.state_dict["speed_left"], self.state_dict["speed_right"],
+            center_velocity, turning_radius, turning_angle))
+    
+    def rotate1(self, center_velocity, turning_angle, rotate_time):
+        """ロボットの中心速度, 旋回角度, 時間を指定して回転"""
+        self.execute_plan(self.plan_rotate1(
+            self.state_dict["speed_left"], self.state_dict["speed_right"],
+            center_velocity, turning_angle, rotate_time))
+
+    def rotate2(self, turning_angle):
+        """現在の速度を保った状態で, ロボットの旋回角度を指定して回転"""
+        self.execute_plan(self.plan_rotate2(
+            self.state_dict["speed_left"], self.state_dict["speed_right"],
+            turning_angle))
+
+    def pivot_turn(self, turning_angle, rotate_time):
+        """ロボットの信地旋回を行う(左のモータを停止)"""
+        self.execute_plan(self.plan_pivot_turn(
+            self.state_dict["speed_left"], self.state_dict["speed_right"],
+            turning_angle, rotate_time))
+
+    def spin_turn(self, turning_angle, rotate_time):
+        """ロボットの超信地旋回を行う(左右のモータを互いに等速逆回転)"""
+        self.execute_plan(self.plan_spin_turn(
+            self.state_dict["speed_left"], self.state_dict["speed_right"],
+            turning_angle, rotate_time))
+
+    def set_range_state(self, range_state, sensor_bearings=None):
+        """障害物回避で参照する超音波センサのノードの状態を設定"""
+        self.range_state = range_state
+
+        if sensor_bearings is not None:
+            self.sensor_bearings = sensor_bearings
+
+    def calculate_avoidance_velocity(self, center_velocity, distances):
+        """超音波センサの距離から障害物を回避するための左右の車輪の回転速度を計算"""
+
+        # 前方の障害物までの距離(センチメートル)
+        forward_distance = None
+        # 障害物から遠ざかるための旋回角速度(ラジアン毎秒)
+        turning_angle_velocity = 0.0
+
+        for addr, dist in distances.items():
+            bearing = math.radians(self.sensor_bearings.get(addr, 0.0))
+
+            # 前方の障害物までの距離を進行方向に射影
+            if abs(math.degrees(bearing)) <= self.forward_fov:
+                projected = dist * math.cos(bearing)
+                forward_distance = projected if forward_distance is None \
+                    else min(forward_distance, projected)
+
+            # 障害物が左にあれば右に, 右にあれば左に旋回(近いほど強く旋回)
+            turning_angle_velocity -= self.steer_gain * math.sin(bearing) / max(dist, 1.0)
+
+        # 衝突までの時間に応じて前進の速度を減速
+        scale = 1.0
+
+        if forward_distance is not None and center_velocity > 0:
+            ttc = (forward_distance - self.stop_distance) / center_velocity
+            scale = (ttc - self.stop_ttc) / (self.slow_ttc - self.stop_ttc)
+            scale = max(0.0, min(1.0, scale))
+
+        velocity = center_velocity * scale
+        left_velocity = velocity - turning_angle_velocity * self.distance_between_wheels / 2.0
+        right_velocity = velocity + turning_angle_velocity * self.distance_between_wheels / 2.0
+
+        return left_velocity, right_velocity
+
+    def avoid_drive(self, center_velocity, seconds):
+        """超音波センサの距離に応じて減速・旋回しながら, 指定された時間だけ走行"""
+
+        if self.range_state is None:
+            raise ValueError("MotorNode::avoid_drive(): " +
+                             "ultrasonic sensor node (srf02) is not enabled")
+        if seconds <= 0:
+            raise ValueError("MotorNode::avoid_drive(): " +
+                             "the argument 'seconds' must be positive")
+
+        end_time = time.monotonic() + seconds
+
+        while time.monotonic() < end_time:
+            # 新たな命令が送られてきた場合は走行を打ち切って命令を実行
+            if not self.command_queue.empty():
+                return
+
+            # 各超音波センサの距離を取得(まだ計測されていないセンサは無視)
+            range_state = self.range_state.copy()
+            distances = { addr: state["dist"] for addr, state in range_state.items()
+                          if isinstance(state, dict) and "dist" in state }
+
+            # 左右のモータの速度を計算して変更
+            left_velocity, right_velocity = self.calculate_avoidance_velocity(
+                center_velocity, distances)
+            self.execute_plan([(
+                self.convert_centimeters_per_second_to_speed(left_velocity),
+                self.convert_centimeters_per_second_to_speed(right_velocity),
+                self.control_interval)])
+
+        # 走行を終了して停止
+        self.stop()
 
     def stop(self):
         """2つのモータを停止"""
@@ -0,0 +1,145 @@
+# coding: utf-8
+# motor_status_monitor.py
+
+import threading
+import time
+
+class MotorStatusMonitor(object):
+    """
+    ステッピングモータ(L6470)のSTATUSレジスタを監視するクラス
+    """
+
+    # STATUSレジスタの監視対象のフラグ
+    # (フラグ名, ビット, アクティブローであるかどうか)
+    STATUS_FLAGS = [
+        ("UVLO", 1 << 9, True),
+        ("TH_WRN", 1 << 10, True),
+        ("TH_SD", 1 << 11, True),
+        ("OCD", 1 << 12, True),
+        ("STEP_LOSS_A", 1 << 13, True),
+        ("STEP_LOSS_B", 1 << 14, True)
+    ]
+
+    # ストール(脱調)を表すフラグ
+    STALL_FLAGS = ("STEP_LOSS_A", "STEP_LOSS_B")
+
+    def __init__(self, motors, interval, event_callback,
+                 counters_callback=None, counters_interval=1.0):
+        """コンストラクタ"""
+
+        # 監視対象のモータ(名前とMotorL6470のインスタンスのディクショナリ)
+        self.motors = motors
+        # 全てのモータのSTATUSレジスタを1回ずつ読み出す間隔(秒)
+        self.interval = interval
+        # ストールや異常を検出したときに呼び出される関数
+        self.event_callback = event_callback
+        # カウンタのスナップショットを定期的に渡す関数
+        self.counters_callback = counters_callback
+        # カウンタのスナップショットを渡す間隔(秒)
+        self.counters_interval = counters_interval
+
+        # 監視を行うスレッド
+        self.thread = None
+        # 監視を終了させるためのイベント
+        self.stop_event = threading.Event()
+        # カウンタを排他制御するためのロック
+        self.counters_lock = threading.Lock()
+
+        # 前回の読み出しで立っていたフラグ
+        self.prev_flags = { name: set() for name in self.motors }
+        # 各モータのカウンタ
+        self.counters = { name: self.create_counters() for name in self.motors }
+
+    def create_counters(self):
+        """カウンタを初期化"""
+        counters = { "polls": 0, "skipped": 0, "last_status": None }
+        counters.update({ flag_name: 0 for flag_name, _, _ in self.STATUS_FLAGS })
+        return counters
+
+    def start(self):
+        """監視を開始(モータを操作するプロセス内で呼び出す)"""
+
+        # スレッドはforkによって子プロセスに引き継がれないため,
+        # ノードのプロセスを開始した後にスレッドを作成する
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """監視を終了"""
+        self.stop_event.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """STATUSレジスタを定期的に読み出し"""
+
+        # コマンドの送信と交互に実行されるように, 1つのモータを読み出すごとに待機
+        wait_time = self.interval / max(len(self.motors), 1)
+        # 最後にカウンタのスナップショットを渡した時刻
+        last_counters_time = time.monotonic()
+
+        while not self.stop_event.is_set():
+            for name, motor in self.motors.items():
+                self.poll(name, motor)
+
+                if self.stop_event.wait(wait_time):
+                    break
+
+            if self.counters_callback is not None and \
+                time.monotonic() - last_counters_time >= self.counters_interval:
+                self.counters_callback(self.get_counters())
+                last_counters_time = time.monotonic()
+
+    def poll(self, name, motor):
+        """指定されたモータのSTATUSレジスタを読み出してフラグを確認"""
+
+        # コマンドの送信中であればブロックせずに今回の読み出しを諦める
+        if not motor.lock.acquire(blocking=False):
+            with self.counters_lock:
+                self.counters[name]["skipped"] += 1
+            return
+
+        try:
+            status = motor.get_status()
+        finally:
+            motor.lock.release()
+
+        # 立っているフラグを取得(アクティブローのフラグは反転)
+        flags = set(flag_name for flag_name, bit, active_low in self.STATUS_FLAGS
+                    if bool(status & bit) != active_low)
+        # 今回新たに立ったフラグ
+        new_flags = flags - self.prev_flags[name]
+        self.prev_flags[name] = flags
+
+        with self.counters_lock:
+            counters = self.counters[name]
+            counters["polls"] += 1
+            counters["last_status"] = status
+
+            for flag_name in new_flags:
+                counters[flag_name] += 1
+
+        if not new_flags:
+            return
+
+        # ストールと異常とを分けて通知
+        stall_flags = sorted(new_flags & set(self.STALL_FLAGS))
+        fault_flags = sorted(new_flags - set(self.STALL_FLAGS))
+
+        if stall_flags:
+            self.event_callback({ "state": "stall", "motor": name,
+                                  "flags": stall_flags, "status": status,
+                                  "time": time.monotonic() })
+        if fault_flags:
+            self.event_callback({ "state": "fault", "motor": name,
+                                  "flags": fault_flags, "status": status,
+                                  "time": time.monotonic() })
+
+    def get_counters(self):
+        """カウンタのスナップショットを取得"""
+        with self.counters_lock:
+            return { name: dict(counters) for name, counters in self.counters.items() }
@@ -8,20 +8,27 @@ import wiringpi as wp
 
 from data_sender_node import DataSenderNode
 from command_receiver_node import CommandReceiverNode, UnknownCommandException
+from i2c_bus import I2cBus
 from motor_l6470 import MotorL6470
 from motor_node import MotorNode
+from safety_interlock import SafetyInterlock
 from servo_gws_s03t import ServoGwsS03t
+from servo_pca9685 import Pca9685, SimulatedPca9685, ServoPca9685
 from servo_motor_node import ServoMotorNode
 from srf02 import Srf02
 from srf02_node import Srf02Node
 from julius_node import JuliusNode
 from openjtalk_node import OpenJTalkNode
 from google_speech_api_node import GoogleSpeechApiNode
+from camera_node import CameraNode
+from face_detector import create_face_detector
 from webcam_node import WebCamNode
 from card_detection_node import CardDetectionNode
 from fashion_check_node import FashionCheckNode
 from motion_detection_node import MotionDetectionNode
 from facial_expression_node import FacialExpressionNode
+from occupancy_grid import OccupancyGrid
+from mapping_node import MappingNode
 
 class NodeManager(object):
     """
@@ -51,6 +58,8 @@ class NodeManager(object):
         self.__gpio_initialized = False
         # SPIが初期化されたかどうか
         self.__spi_initialized = [False for i in range(self.__spi_channels_num)]
+        # 各ノードで共有されるI2Cデータバス
+        self.__i2c_bus = None
 
         # モータのノードを初期化
         if "enable_motor" in self.__config_dict and \
@@ -82,6 +91,14 @@ class NodeManager(object):
             self.__config_dict["enable_speechapi"]:
             self.__setup_speechapi_node(config_dict["speechapi"])
 
+        # カメラの画像を共有するノードを初期化
+        # 画像を使用する各ノードより先に初期化する必要がある
+        self.__camera_node = None
+
+        if "enable_camera" in self.__config_dict and \
+            self.__config_dict["enable_camera"]:
+            self.__setup_camera_node(config_dict["camera"])
+
         # ウェブカメラのノードを初期化
         if "enable_webcam" in self.__config_dict and \
             self.__config_dict["enable_webcam"]:
@@ -107,6 +124,14 @@ class NodeManager(object):
             self.__config_dict["enable_fashion"]:
             self.__setup_fashion_check_node(config_dict["fashion"])
 
+        # 占有格子地図を作成するノードを初期化
+        if "enable_mapping" in self.__config_dict and \
+            self.__config_dict["enable_mapping"]:
+            self.__setup_mapping_node(config_dict["mapping"])
+
+        # ノード間で状態を共有
+        self.__connect_nodes()
+
     def __setup_gpio(self):
         """GPIOの初期化"""
         
@@ -143,13 +168,23 @@ class NodeManager(object):
         self.__setup_spi(spi_channel=0, speed=MotorL6470.L6470_SPI_SPEED)
         self.__setup_spi(spi_channel=1, speed=MotorL6470.L6470_SPI_SPEED)
 
+        # 1ステップあたりのマイクロステップ数(既定値は電源投入時と同じ128)
+        microsteps = config_dict.get("step_mode", 128)
+        # フルステップ駆動に切り替わる速度(FS_SPDレジスタの値)
+        full_step_speed = config_dict.get("full_step_speed", None)
+
         # 左右のモータを初期化
-        self.__motor_left = MotorL6470(spi_channel=0)
-        self.__motor_right = MotorL6470(spi_channel=1)
+        self.__motor_left = MotorL6470(
+            spi_channel=0, microsteps=microsteps, full_step_speed=full_step_speed)
+        self.__motor_right = MotorL6470(
+            spi_channel=1, microsteps=microsteps, full_step_speed=full_step_speed)
         # モータのノードを作成
         self.__motor_node = MotorNode(
             self.__process_manager, self.__msg_queue,
-            self.__motor_left, self.__motor_right)
+            self.__motor_left, self.__motor_right,
+            config_dict.get("status_monitor_interval", 0.1),
+            config_dict.get("primitive_cache_size", 32),
+            config_dict.get("avoidance", None))
 
         # モータのノードを追加
         self.__add_command_receiver_node("motor", self.__motor_node)
@@ -157,36 +192,102 @@ class NodeManager(object):
     def __setup_servo_motor_node(self, config_dict):
         """サーボモータのノードを初期化"""
 
-        # GPIOを初期化
-        self.__setup_gpio()
+        # サーボモータを駆動する方法
+        # gpio: GPIOのハードウェアPWMで1つのサーボモータを駆動
+        # pca9685: I2C接続のPWMコントローラ(PCA9685)で複数のサーボモータを駆動
+        # simulated: PCA9685を模倣(ハードウェアを使用しない)
+        backend = config_dict.get("backend", "gpio")
+
+        # 複数のチャネルをまとめて書き込むPWMコントローラ
+        self.__servo_controller = None
+        # 名前を付けたサーボモータ
+        self.__servo_motors = None
+        # 名前を指定しない命令で用いるサーボモータの名前
+        default_servo = config_dict.get("default_servo", "default")
+
+        if backend == "gpio":
+            # GPIOを初期化
+            self.__setup_gpio()
+
+            # サーボモータが使用するGPIOの端子
+            self.__servo_motor_gpio_pin = 18
+            # サーボモータを初期化
+            # 48を指定したときに0度, 144を指定したときに180度となることを確認済み
+            self.__servo_motor = ServoGwsS03t(
+                self.__servo_motor_gpio_pin, min_value=48, max_value=144,
+                min_angle=0, max_angle=180, frequency=50)
+        elif backend in ("pca9685", "simulated"):
+            # PWMコントローラを初期化
+            if backend == "pca9685":
+                self.__servo_controller = Pca9685(
+                    self.__setup_i2c_bus(), config_dict.get("i2c_addr", 0x40),
+                    config_dict.get("pwm_frequency", 50))
+            else:
+                self.__servo_controller = SimulatedPca9685(
+                    config_dict.get("i2c_addr", 0x40),
+                    config_dict.get("pwm_frequency", 50))
+
+            # 各チャネルに接続されたサーボモータを初期化
+            servos_config = config_dict.get("servos", { default_servo: { "channel": 0 } })
+            self.__servo_motors = {
+                name: ServoPca9685(
+                    self.__servo_controller, servo_config["channel"],
+                    servo_config.get("min_value", 102), servo_config.get("max_value", 512),
+                    servo_config.get("min_angle", 0), servo_config.get("max_angle", 180))
+                for name, servo_config in servos_config.items() }
+
+            if default_servo not in self.__servo_motors:
+                default_servo = sorted(self.__servo_motors)[0]
+
+            self.__servo_motor = self.__servo_motors[default_servo]
+        else:
+            raise ValueError("NodeManager::__setup_servo_motor_node(): " +
+                             "unknown servo backend: {0}".format(backend))
 
-        # サーボモータが使用するGPIOの端子
-        self.__servo_motor_gpio_pin = 18
-        # サーボモータを初期化
-        # 48を指定したときに0度, 144を指定したときに180度となることを確認済み
-        self.__servo_motor = ServoGwsS03t(
-            self.__servo_motor_gpio_pin, min_value=48, max_value=144,
-            min_angle=0, max_angle=180, frequency=50)
         # サーボモータのノードを作成
         self.__servo_motor_node = ServoMotorNode(
             self.__process_manager, self.__msg_queue,
-            self.__servo_motor)
+            self.__servo_motor,
+            config_dict.get("trajectory_interval", 0.02),
+            config_dict.get("max_velocity", 180.0),
+            config_dict.get("max_acceleration", 720.0),
+            self.__servo_motors, default_servo, self.__servo_controller)
 
         # サーボモータのノードを追加
         self.__add_command_receiver_node("servo", self.__servo_motor_node)
 
+    def __setup_i2c_bus(self):
+        """I2Cデータバスの初期化"""
+
+        # I2Cデータバスは全てのノードで共有するため1度だけ初期化
+        if self.__i2c_bus is None:
+            self.__i2c_bus = I2cBus(self.__config_dict.get("i2c_bus", 1))
+
+        return self.__i2c_bus
+
     def __setup_srf02_node(self, config_dict):
         """超音波センサのノードを初期化"""
 
         # 超音波センサを初期化
-        self.__srf02 = Srf02()
+        self.__srf02 = Srf02(
+            config_dict.get("ranging_mode", "fixed"),
+            config_dict.get("poll_interval", 0.002),
+            config_dict.get("poll_max_interval", 0.01),
+            config_dict.get("poll_timeout", 0.1),
+            self.__setup_i2c_bus())
         # 超音波センサのノードを作成
         self.__srf02_node = Srf02Node(
             self.__process_manager, self.__msg_queue, self.__srf02,
             config_dict["distance_threshold"],
             config_dict["near_obstacle_threshold"],
             config_dict["interval"],
-            config_dict["addr_list"])
+            config_dict["addr_list"],
+            config_dict.get("ranging_groups", None),
+            config_dict.get("history_size", 32))
+
+        # 衝突までの時間の推定に用いるパラメータを設定
+        if config_dict.get("ttc") is not None:
+            self.__srf02_node.set_ttc_config(config_dict["ttc"])
 
         # 超音波センサのノードを追加
         self.__add_data_sender_node("srf02", self.__srf02_node)
@@ -220,19 +321,66 @@ class NodeManager(object):
         # Google Cloud Speech APIのノードを追加
         self.__add_data_sender_node("speechapi", self.__google_speech_api_node)
 
+    def __setup_camera_node(self, config_dict):
+        """カメラの画像を共有するノードを初期化"""
+
+        # カメラの画像を共有するノードを作成
+        self.__camera_node = CameraNode(
+            self.__process_manager, self.__msg_queue,
+            config_dict["camera_id"],
+            config_dict["frame_width"],
+            config_dict["frame_height"],
+            config_dict.get("slots", 4),
+            config_dict.get("fourcc", None),
+            config_dict.get("capture_fps", None),
+            config_dict.get("exposure", None),
+            config_dict.get("raw_mjpeg", False),
+            config_dict.get("preview_scale", None))
+
+        # カメラの画像を共有するノードを追加
+        self.__add_data_sender_node("camera", self.__camera_node)
+
+    def __get_capture_config(self, config_dict):
+        """画像を使用するノードのビデオ撮影デバイス, 解像度, 撮影の設定を取得"""
+
+        # 読み出す画像の形式(color: 元の解像度のカラー画像, gray: 縮小したグレースケール画像)
+        stream = config_dict.get("stream", "color")
+
+        # カメラのノードが無い場合は各ノードがビデオ撮影デバイスを作成
+        if self.__camera_node is None:
+            capture_config = { key: config_dict[key] for key in
+                               ("fourcc", "capture_fps", "exposure", "raw_mjpeg", "preview_scale")
+                               if key in config_dict }
+            capture_config["stream"] = stream
+            return None, config_dict["frame_width"], config_dict["frame_height"], \
+                capture_config
+
+        # カメラのノードが有効な場合は共有メモリから画像を読み出す
+        # 解像度はカメラのノードの設定に従う
+        frame_width, frame_height = self.__camera_node.get_stream_size(stream)
+        return self.__camera_node.create_reader(stream=stream), \
+            frame_width, frame_height, None
+
     def __setup_webcam_node(self, config_dict):
         """ウェブカメラを操作するノードを初期化"""
         
-        # カスケード分類器の初期化
-        WebCamNode.setup_cascade_classifier()
+        # 顔検出器の初期化
+        # モデルのファイルが無い場合などはHaar-like特徴のカスケード分類器を使用
+        face_detector = create_face_detector(config_dict.get("detector", {}), "haar")
+
+        # ビデオ撮影デバイスと解像度を取得
+        video_capture, frame_width, frame_height, capture_config = \
+            self.__get_capture_config(config_dict)
 
         # ウェブカメラのノードを作成
         self.__webcam_node = WebCamNode(
             self.__process_manager, self.__msg_queue,
             config_dict["camera_id"],
             config_dict["interval"],
-            config_dict["frame_width"],
-            config_dict["frame_height"])
+            frame_width, frame_height, video_capture,
+            config_dict.get("track_interval", None),
+            config_dict.get("roi_margin", 0.5),
+            face_detector, capture_config)
         
         # ウェブカメラのノードを追加
         self.__add_data_sender_node("webcam", self.__webcam_node)
@@ -240,13 +388,16 @@ class NodeManager(object):
     def __setup_card_detection_node(self, config_dict):
         """トランプのカードを検出するノードを初期化"""
 
+        # ビデオ撮影デバイスと解像度を取得
+        video_capture, frame_width, frame_height, capture_config = \
+            self.__get_capture_config(config_dict)
+
         # カードを検出するノードを作成
         self.__card_detection_node = CardDetectionNode(
             self.__process_manager, self.__msg_queue,
             config_dict["server_host"],
             config_dict["camera_id"],
-            config_dict["frame_width"],
-            config_dict["frame_height"])
+            frame_width, frame_height, video_capture, capture_config)
 
         # カードを検出するノードを追加
         self.__add_command_receiver_node("card", self.__card_detection_node)
@@ -254,13 +405,16 @@ class NodeManager(object):
     def __setup_fashion_check_node(self, config_dict):
         """服装がおしゃれかどうかを判定するノードを追加"""
 
+        # ビデオ撮影デバイスと解像度を取得
+        video_capture, frame_width, frame_height, capture_config = \
+            self.__get_capture_config(config_dict)
+
         # 服装がおしゃれかどうかを判定するノードを作成
         self.__fashion_check_node = FashionCheckNode(
             self.__process_manager, self.__msg_queue,
             config_dict["server_host"],
             config_dict["camera_id"],
-            config_dict["frame_width"],
-            config_dict["frame_height"])
+            frame_width, frame_height, video_capture, capture_config)
 
         # 服装がおしゃれかどうかを判定するノードを追加
         self.__add_command_receiver_node("fashion", self.__fashion_check_node)
@@ -268,12 +422,26 @@ class NodeManager(object):
     def __setup_motion_detection_node(self, config_dict):
         """人の動きを検出するノードを初期化"""
 
+        # ビデオ撮影デバイスと解像度を取得
+        video_capture, frame_width, frame_height, capture_config = \
+            self.__get_capture_config(config_dict)
+
         # 人の動きを検出するノードを作成
         self.__motion_detection_node = MotionDetectionNode(
             self.__process_manager, self.__msg_queue,
             config_dict["camera_id"], config_dict["interval"],
-            config_dict["frame_width"], config_dict["frame_height"],
-            config_dict["contour_area_min"])
+            frame_width, frame_height,
+            config_dict["contour_area_min"], video_capture,
+            config_dict.get("background_model", "first-frame"),
+            config_dict.get("learning_rate", 0.05),
+            config_dict.get("scale", 0.5),
+            config_dict.get("roi", None),
+            config_dict.get("threshold", 40),
+            config_dict.get("blur_size", 15),
+            config_dict.get("output_mode", "contour"),
+            config_dict.get("grid_size", (6, 8)),
+            config_dict.get("fps", None),
+            capture_config)
 
         # 人の動きを検出するノードを追加
         self.__add_command_receiver_node("motion", self.__motion_detection_node)
@@ -289,6 +457,93 @@ class NodeManager(object):
         # 顔の表情を表示するノードを追加
         self.__add_command_receiver_node("face", self.__facial_expression_node)
 
+    def __setup_mapping_node(self, config_dict):
+        """占有格子地図を作成するノードを初期化"""
+
+        # 地図はモータのノードと超音波センサのノードの状態から作成
+        if self.get_node("motor") is None or self.get_node("srf02") is None:
+            raise Exception("NodeManager::__setup_mapping_node(): " +
+                            "You must enable motor and srf02 to enable mapping")
+
+        # 占有格子地図を作成
+        self.__occupancy_grid = OccupancyGrid(
+            config_dict.get("width", 200), config_dict.get("height", 200),
+            config_dict.get("resolution", 5.0))
+        # 占有格子地図を作成するノードを作成
+        self.__mapping_node = MappingNode(
+            self.__process_manager, self.__msg_queue, self.__occupancy_grid,
+            config_dict.get("interval", 0.1),
+            config_dict.get("max_range", 150.0),
+            config_dict.get("beam_width", 30.0),
+            config_dict.get("beam_rays", 5),
+            config_dict.get("servo_addr", None),
+            config_dict.get("servo_center", 90.0))
+
+        # 占有格子地図を作成するノードを追加
+        self.__add_data_sender_node("mapping", self.__mapping_node)
+
+    def __connect_nodes(self):
+        """ノード間で状態を共有するための設定"""
+
+        motor_node = self.get_node("motor")
+        servo_motor_node = self.get_node("servo")
+        srf02_node = self.get_node("srf02")
+        mapping_node = self.get_node("mapping")
+        motion_detection_node = self.get_node("motion")
+
+        # 人の動きを検出するノードからサーボモータとモータの状態を参照
+        # (ロボット自身の動きによる誤検出の抑制で使用)
+        if motion_detection_node is not None:
+            motion_detection_node.set_actuator_states(
+                servo_motor_node.state_dict if servo_motor_node is not None else None,
+                motor_node.shared_state if motor_node is not None else None,
+                self.__config_dict["motion"].get("settle_time", 0.8))
+
+        # 占有格子地図を作成するノードから各ノードの状態を参照
+        if mapping_node is not None:
+            mapping_node.set_sources(
+                motor_node.shared_state,
+                motor_node.convert_speed_to_centimeters_per_second,
+                motor_node.distance_between_wheels,
+                srf02_node.history, motor_node.sensor_bearings,
+                servo_motor_node.state_dict if servo_motor_node is not None else None)
+
+        # サーボモータのノードから超音波センサを操作(走査で使用)
+        if servo_motor_node is not None and srf02_node is not None:
+            servo_motor_node.set_ranger(
+                srf02_node.srf02, srf02_node.ranging_lock,
+                self.__config_dict["servo"].get("scan_addr", srf02_node.addr_list[0]),
+                motor_node.shared_state if motor_node is not None else None)
+
+        # モータのノードから超音波センサの距離を参照(障害物回避で使用)
+        if motor_node is not None and srf02_node is not None:
+            motor_node.set_range_state(srf02_node.state_dict)
+
+            # 超音波センサのノードからモータの速度を参照
+            # (計測の間隔の調整と衝突までの時間の推定で使用)
+            srf02_config = self.__config_dict["srf02"]
+            srf02_node.set_motor_state(
+                motor_node.shared_state,
+                motor_node.convert_speed_to_centimeters_per_second,
+                motor_node.sensor_bearings)
+
+            if srf02_config.get("max_travel_distance") is not None:
+                srf02_node.set_adaptive_interval(
+                    srf02_config["max_travel_distance"],
+                    srf02_config.get("min_interval", 0.1),
+                    srf02_config.get("idle_interval", 1.0))
+
+            # 超音波センサのノードとモータのノードとで安全インターロックを共有
+            if srf02_config.get("interlock_distance") is not None:
+                self.__safety_interlock = SafetyInterlock()
+                srf02_node.set_interlock(
+                    self.__safety_interlock,
+                    srf02_config["interlock_distance"],
+                    srf02_config.get("interlock_release_distance"))
+                motor_node.set_interlock(
+                    self.__safety_interlock,
+                    srf02_config.get("interlock_action", "stop"))
+
     def __add_data_sender_node(self, name, node):
         """指定された名前を持つノードを追加"""
         self.__data_sender_nodes[name] = node
@@ -0,0 +1,131 @@
+# coding: utf-8
+# occupancy_grid.py
+
+import multiprocessing as mp
+import numpy as np
+
+class OccupancyGrid(object):
+    """
+    共有メモリ上に対数オッズで表現された占有格子地図を保持するクラス
+    """
+
+    def __init__(self, width=200, height=200, resolution=5.0,
+                 l_occupied=0.85, l_free=-0.4, l_min=-4.0, l_max=4.0):
+        """コンストラクタ"""
+
+        # 地図の横方向と縦方向のセルの個数
+        self.width = width
+        self.height = height
+        # 1つのセルの大きさ(センチメートル)
+        self.resolution = resolution
+        # 地図の中心を原点(ロボットの初期位置)とする
+        self.origin_x = -width * resolution / 2.0
+        self.origin_y = -height * resolution / 2.0
+
+        # 障害物が観測されたセルと, 障害物が無いと観測されたセルに加える対数オッズ
+        self.l_occupied = l_occupied
+        self.l_free = l_free
+        # 対数オッズの範囲(確信度が高くなり過ぎて変化に追従できなくなるのを防ぐ)
+        self.l_min = l_min
+        self.l_max = l_max
+
+        # 各セルの対数オッズ(0は占有されている確率が0.5であることを表す)
+        # forkによって各ノードのプロセスに引き継がれるため,
+        # ノードの実行を開始する前に作成しておく必要がある
+        self.buffer = mp.RawArray("f", width * height)
+        # 共有メモリをコピーせずに参照する配列(行がy, 列がxに対応)
+        self.grid = np.frombuffer(self.buffer, dtype=np.float32).reshape((height, width))
+        # 地図が更新された回数
+        self.update_count = mp.RawValue("L", 0)
+
+    def world_to_cell(self, x, y):
+        """座標(センチメートル)をセルの番号に変換"""
+        col = np.floor((np.asarray(x) - self.origin_x) / self.resolution).astype(np.int64)
+        row = np.floor((np.asarray(y) - self.origin_y) / self.resolution).astype(np.int64)
+        return col, row
+
+    def cell_to_world(self, col, row):
+        """セルの番号をセルの中心の座標(センチメートル)に変換"""
+        x = self.origin_x + (np.asarray(col) + 0.5) * self.resolution
+        y = self.origin_y + (np.asarray(row) + 0.5) * self.resolution
+        return x, y
+
+    def update_rays(self, x, y, angles, ranges, max_range):
+        """複数の計測値による光線の通過したセルと到達したセルを一度に更新"""
+
+        x = np.broadcast_to(np.asarray(x, dtype=np.float64), np.shape(ranges))
+        y = np.broadcast_to(np.asarray(y, dtype=np.float64), np.shape(ranges))
+        angles = np.asarray(angles, dtype=np.float64)
+        ranges = np.asarray(ranges, dtype=np.float64)
+
+        valid = np.isfinite(ranges) & (ranges > 0.0)
+        if not np.any(valid):
+            return
+
+        x, y, angles, ranges = x[valid], y[valid], angles[valid], ranges[valid]
+        # 最大の距離以上の計測値は障害物が無いことのみを表す
+        hit = ranges < max_range
+        ranges = np.minimum(ranges, max_range)
+
+        # 各光線上にセルの半分の間隔で点を取り, 障害物の手前の点を通過したセルとする
+        step = self.resolution / 2.0
+        t = np.arange(0.0, ranges.max(), step)
+        free = t[np.newaxis, :] < (ranges[:, np.newaxis] - step)
+        free_x = x[:, np.newaxis] + t[np.newaxis, :] * np.cos(angles)[:, np.newaxis]
+        free_y = y[:, np.newaxis] + t[np.newaxis, :] * np.sin(angles)[:, np.newaxis]
+        ray_ids = np.broadcast_to(np.arange(len(ranges))[:, np.newaxis], free.shape)
+
+        # 同じ光線が同じセルを複数回更新しないように重複を取り除く
+        free_cells = self.to_flat_index(free_x[free], free_y[free])
+        free_keys = np.unique(ray_ids[free][free_cells >= 0] * self.grid.size +
+                              free_cells[free_cells >= 0])
+        free_cells = free_keys % self.grid.size
+
+        # 障害物に到達したセル
+        hit_cells = self.to_flat_index(x[hit] + ranges[hit] * np.cos(angles[hit]),
+                                       y[hit] + ranges[hit] * np.sin(angles[hit]))
+        hit_cells = hit_cells[hit_cells >= 0]
+
+        # 同じセルへの複数の光線による更新をまとめて加算
+        grid = self.grid.reshape(-1)
+        np.add.at(grid, free_cells, self.l_free)
+        np.add.at(grid, hit_cells, self.l_occupied)
+        np.clip(grid, self.l_min, self.l_max, out=grid)
+
+        self.update_count.value += 1
+
+    def to_flat_index(self, x, y):
+        """座標(センチメートル)を1次元のセルの番号に変換(地図の範囲外は-1)"""
+        col, row = self.world_to_cell(x, y)
+        inside = (col >= 0) & (col < self.width) & (row >= 0) & (row < self.height)
+        return np.where(inside, row * self.width + col, -1)
+
+    def get_region(self, x_min, y_min, x_max, y_max):
+        """指定された矩形の範囲(センチメートル)のセルの対数オッズを取得(コピーしない)"""
+        col_min, row_min = self.world_to_cell(min(x_min, x_max), min(y_min, y_max))
+        col_max, row_max = self.world_to_cell(max(x_min, x_max), max(y_min, y_max))
+        col_min, col_max = max(int(col_min), 0), min(int(col_max) + 1, self.width)
+        row_min, row_max = max(int(row_min), 0), min(int(row_max) + 1, self.height)
+        return self.grid[row_min:row_max, col_min:col_max]
+
+    def is_region_free(self, x_min, y_min, x_max, y_max, threshold=0.0):
+        """指定された矩形の範囲に障害物が無いと観測されているかどうか"""
+        region = self.get_region(x_min, y_min, x_max, y_max)
+        return region.size > 0 and float(region.max()) < threshold
+
+    def get_log_odds(self, x, y):
+        """指定された座標(センチメートル)のセルの対数オッズを取得"""
+        col, row = self.world_to_cell(x, y)
+
+        if not (0 <= col < self.width and 0 <= row < self.height):
+            return 0.0
+
+        return float(self.grid[row, col])
+
+    def get_probability(self):
+        """各セルが占有されている確率を取得"""
+        return 1.0 - 1.0 / (1.0 + np.exp(self.grid))
+
+    def clear(self):
+        """地図を初期化"""
+        self.grid[:] = 0.0
@@ -0,0 +1,155 @@
+# coding: utf-8
+# range_history.py
+
+import multiprocessing as mp
+import numpy as np
+
+class RangeHistory(object):
+    """
+    超音波センサの計測値の履歴を共有メモリ上のリングバッファに保持するクラス
+    """
+
+    def __init__(self, addr_list, capacity=32):
+        """コンストラクタ"""
+
+        # 書き込み中の列を除いて取得するため, 2個以上の計測値を保持する必要がある
+        if capacity < 2:
+            raise ValueError("RangeHistory::__init__(): " +
+                             "capacity must be at least 2: {0}".format(capacity))
+
+        # 超音波センサのアドレスのリスト(リングバッファの行の順番に対応)
+        self.addr_list = list(addr_list)
+        # 各アドレスに対応するリングバッファの行
+        self.addr_index = { addr: i for i, addr in enumerate(self.addr_list) }
+        # 各超音波センサについて保持する計測値の個数
+        self.capacity = capacity
+
+        # 以下はforkによって各ノードのプロセスに引き継がれるため,
+        # ノードの実行を開始する前に作成しておく必要がある
+        shape = (len(self.addr_list), self.capacity)
+        size = shape[0] * shape[1]
+
+        # 計測値(センチメートル)と計測した時刻(time.monotonic()の値)
+        # 計測に失敗した場合の計測値はNaNとなる
+        self.values_buffer = mp.RawArray("d", size)
+        self.timestamps_buffer = mp.RawArray("d", size)
+        # これまでに書き込まれた計測値の個数(次に書き込む列はcount % capacity)
+        self.count = mp.RawValue("L", 0)
+
+        # 共有メモリをコピーせずに参照する配列
+        self.values = np.frombuffer(self.values_buffer, dtype=np.float64).reshape(shape)
+        self.timestamps = np.frombuffer(self.timestamps_buffer, dtype=np.float64).reshape(shape)
+        self.values[:] = np.nan
+
+    def append(self, values, timestamps):
+        """全ての超音波センサの計測値を1列ずつ書き込み(書き込むプロセスは1つのみ)"""
+
+        column = self.count.value % self.capacity
+        self.values[:, column] = values
+        self.timestamps[:, column] = timestamps
+
+        # 計測値を書き込んでから個数を更新
+        self.count.value += 1
+
+    def get_count(self):
+        """これまでに書き込まれた計測値の個数を取得"""
+        return self.count.value
+
+    def get_window(self, window=None):
+        """直近の計測値と時刻を古い順に取得(各行がアドレスに対応する2次元配列)"""
+
+        # 次に書き込まれる列(count % capacity)は書き込みの途中である可能性があるため,
+        # 最大でcapacity - 1個の計測値を取得
+        count = self.count.value
+        window = min(window or self.capacity, count, self.capacity - 1)
+        end = count % self.capacity
+        start = end - window
+
+        if start >= 0:
+            # リングバッファの端をまたがない場合はコピーせずに参照を返す
+            return self.values[:, start:end], self.timestamps[:, start:end]
+
+        indices = np.arange(start, end) % self.capacity
+        return self.values[:, indices], self.timestamps[:, indices]
+
+    def get_latest(self):
+        """全ての超音波センサの最新の計測値を取得"""
+        values, _ = self.get_window(1)
+        return values[:, -1] if values.shape[1] > 0 else \
+            np.full(len(self.addr_list), np.nan)
+
+    def get_sensor(self, addr, window=None):
+        """指定したアドレスの超音波センサの直近の計測値と時刻を取得"""
+        values, timestamps = self.get_window(window)
+        i = self.addr_index[addr]
+        return values[i], timestamps[i]
+
+    def median(self, window=5):
+        """直近の計測値の中央値を全ての超音波センサについて計算"""
+        values, _ = self.get_window(window)
+        return self.nan_reduce(np.nanmedian, values)
+
+    def ema(self, alpha=0.25, window=None):
+        """直近の計測値の指数移動平均を全ての超音波センサについて計算"""
+
+        values, _ = self.get_window(window)
+
+        # 新しい計測値ほど大きな重みを付ける(計測に失敗した値は除く)
+        weights = (1.0 - alpha) ** np.arange(values.shape[1] - 1, -1, -1)
+        weights = np.where(np.isnan(values), 0.0, weights)
+        total = weights.sum(axis=1)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(total > 0.0,
+                            np.nansum(values * weights, axis=1) / total, np.nan)
+
+    def reject_outliers(self, window=9, threshold=3.0):
+        """中央絶対偏差を用いて外れ値をNaNに置き換えた直近の計測値を取得"""
+
+        values, timestamps = self.get_window(window)
+
+        median = self.nan_reduce(np.nanmedian, values)[:, np.newaxis]
+        deviation = np.abs(values - median)
+        # 正規分布の標準偏差に相当するように中央絶対偏差を1.4826倍
+        mad = self.nan_reduce(np.nanmedian, deviation)[:, np.newaxis] * 1.4826
+
+        with np.errstate(invalid="ignore"):
+            outliers = (deviation > threshold * mad) & (mad > 0.0)
+
+        return np.where(outliers, np.nan, values), timestamps
+
+    def filtered(self, window=9, threshold=3.0):
+        """外れ値を除いた直近の計測値の中央値を全ての超音波センサについて計算"""
+        values, _ = self.reject_outliers(window, threshold)
+        return self.nan_reduce(np.nanmedian, values)
+
+    def slope(self, window=5, min_samples=3):
+        """直近の計測値の時間変化率(センチメートル毎秒)を最小二乗法で全ての超音波センサについて計算"""
+
+        values, timestamps = self.get_window(window)
+        valid = ~np.isnan(values)
+        samples = valid.sum(axis=1)
+
+        # 計測に失敗した値を除いて時刻と計測値の平均を計算
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.where(valid, timestamps, 0.0)
+            d = np.where(valid, values, 0.0)
+            t_mean = t.sum(axis=1, keepdims=True) / samples[:, np.newaxis]
+            d_mean = d.sum(axis=1, keepdims=True) / samples[:, np.newaxis]
+            dt = np.where(valid, timestamps - t_mean, 0.0)
+            dd = np.where(valid, values - d_mean, 0.0)
+            slope = (dt * dd).sum(axis=1) / (dt * dt).sum(axis=1)
+
+        # 計測値の個数が足りない場合はNaN
+        return np.where((samples >= min_samples) & np.isfinite(slope), slope, np.nan)
+
+    def nan_reduce(self, func, values):
+        """全てNaNの行を警告を出さずにNaNとして集計"""
+
+        result = np.full(values.shape[0], np.nan)
+        valid = ~np.all(np.isnan(values), axis=1)
+
+        if values.shape[1] > 0 and np.any(valid):
+            result[valid] = func(values[valid], axis=1)
+
+        return result
@@ -0,0 +1,60 @@
+# coding: utf-8
+# safety_interlock.py
+
+import multiprocessing as mp
+import time
+
+class SafetyInterlockException(Exception):
+    """
+    安全インターロックによって命令の実行が中断されたことを表す例外クラス
+    """
+    pass
+
+class SafetyInterlock(object):
+    """
+    超音波センサのノードとモータのノードとの間で共有される安全インターロックのクラス
+    """
+
+    def __init__(self):
+        """コンストラクタ"""
+
+        # インターロックが作動しているかどうか(プロセス間で共有)
+        # forkによって各ノードのプロセスに引き継がれるため,
+        # ノードの実行を開始する前に作成しておく必要がある
+        self.tripped = mp.Event()
+        # インターロックが作動した時刻(time.monotonic()の値)
+        self.trip_time = mp.RawValue("d", 0.0)
+        # インターロックを作動させた超音波センサのアドレス
+        self.trip_addr = mp.RawValue("i", -1)
+        # インターロックを作動させたときの距離(センチメートル)
+        self.trip_distance = mp.RawValue("d", 0.0)
+
+    def trip(self, addr, distance):
+        """インターロックを作動"""
+
+        # 既に作動している場合は何もしない
+        if self.tripped.is_set():
+            return
+
+        self.trip_time.value = time.monotonic()
+        self.trip_addr.value = addr
+        self.trip_distance.value = distance
+        self.tripped.set()
+
+    def clear(self):
+        """インターロックを解除"""
+        self.tripped.clear()
+
+    def is_tripped(self):
+        """インターロックが作動しているかどうか"""
+        return self.tripped.is_set()
+
+    def wait(self, timeout=None):
+        """インターロックが作動するまで待機(作動した場合はTrueを返す)"""
+        return self.tripped.wait(timeout)
+
+    def get_trip_info(self):
+        """インターロックが作動したときの情報を取得"""
+        return { "time": self.trip_time.value,
+                 "addr": self.trip_addr.value,
+                 "distance": self.trip_distance.value }
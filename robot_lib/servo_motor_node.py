@@ -1,19 +1,63 @@
 # coding: utf-8
 # servo_motor_node.py
 
+import numpy as np
+import queue
+import time
+
 from command_receiver_node import CommandReceiverNode, UnknownCommandException
+from servo_trajectory import ServoTrajectory
 
 class ServoMotorNode(CommandReceiverNode):
     """
     サーボモータを操作するクラス
     """
 
-    def __init__(self, process_manager, msg_queue, servo_motor):
+    # "command"キーで指定する命令
+    COMMANDS = ("trajectory", "cancel-trajectory", "scan", "pose")
+
+    def __init__(self, process_manager, msg_queue, servo_motor,
+                 trajectory_interval=0.02, max_velocity=180.0, max_acceleration=720.0,
+                 servos=None, default_servo="default", controller=None):
         """コンストラクタ"""
+
+        # 名前を付けた全てのサーボモータ(名前とインスタンスのディクショナリ)
+        # 指定されない場合はservo_motorのみを"default"という名前で使用
+        self.servos = servos if servos is not None else { default_servo: servo_motor }
+        # 名前を指定しない命令, 軌道, 走査で用いるサーボモータの名前
+        self.default_servo = default_servo
+
         super().__init__(process_manager, msg_queue)
-        
+
         # サーボモータのインスタンス
         self.servo_motor = servo_motor
+        # 複数のチャネルをまとめて書き込むPWMコントローラ(PCA9685)
+        # Noneの場合は各サーボモータの角度を順に設定
+        self.controller = controller
+
+        # 軌道に沿って角度を更新する間隔(秒)
+        self.trajectory_interval = trajectory_interval
+        # 軌道の命令で指定されなかった場合の最大の角速度(度毎秒)と角加速度(度毎秒毎秒)
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        # 実行中の軌道とその命令
+        self.trajectory = None
+        self.trajectory_cmd = None
+        # 実行中の軌道の開始時刻と, 次に角度を更新する時刻
+        self.trajectory_start_time = 0.0
+        self.next_tick_time = 0.0
+
+        # サーボモータに取り付けられた超音波センサ(Srf02)
+        # NodeManager::connect_nodes()により設定される
+        self.srf02 = None
+        # 超音波センサのノードと超音波センサを排他的に使用するためのロック
+        self.ranging_lock = None
+        # 走査に用いる超音波センサのアドレスの既定値
+        self.scan_addr = None
+        # モータのノードと共有する左右のモータの速度(SharedMotorState)
+        # 走査中は超音波センサのノードの計測(安全インターロックを含む)が止まるため,
+        # ロボットが走行している間は走査しない
+        self.motor_state = None
 
     def initialize_state_dict(self):
         """ノードの状態を格納するディクショナリを初期化"""
@@ -21,42 +65,328 @@ class ServoMotorNode(CommandReceiverNode):
 
         # サーボモータの角度をディクショナリに格納
         self.state_dict["angle"] = 0
+        # 名前を付けた各サーボモータの角度
+        self.state_dict["angles"] = { name: 0 for name in self.servos }
+        # 軌道に沿って回転しているかどうか
+        self.state_dict["moving"] = False
+        # 最後にサーボモータの角度を変更した時刻(time.monotonic()の値)
+        # 軌道の実行中は角度を更新するたびに, 軌道の終了時にも更新される
+        self.state_dict["last_move_time"] = None
+        # 最後に行った走査の結果
+        self.state_dict["scan"] = None
+
+    def set_ranger(self, srf02, ranging_lock, addr, motor_state=None):
+        """走査に用いる超音波センサと, 走行中かどうかの判定に用いるモータの速度を設定"""
+        self.srf02 = srf02
+        self.ranging_lock = ranging_lock
+        self.scan_addr = addr
+        self.motor_state = motor_state
+
+    def is_robot_moving(self):
+        """モータが回転しているかどうか"""
+        return self.motor_state is not None and self.motor_state.is_moving()
 
     def process_command(self):
         """サーボモータへの命令を処理"""
-        
+
         try:
             while True:
-                # サーボモータへの命令をキューから取り出し
-                cmd = self.command_queue.get()
-                print("ServoMotorNode::process_command(): command received: {0}"
-                      .format(cmd))
-                
-                # 適切な命令でない場合は例外をスロー
-                if "angle" not in cmd and "value" not in cmd:
-                    raise UnknownCommandException(
-                        "ServoMotorNode::process_command(): unknown command: {0}"
-                        .format(cmd))
-
-                # 命令の実行開始をアプリケーションに伝達
-                self.send_message("servo", { "command": cmd, "state": "start" })
-
-                if "angle" in cmd:
-                    # サーボモータの角度を指定
-                    self.servo_motor.set_angle(cmd["angle"])
-                    # 最後に指定した角度を更新
-                    self.state_dict["angle"] = cmd["angle"]
-                elif "value" in cmd:
-                    # サーボモータのGPIO端子に値を書き込み
-                    self.servo_motor.write(cmd["value"])
-                
-                # 命令の実行終了をアプリケーションに伝達
-                self.send_message("servo", { "command": cmd, "state": "done" })
-
-                # サーボモータへの命令が完了
-                self.command_queue.task_done()
+                # 軌道の実行中は次に角度を更新する時刻まで命令を待機
+                if self.trajectory is None:
+                    timeout = None
+                else:
+                    timeout = max(self.next_tick_time - time.monotonic(), 0.0)
+
+                try:
+                    # サーボモータへの命令をキューから取り出し
+                    cmd = self.command_queue.get(timeout=timeout)
+                except queue.Empty:
+                    cmd = None
+
+                if cmd is not None:
+                    print("ServoMotorNode::process_command(): command received: {0}"
+                          .format(cmd))
+
+                    try:
+                        self.execute_command(cmd)
+                    except (KeyError, ValueError, UnknownCommandException) as e:
+                        print("ServoMotorNode::process_command(): exception was thrown: {0}"
+                              .format(e))
+                        print("ServoMotorNode::process_command(): operation was ignored")
+
+                        # 命令が無視されたことをアプリケーションに伝達
+                        self.send_message("servo", { "command": cmd, "state": "ignored" })
+
+                    # サーボモータへの命令が完了
+                    self.command_queue.task_done()
+
+                # 実行中の軌道に沿って角度を更新
+                self.update_trajectory()
 
         except KeyboardInterrupt:
             # プロセスが割り込まれた場合
             print("ServoMotorNode::process_command(): KeyboardInterrupt occurred")
 
+    def execute_command(self, cmd):
+        """サーボモータへの命令を実行"""
+
+        # 適切な命令でない場合は例外をスロー
+        if "angle" not in cmd and "value" not in cmd and \
+            cmd.get("command") not in ServoMotorNode.COMMANDS:
+            raise UnknownCommandException(
+                "ServoMotorNode::execute_command(): unknown command: {0}"
+                .format(cmd))
+
+        # 超音波センサが無い場合やロボットが走行している場合は走査しない
+        if cmd.get("command") == "scan":
+            if self.srf02 is None:
+                print("ServoMotorNode::execute_command(): " +
+                      "ultrasonic sensor node (srf02) is not enabled")
+                self.send_message("servo", { "command": cmd, "state": "ignored" })
+                return
+            if self.is_robot_moving():
+                print("ServoMotorNode::execute_command(): " +
+                      "scan is not allowed while the robot is moving")
+                self.send_message("servo", { "command": cmd, "state": "ignored" })
+                return
+
+        # 名前が指定された場合は存在するサーボモータであることを確認
+        for name in self.get_target_servos(cmd):
+            if name not in self.servos:
+                raise UnknownCommandException(
+                    "ServoMotorNode::execute_command(): unknown servo: {0}"
+                    .format(name))
+
+        # 既定のサーボモータを動かす命令は実行中の軌道を中断する
+        # 新たな軌道の命令は実行中の軌道を置き換える
+        if self.default_servo in self.get_target_servos(cmd):
+            self.cancel_trajectory()
+
+        # 命令の実行開始をアプリケーションに伝達
+        self.send_message("servo", { "command": cmd, "state": "start" })
+
+        # 命令の実行終了時に送るメッセージ
+        done_msg = { "command": cmd, "state": "done" }
+
+        if cmd.get("command") == "trajectory":
+            # 軌道の実行を開始(実行終了は軌道が終了したときに伝達)
+            self.start_trajectory(cmd)
+            return
+        elif cmd.get("command") == "cancel-trajectory":
+            # 実行中の軌道は既に中断されている
+            pass
+        elif cmd.get("command") == "scan":
+            # 超音波センサを取り付けたサーボモータを回転させて距離を計測
+            angles, ranges, completed = self.scan(
+                cmd["angles"], cmd.get("addr", self.scan_addr),
+                cmd.get("settle", 0.1), cmd.get("slew_rate", None))
+            done_msg["angles"] = angles
+            done_msg["ranges"] = ranges
+
+            # ロボットが走行を始めたために走査を中断した場合
+            if not completed:
+                done_msg["state"] = "interrupted"
+        elif cmd.get("command") == "pose":
+            # 複数のサーボモータの角度を同時に設定
+            self.set_pose(cmd["angles"])
+        elif "angle" in cmd:
+            # サーボモータの角度を指定
+            self.set_pose({ cmd.get("servo", self.default_servo): cmd["angle"] })
+        elif "value" in cmd:
+            # サーボモータのGPIO端子に値を書き込み
+            self.servos[cmd.get("servo", self.default_servo)].write(cmd["value"])
+
+        # 命令の実行終了をアプリケーションに伝達
+        self.send_message("servo", done_msg)
+
+    def get_target_servos(self, cmd):
+        """命令によって動かされるサーボモータの名前のリストを取得"""
+
+        if cmd.get("command") == "pose":
+            return list(cmd["angles"])
+        elif cmd.get("command") in ServoMotorNode.COMMANDS:
+            return [self.default_servo]
+        else:
+            return [cmd.get("servo", self.default_servo)]
+
+    def set_angle(self, name, angle):
+        """指定された名前のサーボモータの角度を設定"""
+        self.set_pose({ name: angle })
+
+    def set_pose(self, angles):
+        """複数のサーボモータの角度を同時に設定"""
+
+        if self.controller is not None:
+            # 全ての角度を書き込む値に変換してから(範囲外の場合は何も書き込まない),
+            # 1回のブロック書き込みで同時に出力を切り替える
+            # チャネルの範囲が8個を超える場合は複数回に分けて書き込むため同時には切り替わらない
+            values = { self.servos[name].channel: self.servos[name].angle_to_value(angle)
+                       for name, angle in angles.items() }
+            if self.controller.write_channels(values) > 1:
+                print("ServoMotorNode::set_pose(): " +
+                      "channels {0} span more than one block write ".format(sorted(values)) +
+                      "and were not switched simultaneously")
+        else:
+            for name, angle in angles.items():
+                self.servos[name].set_angle(angle)
+
+        # 最後に指定した角度を更新
+        servo_angles = self.state_dict["angles"]
+        servo_angles.update(angles)
+        self.state_dict["angles"] = servo_angles
+
+        if self.default_servo in angles:
+            self.state_dict["angle"] = angles[self.default_servo]
+
+        # 他のノードがロボット自身の動きを判定できるように時刻を記録
+        self.state_dict["last_move_time"] = time.monotonic()
+
+    def start_trajectory(self, cmd):
+        """軌道の実行を開始"""
+
+        start_angle = self.state_dict["angle"]
+
+        if "keyframes" in cmd:
+            # キーフレームの間を補間する軌道
+            trajectory = ServoTrajectory.keyframes(start_angle, cmd["keyframes"])
+        else:
+            # 角速度と角加速度を制限して目標の角度まで回転させる軌道
+            trajectory = ServoTrajectory.trapezoidal(
+                start_angle, cmd["angle"],
+                cmd.get("max_velocity", self.max_velocity),
+                cmd.get("max_acceleration", self.max_acceleration))
+
+        # 補間された角度はキーフレームの角度の範囲に収まるため, キーフレームの角度のみを確認
+        for angle in trajectory.angles:
+            if not self.servo_motor.min_angle <= angle <= self.servo_motor.max_angle:
+                raise ValueError("ServoMotorNode::start_trajectory(): " +
+                                 "specified angle {0} is out of range [{1}, {2}]"
+                                 .format(angle, self.servo_motor.min_angle,
+                                         self.servo_motor.max_angle))
+
+        self.trajectory = trajectory
+        self.trajectory_cmd = cmd
+        self.trajectory_start_time = time.monotonic()
+        self.next_tick_time = self.trajectory_start_time
+        self.state_dict["moving"] = True
+
+    def update_trajectory(self):
+        """実行中の軌道に沿ってサーボモータの角度を更新"""
+
+        if self.trajectory is None:
+            return
+
+        current_time = time.monotonic()
+
+        if current_time < self.next_tick_time:
+            return
+
+        elapsed = current_time - self.trajectory_start_time
+        angle = self.trajectory.angle_at(elapsed)
+
+        # 角度が変化した場合のみ書き込み
+        if angle != self.state_dict["angle"]:
+            self.set_angle(self.default_servo, angle)
+
+        if self.trajectory.is_finished(elapsed):
+            # 軌道の実行終了をアプリケーションに伝達
+            self.send_message("servo", { "command": self.trajectory_cmd, "state": "done" })
+            self.finish_trajectory()
+            return
+
+        # 処理が遅れた場合は遅れを取り戻そうとせずに次の時刻を決める
+        self.next_tick_time = max(self.next_tick_time + self.trajectory_interval,
+                                  current_time)
+
+    def cancel_trajectory(self):
+        """実行中の軌道を中断"""
+
+        if self.trajectory is None:
+            return
+
+        # 軌道の中断をアプリケーションに伝達
+        self.send_message("servo", { "command": self.trajectory_cmd, "state": "cancelled",
+                                     "angle": self.state_dict["angle"] })
+        self.finish_trajectory()
+
+    def finish_trajectory(self):
+        """軌道の実行を終了"""
+        self.trajectory = None
+        self.trajectory_cmd = None
+        self.state_dict["moving"] = False
+        self.state_dict["last_move_time"] = time.monotonic()
+
+    def read_range(self, addr):
+        """超音波センサから測距の結果を読み出し(失敗した場合はNaN)"""
+        try:
+            return float(self.srf02.read_values(addr)[0])
+        except IOError:
+            print("ServoMotorNode::read_range(): IOError occurred")
+            return np.nan
+
+    def scan(self, angles, addr, settle=0.1, slew_rate=None):
+        """
+        サーボモータを各角度に回転させながら超音波センサで距離を計測
+        ロボットが走行を始めた場合は, 超音波センサのノードの計測を再開させるために中断
+        """
+
+        angles = np.asarray(angles, dtype=np.float64)
+        # 各角度で計測された距離(計測に失敗した場合はNaN)
+        ranges = np.full(len(angles), np.nan)
+        # 全ての角度で計測したかどうか
+        completed = True
+
+        if len(angles) == 0:
+            return angles, ranges, completed
+
+        # 走査中は超音波センサのノードの計測を止める
+        with self.ranging_lock:
+            prev_angle = self.state_dict["angle"]
+            self.set_angle(self.default_servo, float(angles[0]))
+            move_time = time.monotonic()
+            # 測距が完了したが結果をまだ読み出していない角度の番号
+            pending = None
+
+            for i, angle in enumerate(angles):
+                # 走査中にロボットが走行を始めた場合は中断
+                if self.is_robot_moving():
+                    print("ServoMotorNode::scan(): " +
+                          "scan was interrupted since the robot started moving")
+                    completed = False
+                    break
+
+                # サーボモータの回転が終わって静止するまでの時間
+                wait_time = settle
+                if slew_rate is not None:
+                    wait_time += abs(angle - prev_angle) / slew_rate
+
+                # サーボモータが回転している間に前の角度の結果を読み出し
+                if pending is not None:
+                    ranges[pending] = self.read_range(addr)
+                    pending = None
+
+                remaining = move_time + wait_time - time.monotonic()
+                if remaining > 0.0:
+                    time.sleep(remaining)
+
+                try:
+                    # 測距を開始して音波が返ってくるまで待機
+                    self.srf02.start_ranging(addr)
+                    if self.srf02.wait_ranging([addr]):
+                        pending = i
+                except IOError:
+                    print("ServoMotorNode::scan(): IOError occurred")
+
+                # 測距が完了したらすぐに次の角度へ回転させる
+                if i + 1 < len(angles):
+                    self.set_angle(self.default_servo, float(angles[i + 1]))
+                    move_time = time.monotonic()
+                    prev_angle = angle
+
+            # 最後の角度の結果を読み出し
+            if pending is not None:
+                ranges[pending] = self.read_range(addr)
+
+        self.state_dict["scan"] = { "angles": angles, "ranges": ranges, "addr": addr }
+
+        return angles, ranges, completed
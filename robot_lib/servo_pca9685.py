@@ -0,0 +1,237 @@
+# coding: utf-8
+# servo_pca9685.py
+
+from util import usleep
+
+class Pca9685(object):
+    """
+    I2C接続の16チャネルPWMコントローラ(PCA9685)を操作するクラス
+    """
+
+    # レジスタのアドレス
+    MODE1 = 0x00
+    LED0_ON_L = 0x06
+    PRESCALE = 0xFE
+
+    # MODE1レジスタのビット
+    MODE1_SLEEP = 0x10
+    MODE1_AI = 0x20
+
+    # チャネルの個数とPWMの分解能
+    CHANNEL_NUM = 16
+    PWM_RANGE = 4096
+    # 内部発振器の周波数(Hz)
+    OSC_CLOCK = 25000000
+    # 1回のブロック書き込みで更新できるチャネルの個数(SMBusの制限で32バイトまで)
+    # PCA9685の出力は通信の終了(STOP)時に切り替わるため(MODE2レジスタのOCHが0の既定値),
+    # 同時に切り替えられるのは連続する8個のチャネルまで
+    MAX_BLOCK_CHANNELS = 8
+
+    def __init__(self, i2c_bus, addr=0x40, frequency=50):
+        """コンストラクタ"""
+
+        # 他のデバイスと共有するI2Cデータバス
+        self.i2c_bus = i2c_bus
+        # PCA9685のアドレス
+        self.addr = addr
+        # PWMの動作周波数(通常は50Hz)
+        self.pwm_frequency = frequency
+        # 各チャネルのLEDn_ON_LからLEDn_OFF_Hまでのレジスタの値
+        # (ブロック書き込みで間のチャネルを埋めるために使用, 値が不明な場合はNone)
+        # 指令していないチャネルも現在の出力を保つように, 初期化時に読み出した値で埋める
+        self.channel_registers = [None] * Pca9685.CHANNEL_NUM
+        # ブロック書き込みの回数
+        self.block_writes = 0
+
+        self.setup()
+        self.read_channel_registers()
+
+        print("Pca9685::__init__(): initialization succeeded")
+
+    def setup(self):
+        """PWMの動作周波数を設定"""
+
+        # PWMの動作周波数 = 25MHz / (4096 * (PRESCALE + 1))
+        prescale = int(round(Pca9685.OSC_CLOCK / (Pca9685.PWM_RANGE * self.pwm_frequency))) - 1
+
+        # PRESCALEレジスタはスリープ中のみ書き込める
+        self.write_register(Pca9685.MODE1, Pca9685.MODE1_SLEEP)
+        self.write_register(Pca9685.PRESCALE, prescale)
+        # スリープを解除し, ブロック書き込みのためにレジスタのアドレスの自動加算を有効化
+        self.write_register(Pca9685.MODE1, Pca9685.MODE1_AI)
+        # 発振器が安定するまで待機(500マイクロ秒以上)
+        usleep(500)
+
+    def read_channel_registers(self):
+        """全てのチャネルのレジスタの現在の値を読み出し"""
+
+        for first in range(0, Pca9685.CHANNEL_NUM, Pca9685.MAX_BLOCK_CHANNELS):
+            try:
+                data = self.read_block(Pca9685.LED0_ON_L + 4 * first,
+                                       4 * Pca9685.MAX_BLOCK_CHANNELS)
+            except OSError as e:
+                # 読み出せなかったチャネルはブロック書き込みに含めない
+                print("Pca9685::read_channel_registers(): " +
+                      "failed to read channels {0} to {1}: {2}"
+                      .format(first, first + Pca9685.MAX_BLOCK_CHANNELS - 1, e))
+                continue
+
+            for i in range(Pca9685.MAX_BLOCK_CHANNELS):
+                self.channel_registers[first + i] = list(data[4 * i:4 * i + 4])
+
+    def write_register(self, reg, value):
+        """レジスタに1バイトの値を書き込み"""
+        self.i2c_bus.write_byte_data(self.addr, reg, value)
+
+    def write_block(self, reg, data):
+        """連続するレジスタに1回の通信で書き込み"""
+        self.i2c_bus.write_block_data(self.addr, reg, data)
+
+    def read_block(self, reg, length):
+        """連続するレジスタを1回の通信で読み出し"""
+        return self.i2c_bus.read_block_data(self.addr, reg, length)
+
+    def write_channels(self, values):
+        """
+        複数のチャネルのPWMの値(パルス幅のカウント数)をまとめて書き込み
+        ブロック書き込みの回数を返す(1回の場合のみ全てのチャネルの出力が同時に切り替わる)
+        """
+
+        if not values:
+            return 0
+
+        for channel, value in values.items():
+            if not 0 <= channel < Pca9685.CHANNEL_NUM:
+                raise ValueError("Pca9685::write_channels(): " +
+                                 "invalid channel: {0}".format(channel))
+            # ON(パルスの立ち上がり)のカウントを0, OFF(立ち下がり)のカウントを値に設定
+            off = int(value)
+            self.channel_registers[channel] = [0x00, 0x00, off & 0xFF, (off >> 8) & 0x0F]
+
+        # 書き込むチャネルを含む連続したチャネルを1回のブロック書き込みで更新
+        # 間のチャネルには現在の値を書き戻すため, 指令していないチャネルの出力は変わらない
+        # 1回の通信で書き込まれたチャネルの出力は通信の終了時に同時に切り替わるが,
+        # MAX_BLOCK_CHANNELSを超える範囲のチャネルや, 間に値が不明なチャネルを含む
+        # チャネルは複数回に分けて書き込むため, ブロック書き込みごとに順に切り替わる
+        channels = sorted(values)
+        first = channels[0]
+        block_writes = 0
+
+        while first <= channels[-1]:
+            end = min(first + Pca9685.MAX_BLOCK_CHANNELS, channels[-1] + 1)
+            last = first + 1
+
+            # 値が不明なチャネルの手前までを1回のブロック書き込みに含める
+            while last < end and self.channel_registers[last] is not None:
+                last += 1
+            # 末尾の指令していないチャネルは書き込まない
+            while last - 1 not in values:
+                last -= 1
+
+            data = []
+
+            for channel in range(first, last):
+                data.extend(self.channel_registers[channel])
+
+            self.write_block(Pca9685.LED0_ON_L + 4 * first, data)
+            self.block_writes += 1
+            block_writes += 1
+
+            # 次のブロック書き込みで更新するチャネル
+            remaining = [channel for channel in channels if channel >= last]
+            if not remaining:
+                break
+            first = remaining[0]
+
+        return block_writes
+
+class SimulatedPca9685(Pca9685):
+    """
+    ハードウェアを使用せずにPCA9685の動作を模倣するクラス
+    """
+
+    def __init__(self, addr=0x40, frequency=50):
+        """コンストラクタ"""
+
+        # 書き込まれたレジスタの値
+        # 各チャネルは電源投入時と同様に常にOFF(LEDn_OFF_Hのビット4が1)とする
+        self.registers = {}
+        for channel in range(Pca9685.CHANNEL_NUM):
+            self.registers[Pca9685.LED0_ON_L + 4 * channel + 3] = 0x10
+        super().__init__(None, addr, frequency)
+
+    def write_register(self, reg, value):
+        """レジスタに1バイトの値を書き込み"""
+        self.registers[reg] = value
+
+    def write_block(self, reg, data):
+        """連続するレジスタに1回の通信で書き込み"""
+        for i, value in enumerate(data):
+            self.registers[reg + i] = value
+
+    def read_block(self, reg, length):
+        """連続するレジスタを1回の通信で読み出し"""
+        return [self.registers.get(reg + i, 0) for i in range(length)]
+
+class ServoPca9685(object):
+    """
+    PWMコントローラ(PCA9685)の1つのチャネルに接続されたサーボモータを操作するクラス
+    """
+
+    def __init__(self, controller, channel, min_value=102, max_value=512,
+                 min_angle=0, max_angle=180):
+        """コンストラクタ"""
+        print("ServoPca9685::__init__(): channel: {0}".format(channel))
+
+        # min_valueを書き込んだときの角度がmin_angle,
+        # max_valueを書き込んだときの角度がmax_angleとなるように設定
+        # 50Hzの場合は1カウントが約4.88マイクロ秒に相当するため,
+        # 102が約0.5ミリ秒, 512が約2.5ミリ秒のパルス幅に相当
+
+        # PWMコントローラ
+        self.controller = controller
+        # 使用するチャネル
+        self.channel = channel
+        # 書き込む値の最小値と最大値(サーボモータによって異なる)
+        self.min_value = min_value
+        self.max_value = max_value
+        # 指定する角度の最小値と最大値
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+
+    def check_value(self, val):
+        """書き込む値が範囲内であるかどうかを確認"""
+
+        # 書き込もうとしている値が小さ過ぎる場合は例外をスロー
+        if val < self.min_value:
+            raise ValueError("ServoPca9685::check_value(): " +
+                             "specified value {0} is less than the minimum value {1}"
+                             .format(val, self.min_value))
+
+        # 書き込もうとしている値が大き過ぎる場合は例外をスロー
+        if val > self.max_value:
+            raise ValueError("ServoPca9685::check_value(): " +
+                             "specified value {0} is greater than the maximum value {1}"
+                             .format(val, self.max_value))
+
+    def angle_to_value(self, angle):
+        """角度を書き込む値に変換"""
+
+        # 指定された角度が範囲外の場合は例外をスロー
+        if angle < self.min_angle or angle > self.max_angle:
+            raise ValueError("ServoPca9685::angle_to_value(): " +
+                             "specified angle {0} is out of range [{1}, {2}]"
+                             .format(angle, self.min_angle, self.max_angle))
+
+        return int(self.min_value + \
+            (self.max_value - self.min_value) / (self.max_angle - self.min_angle) * \
+            (angle - self.min_angle))
+
+    def write(self, val):
+        """チャネルに値を書き込み"""
+        self.check_value(val)
+        self.controller.write_channels({ self.channel: val })
+
+    def set_angle(self, angle):
+        """角度を指定"""
+        self.controller.write_channels({ self.channel: self.angle_to_value(angle) })
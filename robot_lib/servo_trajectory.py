@@ -0,0 +1,104 @@
+# coding: utf-8
+# servo_trajectory.py
+
+import bisect
+import math
+
+class ServoTrajectory(object):
+    """
+    サーボモータの角度の時間変化(軌道)を表すクラス
+    """
+
+    def __init__(self, times, angles, segment_func):
+        """コンストラクタ"""
+
+        # 各キーフレームの時刻(秒, 軌道の開始時刻からの経過時間)と角度(度)
+        self.times = times
+        self.angles = angles
+        # キーフレーム間の角度を補間する関数
+        # (区間の開始からの経過時間, 区間の番号)を受け取って角度を返す
+        self.segment_func = segment_func
+        # 軌道の実行に要する時間(秒)
+        self.duration = times[-1]
+
+    @staticmethod
+    def trapezoidal(start_angle, target_angle, max_velocity, max_acceleration):
+        """台形の速度分布で目標の角度まで回転させる軌道を作成"""
+
+        if max_velocity <= 0 or max_acceleration <= 0:
+            raise ValueError("ServoTrajectory::trapezoidal(): " +
+                             "max_velocity and max_acceleration must be positive")
+
+        distance = abs(target_angle - start_angle)
+        direction = 1.0 if target_angle >= start_angle else -1.0
+
+        # 加速に要する時間と, その間に回転する角度
+        accel_time = max_velocity / max_acceleration
+        accel_distance = 0.5 * max_acceleration * accel_time ** 2
+
+        if 2.0 * accel_distance > distance:
+            # 最大の角速度に達する前に減速を始める(三角形の速度分布)
+            accel_time = math.sqrt(distance / max_acceleration)
+            accel_distance = distance / 2.0
+            peak_velocity = max_acceleration * accel_time
+            cruise_time = 0.0
+        else:
+            peak_velocity = max_velocity
+            cruise_time = (distance - 2.0 * accel_distance) / max_velocity
+
+        duration = 2.0 * accel_time + cruise_time
+
+        def angle_at(t, segment):
+            if t < accel_time:
+                # 加速中
+                traveled = 0.5 * max_acceleration * t ** 2
+            elif t < accel_time + cruise_time:
+                # 一定の角速度で回転中
+                traveled = accel_distance + peak_velocity * (t - accel_time)
+            else:
+                # 減速中
+                remaining = max(duration - t, 0.0)
+                traveled = distance - 0.5 * max_acceleration * remaining ** 2
+            return start_angle + direction * traveled
+
+        return ServoTrajectory([0.0, duration], [start_angle, target_angle], angle_at)
+
+    @staticmethod
+    def keyframes(start_angle, frames):
+        """キーフレーム(角度と時刻)の間を滑らかに補間する軌道を作成"""
+
+        times = [0.0]
+        angles = [start_angle]
+
+        for frame in frames:
+            if frame["time"] < times[-1]:
+                raise ValueError("ServoTrajectory::keyframes(): " +
+                                 "keyframe times must be in ascending order")
+            times.append(float(frame["time"]))
+            angles.append(float(frame["angle"]))
+
+        def angle_at(t, segment):
+            length = times[segment + 1] - times[segment]
+            if length <= 0.0:
+                return angles[segment + 1]
+            # 区間の両端で角速度が0となるように余弦関数で補間
+            ratio = 0.5 - 0.5 * math.cos(math.pi * min(t / length, 1.0))
+            return angles[segment] + (angles[segment + 1] - angles[segment]) * ratio
+
+        return ServoTrajectory(times, angles, angle_at)
+
+    def angle_at(self, t):
+        """軌道の開始時刻から指定された時間が経過したときの角度を計算"""
+
+        if t >= self.duration:
+            return self.angles[-1]
+        if t <= 0.0:
+            return self.angles[0]
+
+        # 指定された時刻を含む区間を探索
+        segment = bisect.bisect_right(self.times, t) - 1
+        return self.segment_func(t - self.times[segment], segment)
+
+    def is_finished(self, t):
+        """軌道の開始時刻から指定された時間が経過したときに軌道が終了しているかどうか"""
+        return t >= self.duration
@@ -0,0 +1,47 @@
+# coding: utf-8
+# shared_motor_state.py
+
+import math
+import multiprocessing as mp
+
+class SharedMotorState(object):
+    """
+    モータのノードで指令された左右のモータの速度を他のノードのプロセスと共有するクラス
+    """
+
+    def __init__(self):
+        """コンストラクタ"""
+
+        # 以下はforkによって各ノードのプロセスに引き継がれるため,
+        # ノードの実行を開始する前に作成しておく必要がある
+        # ノードの状態を格納するディクショナリ(state_dict)はノードの停止時に
+        # 再作成され, 他のノードのプロセスからは参照できなくなるため使用しない
+
+        # 左右のモータの速度
+        self.speed_left = mp.RawValue("d", 0.0)
+        self.speed_right = mp.RawValue("d", 0.0)
+        # 最後にモータの速度を変更した時刻(time.monotonic()の値, 変更していない場合はNaN)
+        self.last_move_time = mp.RawValue("d", math.nan)
+
+    def set_speeds(self, speed_left, speed_right, move_time):
+        """左右のモータの速度を更新(Noneの場合は更新しない)"""
+
+        if speed_left is not None:
+            self.speed_left.value = speed_left
+        if speed_right is not None:
+            self.speed_right.value = speed_right
+
+        self.last_move_time.value = move_time
+
+    def get_speeds(self):
+        """左右のモータの速度を取得"""
+        return self.speed_left.value, self.speed_right.value
+
+    def get_last_move_time(self):
+        """最後にモータの速度を変更した時刻を取得(変更していない場合はNone)"""
+        last_move_time = self.last_move_time.value
+        return None if math.isnan(last_move_time) else last_move_time
+
+    def is_moving(self):
+        """モータが回転しているかどうか"""
+        return self.speed_left.value != 0 or self.speed_right.value != 0
@@ -1,48 +1,152 @@
 # coding: utf-8
 # srf02.py
 
-import smbus
 import time
 
+from i2c_bus import I2cBus
 from util import usleep
 
 class Srf02(object):
     """
     超音波センサ(SRF02)を操作するクラス
     """
-    def __init__(self):
+    # 測距の完了を待機する方法
+    # fixed: 常に80ミリ秒待機
+    # poll: ソフトウェアリビジョンのレジスタを読み出して測距の完了を確認
+    RANGING_MODES = ("fixed", "poll")
+
+    # 測距中にソフトウェアリビジョンのレジスタ(レジスタ0)から読み出される値
+    RANGING_BUSY = 0xFF
+
+    def __init__(self, ranging_mode="fixed", poll_interval=0.002,
+                 poll_max_interval=0.01, poll_timeout=0.1, i2c_bus=None):
         """コンストラクタ"""
-        # I2Cデータバス(/dev/i2c-1)をオープン
-        # 引数の1はデータバス番号(/dev/i2c-1の1)に対応
-        self.i2c = smbus.SMBus(1)
+
+        if ranging_mode not in Srf02.RANGING_MODES:
+            raise ValueError("Srf02::__init__(): " +
+                             "unknown ranging mode: {0}".format(ranging_mode))
+
+        # 測距の完了を待機する方法
+        self.ranging_mode = ranging_mode
+        # 測距の完了を確認する最初の間隔(秒)
+        # 確認するたびに間隔を1.5倍に伸ばす(最大でpoll_max_interval秒)
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        # 測距の完了を待機する最大の時間(秒)
+        self.poll_timeout = poll_timeout
+
+        # 他のデバイスと共有するI2Cデータバス
+        # 指定されない場合はI2Cデータバス(/dev/i2c-1)を単独でオープン
+        self.i2c_bus = i2c_bus if i2c_bus is not None else I2cBus(1)
 
         print("Srf02::__init__(): initialization succeeded")
 
-    def __del__(self):
-        """デストラクタ"""
-        # I2Cデータバス(/dev/i2c-1)をクローズ
-        self.i2c.close()
-        
-    def get_values(self, addr):
-        """指定したアドレスを持つ超音波センサから値を取得"""
+    def start_ranging(self, addr):
+        """指定したアドレスを持つ超音波センサの測距を開始"""
+        # コマンドレジスタ0を指定してコマンドを送信
+        # コマンド0x51(Real Ranging Mode (Result in centimeters))を送信
+        self.i2c_bus.write_byte_data(addr, 0x00, 0x51)
+
+    def read_values(self, addr):
+        """指定したアドレスを持つ超音波センサから測距の結果を取得"""
+        # コマンドレジスタ2から5までを1回の通信で読み出し
+        # レジスタ2と3は測距データ(センチメートル)の上位バイトと下位バイト
+        # レジスタ4と5は最小の距離(センチメートル)の上位バイトと下位バイト
+        data = self.i2c_bus.read_block_data(addr, 2, 4)
+        dist = (data[0] << 8) | data[1]
+        mindist = (data[2] << 8) | data[3]
 
+        return (dist, mindist)
+
+    def is_ranging(self, addr):
+        """指定したアドレスを持つ超音波センサが測距中であるかどうか"""
         try:
-            # コマンドレジスタ0を指定してコマンドを送信
-            # コマンド0x51(Real Ranging Mode (Result in centimeters))を送信
-            self.i2c.write_byte_data(addr, 0x00, 0x51)
+            # 測距中はソフトウェアリビジョンのレジスタから0xFFが読み出される
+            # 他のデバイスの通信を妨げないように低い優先度で読み出す
+            return self.i2c_bus.read_byte_data(
+                addr, 0x00, I2cBus.PRIORITY_LOW) == Srf02.RANGING_BUSY
+        except IOError:
+            # 測距中はI2Cバスに応答しないことがあるため測距中とみなす
+            return True
 
+    def wait_ranging(self, addr_list):
+        """指定した超音波センサの測距が完了するまで待機して完了したアドレスを返す"""
+
+        if self.ranging_mode == "fixed":
             # 音波を用いるため適当な時間待機(66ミリ秒以上)
             usleep(80000)
+            return list(addr_list)
+
+        # 測距が完了していない超音波センサのアドレス
+        busy_addrs = list(addr_list)
+        # 測距の完了を確認する間隔
+        interval = self.poll_interval
+        # 待機を打ち切る時刻
+        deadline = time.monotonic() + self.poll_timeout
+
+        while True:
+            time.sleep(interval)
+            busy_addrs = [addr for addr in busy_addrs if self.is_ranging(addr)]
+
+            if not busy_addrs:
+                break
+
+            if time.monotonic() >= deadline:
+                print("Srf02::wait_ranging(): timeout (addr: {0})".format(
+                      ", ".join("{0:#x}".format(addr) for addr in busy_addrs)))
+                break
+
+            interval = min(interval * 1.5, self.poll_max_interval)
+
+        return [addr for addr in addr_list if addr not in busy_addrs]
+
+    def get_values(self, addr):
+        """指定したアドレスを持つ超音波センサから値を取得"""
+
+        try:
+            self.start_ranging(addr)
+
+            # 測距が完了するまで待機
+            if not self.wait_ranging([addr]):
+                return None
             
-            # コマンドレジスタ2を指定して測距データ(センチメートル)を取得
-            dist = self.i2c.read_word_data(addr, 2) >> 8
-            # コマンドレジスタ4を指定して最小の距離(センチメートル)を取得
-            mindist = self.i2c.read_word_data(addr, 4) >> 8
-           
             # 取得された距離を返す
-            return (dist, mindist)
+            return self.read_values(addr)
         except IOError:
             # データの取得に失敗
             print("Srf02::get_values(): IOError occurred")
             return None
 
+    def get_values_multi(self, addr_list):
+        """指定した複数のアドレスを持つ超音波センサで同時に測距して値を取得"""
+
+        # 各アドレスの測距の結果(取得に失敗した場合はNone)
+        results = { addr: None for addr in addr_list }
+        # 測距を開始できた超音波センサのアドレス
+        started_addrs = []
+
+        # 全ての超音波センサの測距を続けて開始
+        for addr in addr_list:
+            try:
+                self.start_ranging(addr)
+                started_addrs.append(addr)
+            except IOError:
+                print("Srf02::get_values_multi(): " +
+                      "IOError occurred (addr: {0:#x})".format(addr))
+
+        if not started_addrs:
+            return results
+
+        # 測距が完了するまで待機
+        # 超音波センサの個数に依らず1回だけ待機する
+        completed_addrs = self.wait_ranging(started_addrs)
+
+        # 全ての超音波センサから結果を取得
+        for addr in completed_addrs:
+            try:
+                results[addr] = self.read_values(addr)
+            except IOError:
+                print("Srf02::get_values_multi(): " +
+                      "IOError occurred (addr: {0:#x})".format(addr))
+
+        return results
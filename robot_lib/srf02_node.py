@@ -1,10 +1,12 @@
 # coding: utf-8
 # srf02_node.py
 
+import math
 import multiprocessing as mp
 import time
 
 from data_sender_node import DataSenderNode
+from range_history import RangeHistory
 
 class Srf02Node(DataSenderNode):
     """
@@ -14,7 +16,8 @@ class Srf02Node(DataSenderNode):
     def __init__(self, process_manager, msg_queue,
                  srf02, distance_threshold=15,
                  near_obstacle_threshold=5,
-                 interval=0.5, addr_list=[0x70]):
+                 interval=0.5, addr_list=[0x70], ranging_groups=None,
+                 history_size=32):
         """コンストラクタ"""
         super().__init__(process_manager, msg_queue)
 
@@ -28,55 +31,326 @@ class Srf02Node(DataSenderNode):
         self.interval = interval
         # 超音波センサのアドレスのリスト
         self.addr_list = addr_list
+        # 同時に測距する超音波センサのアドレスのグループのリスト
+        # 同時に測距すると他の超音波センサの音波を受信して誤った距離となる(クロストーク)
+        # 場合があるため, 指定されない場合は1つずつ順番に測距する
+        # "all"を指定した場合は全ての超音波センサで同時に測距
+        if ranging_groups is None:
+            self.ranging_groups = [[addr] for addr in self.addr_list]
+        elif ranging_groups == "all":
+            self.ranging_groups = [list(self.addr_list)]
+        else:
+            self.ranging_groups = ranging_groups
+
+        if sorted(addr for group in self.ranging_groups for addr in group) != \
+            sorted(self.addr_list):
+            raise ValueError("Srf02Node::__init__(): " +
+                             "ranging_groups must contain each address in addr_list once")
+
+        # 超音波センサを他のノード(サーボモータによる走査)と排他的に使用するためのロック
+        self.ranging_lock = mp.Lock()
+
+        # 各超音波センサの計測値の履歴(共有メモリ上のリングバッファ)
+        # アプリケーションや他のノードはプロセス間通信を行わずに参照できる
+        self.history = RangeHistory(self.addr_list, history_size)
+
         # 指数移動平均のパラメータ(平滑化係数)
         self.smoothing_coeff = 0.75
         # 距離の最大値
         self.max_distance = 50
 
+        # モータのノードと共有する安全インターロック
+        # NodeManager::connect_nodes()により設定される
+        self.interlock = None
+        # 安全インターロックを作動させる距離(センチメートル)
+        self.interlock_distance = None
+        # 安全インターロックを解除する距離(センチメートル)
+        self.interlock_release_distance = None
+
+        # モータのノードと共有する左右のモータの速度(SharedMotorState)
+        # NodeManager::connect_nodes()により設定される
+        self.motor_state = None
+        # モータの速度を車輪の回転速度(センチメートル毎秒)に変換する関数
+        self.speed_converter = None
+        # 計測の間に移動する距離の上限(センチメートル)
+        # Noneの場合は常にintervalの間隔で計測する
+        self.max_travel_distance = None
+        # 計測の間隔の最小値と, 停止しているときの計測の間隔(秒)
+        self.min_interval = interval
+        self.idle_interval = interval
+        # 現在の計測の間隔(秒)
+        self.current_interval = interval
+
+        # 各超音波センサの向き(度, 正面が0で左が正)
+        self.sensor_bearings = {}
+        # 計測値の時間変化率を求めるときに用いる計測値の個数
+        self.ttc_window = 5
+        # 停止するときのロボットの減速度(センチメートル毎秒毎秒)
+        self.deceleration = 20.0
+        # 障害物の手前で停止させたい距離(センチメートル)
+        self.ttc_stop_distance = 5.0
+        # 接近していると判定する接近速度の下限(センチメートル毎秒)
+        self.min_closing_speed = 2.0
+        # 停止に要する時間に加える余裕(秒)と警告の段階
+        # 衝突までの時間が停止に要する時間と余裕の和を下回ると, その段階の警告を送る
+        self.ttc_levels = { "caution": 2.0, "warning": 1.0, "critical": 0.0 }
+        # 各超音波センサについて前回送った警告の段階
+        self.ttc_level_state = { addr: None for addr in self.addr_list }
+
         # 各アドレスに対応する超音波センサの情報を初期化
         for addr in self.addr_list:
             self.state_dict[addr] = None
+
+        # I2Cデータバスの各デバイスとの通信の統計
+        self.state_dict["i2c_bus"] = {}
+        # 現在の計測の間隔(秒)
+        self.state_dict["interval"] = interval
+        # 各超音波センサで推定された衝突までの時間
+        self.state_dict["ttc"] = {}
             
+    def set_interlock(self, interlock, distance, release_distance=None):
+        """モータのノードと共有する安全インターロックを設定"""
+        self.interlock = interlock
+        self.interlock_distance = distance
+        self.interlock_release_distance = release_distance \
+            if release_distance is not None else distance + 5
+
+    def update_interlock(self, addr, dist):
+        """計測値に応じて安全インターロックを作動または解除"""
+
+        if self.interlock is None:
+            return
+
+        # 平滑化する前の計測値が閾値を下回った時点で直ちに作動
+        if dist <= self.interlock_distance:
+            self.interlock.trip(addr, dist)
+            self.interlock_clear_addrs.discard(addr)
+        elif dist >= self.interlock_release_distance:
+            self.interlock_clear_addrs.add(addr)
+
+        # 全ての超音波センサの計測値が解除の距離を上回った場合は解除
+        if self.interlock.is_tripped() and \
+            self.interlock_clear_addrs.issuperset(self.addr_list):
+            self.interlock.clear()
+
+    def set_motor_state(self, motor_state, speed_converter, sensor_bearings=None):
+        """モータのノードと共有する左右のモータの速度を設定"""
+        self.motor_state = motor_state
+        self.speed_converter = speed_converter
+
+        if sensor_bearings is not None:
+            self.sensor_bearings = sensor_bearings
+
+    def set_ttc_config(self, ttc_config):
+        """衝突までの時間の推定に用いるパラメータを設定"""
+        self.ttc_window = ttc_config.get("window", self.ttc_window)
+        self.deceleration = ttc_config.get("deceleration", self.deceleration)
+        self.ttc_stop_distance = ttc_config.get("stop_distance", self.ttc_stop_distance)
+        self.min_closing_speed = ttc_config.get("min_closing_speed", self.min_closing_speed)
+        self.ttc_levels = ttc_config.get("levels", self.ttc_levels)
+
+    def set_adaptive_interval(self, max_travel_distance, min_interval, idle_interval):
+        """ロボットの速度に応じて計測の間隔を変更するように設定"""
+
+        if min_interval <= 0 or idle_interval < min_interval:
+            raise ValueError("Srf02Node::set_adaptive_interval(): " +
+                             "invalid interval: min: {0}, idle: {1}"
+                             .format(min_interval, idle_interval))
+
+        self.max_travel_distance = max_travel_distance
+        self.min_interval = min_interval
+        self.idle_interval = idle_interval
+
+    def get_interval(self):
+        """現在のロボットの速度から計測の間隔を計算"""
+
+        if self.max_travel_distance is None or self.motor_state is None:
+            return self.interval
+
+        # 左右の車輪のうち速い方の回転速度(センチメートル毎秒)を取得
+        # 旋回中も超音波センサの向きが変わるため, 前進の速度ではなく車輪の速度を用いる
+        speed_left, speed_right = self.motor_state.get_speeds()
+        velocity = max(abs(self.speed_converter(speed_left)),
+                       abs(self.speed_converter(speed_right)))
+
+        # 停止している場合は最も長い間隔で計測
+        if velocity <= 0.0:
+            return self.idle_interval
+
+        # 計測の間に移動する距離がmax_travel_distanceを超えないように間隔を決定
+        return max(self.min_interval,
+                   min(self.idle_interval, self.max_travel_distance / velocity))
+
+    def wait_next_cycle(self, cycle_start_time):
+        """次の計測の開始時刻まで待機"""
+
+        if self.max_travel_distance is None or self.motor_state is None:
+            time.sleep(self.interval)
+            return
+
+        # 停止中に動き始めた場合にすぐに計測の間隔を短くできるように,
+        # 最小の計測の間隔ごとにロボットの速度を確認
+        while True:
+            self.current_interval = self.get_interval()
+            remaining = cycle_start_time + self.current_interval - time.monotonic()
+
+            if remaining <= 0.0:
+                break
+
+            time.sleep(min(remaining, self.min_interval))
+
+    def get_forward_velocity(self):
+        """モータのノードで指令されたロボットの前進の速度(センチメートル毎秒)を取得"""
+
+        if self.motor_state is None:
+            return 0.0
+
+        speed_left, speed_right = self.motor_state.get_speeds()
+        left_velocity = self.speed_converter(speed_left)
+        right_velocity = self.speed_converter(speed_right)
+        return (left_velocity + right_velocity) / 2.0
+
+    def get_ttc_level(self, ttc, closing_speed):
+        """衝突までの時間と接近速度から警告の段階を判定"""
+
+        # 現在の接近速度から停止するまでに要する時間
+        stop_time = closing_speed / self.deceleration
+
+        # 最も深刻な段階から順に判定
+        for level, margin in sorted(self.ttc_levels.items(), key=lambda x: x[1]):
+            if ttc <= stop_time + margin:
+                return level
+
+        return None
+
+    def update_ttc(self):
+        """計測値の履歴とロボットの速度から衝突までの時間を推定"""
+
+        # 計測値の時間変化率から求めた各超音波センサの接近速度
+        range_closing_speeds = -self.history.slope(self.ttc_window)
+        # 各超音波センサの最新の距離(外れ値と判定された場合は直近の計測値の中央値)
+        # 中央値は計測値の変化に遅れるため, なるべく最新の計測値を用いる
+        values, _ = self.history.reject_outliers(self.ttc_window)
+        dists = values[:, -1] if values.shape[1] > 0 else self.history.get_latest()
+        dists = [float(dist) if not math.isnan(dist) else float(median)
+                 for dist, median in zip(dists, self.history.filtered(self.ttc_window))]
+        # 指令されたロボットの前進の速度
+        forward_velocity = self.get_forward_velocity()
+
+        ttc_dict = {}
+
+        for addr, range_closing_speed, dist in zip(
+            self.addr_list, range_closing_speeds, dists):
+            if math.isnan(dist):
+                continue
+
+            # 指令された前進の速度を超音波センサの向きに射影した接近速度
+            bearing = math.radians(self.sensor_bearings.get(addr, 0.0))
+            command_closing_speed = forward_velocity * math.cos(bearing)
+
+            # 障害物が動いている場合や指令どおりに進んでいない場合に備えて,
+            # 2つの接近速度のうち大きい方を用いる
+            closing_speed = command_closing_speed
+            if not math.isnan(range_closing_speed):
+                closing_speed = max(closing_speed, float(range_closing_speed))
+
+            # 停止している場合や遠ざかっている場合は警告しない
+            if closing_speed < self.min_closing_speed:
+                ttc, level = None, None
+            else:
+                ttc = max(dist - self.ttc_stop_distance, 0.0) / closing_speed
+                level = self.get_ttc_level(ttc, closing_speed)
+
+            ttc_dict[addr] = { "ttc": ttc, "closing_speed": closing_speed,
+                               "dist": dist, "level": level }
+
+            # 警告の段階が変化した場合のみアプリケーションにメッセージを送出
+            if level is not None and level != self.ttc_level_state[addr]:
+                self.send_message("srf02", {
+                    "addr": addr, "state": "obstacle-approaching", "level": level,
+                    "ttc": ttc, "dist": dist, "closing_speed": closing_speed })
+
+            self.ttc_level_state[addr] = level
+
+        self.state_dict["ttc"] = ttc_dict
+
+    def process_values(self, addr, result):
+        """超音波センサから取得された値を処理して状態を更新"""
+
+        if result is None:
+            return
+
+        # 測距データと最小の距離を取得
+        dist, mindist = result
+
+        # 測距データを適当な範囲に収める
+        dist = max(min(dist, self.max_distance), mindist)
+
+        # 安全インターロックを更新
+        self.update_interlock(addr, dist)
+
+        # 各アドレスの超音波センサの情報を更新
+        if self.state_dict[addr] is None:
+            self.state_dict[addr] = {
+                "dist": dist, "mindist": mindist,
+                "near": 1 if dist <= self.distance_threshold else 0 }
+        else:
+            # 指数移動平均により計測値を平滑化
+            dist = self.state_dict[addr]["dist"] * self.smoothing_coeff + \
+                dist * (1.0 - self.smoothing_coeff)
+            # 何回連続して障害物に接近したと判定されているか
+            near = self.state_dict[addr]["near"] + 1 \
+                if dist <= self.distance_threshold else 0
+            self.state_dict[addr] = { "dist": dist, "mindist": mindist, "near": near }
+            
+            # 5回以上連続して障害物の接近と判定された場合
+            if near >= self.near_obstacle_threshold:
+                # アプリケーションにメッセージを送出
+                self.send_message("srf02", { "addr": addr, "state": "obstacle-detected" })
+
     def update(self):
         """入力を処理して状態を更新"""
 
+        # 安全インターロックを解除する距離を上回っている超音波センサのアドレス
+        self.interlock_clear_addrs = set()
+
         try:
             while True:
-                for addr in self.addr_list:
-                    # 各アドレスの超音波センサから距離を取得
-                    result = self.srf02.get_values(addr)
-                    
-                    if result is None:
-                        continue
-
-                    # 測距データと最小の距離を取得
-                    dist, mindist = result
-
-                    # 測距データを適当な範囲に収める
-                    dist = max(min(dist, self.max_distance), mindist)
-
-                    # 各アドレスの超音波センサの情報を更新
-                    if self.state_dict[addr] is None:
-                        self.state_dict[addr] = {
-                            "dist": dist, "mindist": mindist,
-                            "near": 1 if dist <= self.distance_threshold else 0 }
-                    else:
-                        # 指数移動平均により計測値を平滑化
-                        dist = self.state_dict[addr]["dist"] * self.smoothing_coeff + \
-                            dist * (1.0 - self.smoothing_coeff)
-                        # 何回連続して障害物に接近したと判定されているか
-                        near = self.state_dict[addr]["near"] + 1 \
-                            if dist <= self.distance_threshold else 0
-                        self.state_dict[addr] = { "dist": dist, "mindist": mindist, "near": near }
-                        
-                        # 5回以上連続して障害物の接近と判定された場合
-                        if near >= self.near_obstacle_threshold:
-                            # アプリケーションにメッセージを送出
-                            self.send_message("srf02", { "addr": addr, "state": "obstacle-detected" })
-
-                time.sleep(self.interval)
+                # 計測を開始した時刻
+                cycle_start_time = time.monotonic()
+
+                # 履歴に書き込む計測値と時刻(計測に失敗した場合はNaN)
+                values = [float("nan")] * len(self.addr_list)
+                timestamps = [cycle_start_time] * len(self.addr_list)
+
+                for group in self.ranging_groups:
+                    # グループ内の超音波センサで同時に測距して距離を取得
+                    # 他のノードが超音波センサを使用している間は待機
+                    with self.ranging_lock:
+                        results = self.srf02.get_values_multi(group)
+                    ranging_time = time.monotonic()
+
+                    for addr in group:
+                        index = self.history.addr_index[addr]
+                        timestamps[index] = ranging_time
+
+                        if results[addr] is not None:
+                            values[index] = results[addr][0]
+
+                        self.process_values(addr, results[addr])
+
+                # 全ての超音波センサの計測値を履歴に追加
+                self.history.append(values, timestamps)
+                # 衝突までの時間を推定
+                self.update_ttc()
+
+                # I2Cデータバスの各デバイスとの通信の統計を更新
+                self.state_dict["i2c_bus"] = self.srf02.i2c_bus.get_counters()
+                # 現在の計測の間隔を更新
+                self.state_dict["interval"] = self.current_interval
+
+                self.wait_next_cycle(cycle_start_time)
 
         except KeyboardInterrupt:
             # プロセスが割り込まれた場合
             print("Srf02Node::update(): KeyboardInterrupt occurred")
-        
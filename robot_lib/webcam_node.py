@@ -6,37 +6,66 @@ import multiprocessing as mp
 import time
 
 from data_sender_node import DataSenderNode
+from face_detector import HaarFaceDetector
+from frame_grabber import open_latest_frame_grabber
+from frame_ring import is_frame_valid
+from frame_rate_scheduler import FrameRateScheduler
 
 class WebCamNode(DataSenderNode):
     """
     カメラを操作するクラス
     """
 
-    # カスケード分類器のファイル名
-    cascade_file_path = "haarcascade_frontalface_default.xml"
-    # カスケード分類器
-    cascade_classifier_face = None
-
-    @classmethod
-    def setup_cascade_classifier(cls):
-        """カスケード分類器の作成"""
-        cls.cascade_classifier_face = cv2.CascadeClassifier(cls.cascade_file_path)
-
     def __init__(self, process_manager, msg_queue,
-                 camera_id, interval, frame_width, frame_height):
+                 camera_id, interval, frame_width, frame_height, video_capture=None,
+                 track_interval=None, roi_margin=0.5, face_detector=None,
+                 capture_config=None):
         """コンストラクタ"""
         super().__init__(process_manager, msg_queue)
 
+        # 顔検出器(指定されない場合はHaar-like特徴のカスケード分類器を使用)
+        self.face_detector = face_detector if face_detector is not None \
+            else HaarFaceDetector()
+
         # ビデオ撮影デバイスの作成
         self.camera_id = camera_id
-        self.video_capture = cv2.VideoCapture(camera_id)
-        self.video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        self.video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
-        self.video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
+        # ビデオ撮影デバイスのパラメータの設定
+        # カメラのノードが画像を共有する場合はリングバッファから読み出す
+        # それ以外の場合は画像を取り込み続けるスレッドから最新の画像を読み出す
+        # (capture_configで撮影形式や読み出す画像の形式を指定)
+        if video_capture is not None:
+            self.video_capture = video_capture
+        else:
+            self.video_capture = open_latest_frame_grabber(
+                camera_id, frame_width, frame_height, **(capture_config or {}))
 
-        # 画像をキャプチャする間隔
+        # 画像をキャプチャする間隔(画像全体から顔を検出する間隔)
         self.interval = interval
-        
+        # 検出した顔を追跡する間隔(Noneの場合は追跡せず, 常に画像全体から検出)
+        self.track_interval = track_interval
+        # 画像を処理する周期を管理(処理が間に合わない場合は画像を飛ばす)
+        self.scheduler = FrameRateScheduler(1.0 / interval)
+        # 顔を追跡する際に, 前回の顔の矩形領域の周囲に広げる探索範囲の割合
+        self.roi_margin = roi_margin
+        # 追跡する顔の大きさの変化の範囲(前回の顔の大きさに対する割合)
+        self.track_min_scale = 0.7
+        self.track_max_scale = 1.4
+
+    def initialize_state_dict(self):
+        """ノードの状態を格納するディクショナリを初期化"""
+        super().initialize_state_dict()
+
+        # 最後に検出または追跡された顔の矩形領域のリスト
+        self.state_dict["faces"] = []
+        # 最後に顔を検出したか追跡したか("detect"または"track")
+        self.state_dict["mode"] = "detect"
+        # 画像全体からの顔検出と, 顔の追跡に要した時間(秒)
+        self.state_dict["detect_time"] = 0.0
+        self.state_dict["track_time"] = 0.0
+        # 画像を処理したフレームレート(毎秒)と, 処理が間に合わずに飛ばした画像の数
+        self.state_dict["fps"] = 0.0
+        self.state_dict["dropped_frames"] = 0
+
     def __del__(self):
         """デストラクタ"""
 
@@ -46,28 +75,109 @@ class WebCamNode(DataSenderNode):
         # ウィンドウを全て破棄
         cv2.destroyAllWindows()
     
+    def detect_faces(self, frame):
+        """画像全体から顔を検出"""
+        return self.face_detector.detect(frame)
+
+    def track_faces(self, frame, faces):
+        """前回の顔の矩形領域の周囲のみを探索して顔を追跡"""
+
+        frame_height, frame_width = frame.shape[:2]
+        tracked_faces = []
+
+        for x, y, w, h in faces:
+            # 前回の矩形領域を広げた探索範囲
+            margin_x = int(w * self.roi_margin)
+            margin_y = int(h * self.roi_margin)
+            x0 = max(x - margin_x, 0)
+            y0 = max(y - margin_y, 0)
+            x1 = min(x + w + margin_x, frame_width)
+            y1 = min(y + h + margin_y, frame_height)
+
+            # 探索範囲と顔の大きさを制限することで, 画像全体からの検出よりも高速に処理
+            candidates = self.face_detector.detect(
+                frame[y0:y1, x0:x1],
+                min_size=(int(w * self.track_min_scale), int(h * self.track_min_scale)),
+                max_size=(int(w * self.track_max_scale) + 1, int(h * self.track_max_scale) + 1))
+
+            if len(candidates) == 0:
+                continue
+
+            # 前回の顔の中心に最も近い候補を追跡結果とする
+            center_x = x + w / 2 - x0
+            center_y = y + h / 2 - y0
+            cx, cy, cw, ch = min(candidates, key=lambda c:
+                (c[0] + c[2] / 2 - center_x) ** 2 + (c[1] + c[3] / 2 - center_y) ** 2)
+            tracked_faces.append((int(cx) + x0, int(cy) + y0, int(cw), int(ch)))
+
+        return tracked_faces
+
     def update(self):
         """撮影した動画を処理"""
         
         try:
+            # 検出または追跡された顔の矩形領域のリスト
+            faces = []
+            # 最後に画像全体から顔を検出した時刻
+            last_detect_time = None
+
             while True:
+                # 次の画像を処理する時刻まで待機
+                self.scheduler.wait()
+
                 # 撮影した動画を取り込み
                 ret, frame = self.video_capture.read()
-                # グレースケール画像に変換
-                frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-                # 顔検出の処理
-                faces = WebCamNode.cascade_classifier_face.detectMultiScale(
-                    frame_gray, scaleFactor=1.1,
-                    minNeighbors=5, minSize=(15, 15))
+                if frame is None:
+                    continue
+
+                # グレースケール画像への変換などは顔検出器が必要に応じて行う
+                start_time = time.monotonic()
+
+                # 追跡中の顔が無い場合と, 前回の検出から一定時間が経過した場合は画像全体から検出
+                # それ以外の場合は前回の顔の周囲のみを探索して追跡
+                if self.track_interval is None or len(faces) == 0 or \
+                    start_time - last_detect_time >= self.interval:
+                    mode = "detect"
+                else:
+                    mode = "track"
+                    faces = self.track_faces(frame, faces)
+                    self.state_dict["track_time"] = time.monotonic() - start_time
+
+                    # 顔を見失った場合は画像全体から検出し直す
+                    if len(faces) == 0:
+                        mode = "detect"
+                        start_time = time.monotonic()
+
+                if mode == "detect":
+                    # 顔検出の処理
+                    faces = self.detect_faces(frame)
+                    last_detect_time = start_time
+                    self.state_dict["detect_time"] = time.monotonic() - start_time
+
+                # 処理の間に共有メモリ上の画像が上書きされた場合は結果を破棄して検出し直す
+                if not is_frame_valid(self.video_capture):
+                    print("WebCamNode::update(): frame was overwritten during processing")
+                    faces = []
+                    continue
+
+                self.state_dict["faces"] = faces
+                self.state_dict["mode"] = mode
 
                 # 検出された顔領域をアプリケーションに伝達
                 if len(faces) > 0:
-                    self.send_message("webcam", { "state": "face-detected", "faces": faces })
+                    self.send_message("webcam", { "state": "face-detected", "faces": faces, "mode": mode })
                 else:
-                    self.send_message("webcam", { "state": "face-not-detected", "faces": faces })
+                    self.send_message("webcam", { "state": "face-not-detected", "faces": faces, "mode": mode })
+
+                self.state_dict["fps"] = self.scheduler.fps
+                self.state_dict["dropped_frames"] = self.scheduler.dropped_frames
 
-                time.sleep(self.interval)
+                # 顔を追跡中の場合は短い周期で次の画像を処理
+                if self.track_interval is not None and len(faces) > 0:
+                    self.scheduler.set_target_fps(1.0 / self.track_interval)
+                else:
+                    self.scheduler.set_target_fps(1.0 / self.interval)
 
         except KeyboardInterrupt:
             # プロセスが割り込まれた場合
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# face_detector_benchmark.py
+
+import argparse
+import cv2
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "robot_lib"))
+
+from face_detector import FACE_DETECTORS, create_face_detector
+
+# 計測する解像度(横幅, 縦幅)のリスト
+RESOLUTIONS = [(640, 480), (320, 240), (160, 120)]
+# 検出結果が正解と一致したと判定するための重なりの閾値
+IOU_THRESHOLD = 0.5
+
+def load_frames(clip_path, max_frames):
+    """録画した動画から画像を読み込み(デコードの時間を計測に含めないため事前に読み込む)"""
+
+    video_capture = cv2.VideoCapture(clip_path)
+    frames = []
+
+    while len(frames) < max_frames:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+
+    video_capture.release()
+    return frames
+
+def load_annotations(annotation_path):
+    """正解の顔の矩形領域を読み込み(画像の番号をキーとし, 元の解像度の(x, y, w, h)のリストを値とするJSON)"""
+
+    with open(annotation_path, "r") as f:
+        annotations = json.load(f)
+
+    return { int(index): [tuple(face) for face in faces]
+             for index, faces in annotations.items() }
+
+def compute_iou(face0, face1):
+    """2つの矩形領域の重なりの割合を計算"""
+
+    x0, y0, w0, h0 = face0
+    x1, y1, w1, h1 = face1
+    inter_w = max(min(x0 + w0, x1 + w1) - max(x0, x1), 0)
+    inter_h = max(min(y0 + h0, y1 + h1) - max(y0, y1), 0)
+    inter = inter_w * inter_h
+    union = w0 * h0 + w1 * h1 - inter
+    return inter / union if union > 0 else 0.0
+
+def count_matches(faces, expected_faces):
+    """正解の顔のうち, 検出された顔と一致したものの個数を計算"""
+    return sum(1 for expected in expected_faces
+               if any(compute_iou(face, expected) >= IOU_THRESHOLD for face in faces))
+
+def benchmark(face_detector, frames, resolution):
+    """指定された解像度で顔検出に要する時間と検出結果を取得"""
+
+    frame_height, frame_width = frames[0].shape[:2]
+    scale_x = frame_width / resolution[0]
+    scale_y = frame_height / resolution[1]
+
+    # 各画像の処理に要した時間(ミリ秒)
+    latencies = []
+    # 元の解像度に換算した検出結果
+    results = []
+
+    for frame in frames:
+        resized = cv2.resize(frame, resolution)
+
+        start_time = time.perf_counter()
+        faces = face_detector.detect(resized)
+        latencies.append((time.perf_counter() - start_time) * 1000.0)
+
+        results.append([(int(x * scale_x), int(y * scale_y),
+                         int(w * scale_x), int(h * scale_y)) for x, y, w, h in faces])
+
+    return latencies, results
+
+def main():
+    parser = argparse.ArgumentParser(description="face detector benchmark")
+    parser.add_argument("clip", help="recorded video clip")
+    parser.add_argument("--annotations", default=None,
+                        help="ground truth faces (JSON); " +
+                             "detections of the reference backend are used if omitted")
+    parser.add_argument("--reference", default="haar",
+                        help="reference backend used as ground truth at full resolution")
+    parser.add_argument("--backends", default=",".join(FACE_DETECTORS),
+                        help="comma separated list of backends")
+    parser.add_argument("--max-frames", type=int, default=300)
+    args = parser.parse_args()
+
+    print("starting up face detector benchmark program ...")
+
+    frames = load_frames(args.clip, args.max_frames)
+    if not frames:
+        print("failed to read frames from {0}".format(args.clip))
+        return
+
+    frame_height, frame_width = frames[0].shape[:2]
+    print("clip: {0}, frames: {1}, resolution: {2}x{3}"
+          .format(args.clip, len(frames), frame_width, frame_height))
+
+    # 正解の顔の矩形領域
+    if args.annotations is not None:
+        annotations = load_annotations(args.annotations)
+        expected = [annotations.get(i, []) for i in range(len(frames))]
+    else:
+        print("no annotations given, using {0} at {1}x{2} as ground truth"
+              .format(args.reference, frame_width, frame_height))
+        _, expected = benchmark(create_face_detector({ "backend": args.reference }),
+                                frames, (frame_width, frame_height))
+
+    num_expected = sum(len(faces) for faces in expected)
+
+    for backend in args.backends.split(","):
+        try:
+            face_detector = create_face_detector({ "backend": backend })
+        except (ValueError, FileNotFoundError, AttributeError, cv2.error) as e:
+            print("{0:>5}: skipped ({1})".format(backend, e))
+            continue
+
+        for resolution in RESOLUTIONS:
+            latencies, results = benchmark(face_detector, frames, resolution)
+            matches = sum(count_matches(faces, expected_faces)
+                          for faces, expected_faces in zip(results, expected))
+            recall = matches / num_expected if num_expected > 0 else float("nan")
+
+            print("{0:>5} {1:>3}x{2:<3}: average: {3:.2f} ms, max: {4:.2f} ms, recall: {5:.3f}"
+                  .format(backend, resolution[0], resolution[1],
+                          sum(latencies) / len(latencies), max(latencies), recall))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# frame_grabber_test.py
+
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "robot_lib"))
+
+from frame_grabber import LatestFrameGrabber
+
+class FakeVideoCapture(object):
+    """
+    一定のフレームレートで画像を取り込むビデオ撮影デバイスを模倣するクラス
+    """
+
+    def __init__(self, fps=30.0, frame_width=320, frame_height=240):
+        """コンストラクタ"""
+        self.period = 1.0 / fps
+        self.next_time = time.monotonic()
+        self.frame = np.zeros((frame_height, frame_width, 3), dtype=np.uint8)
+        self.grabs = 0
+
+    def grab(self):
+        """次の画像が撮影されるまで待機"""
+        self.next_time += self.period
+        remaining = self.next_time - time.monotonic()
+        if remaining > 0.0:
+            time.sleep(remaining)
+        self.grabs += 1
+        return True
+
+    def retrieve(self):
+        """最後に取り込んだ画像を読み出し"""
+        self.frame[0, 0, 0] = self.grabs % 256
+        return True, self.frame.copy()
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop_id):
+        return 0.0
+
+    def set(self, prop_id, value):
+        return True
+
+    def release(self):
+        pass
+
+def main():
+    print("starting up frame grabber test program ...")
+
+    # 前回の読み出しの直後に次の画像を要求しても, 次の画像が取り込まれ次第読み出せることを確認
+    grabber = LatestFrameGrabber(FakeVideoCapture(30.0), timeout=1.0)
+    latencies = []
+    failures = 0
+
+    for i in range(20):
+        start_time = time.monotonic()
+        ret, frame = grabber.read()
+        latencies.append(time.monotonic() - start_time)
+        if not ret:
+            failures += 1
+
+    grabber.release()
+
+    print("back-to-back reads: 20, failures: {0}, max latency: {1:.1f} ms"
+          .format(failures, max(latencies) * 1000.0))
+
+    # 1フレームの周期(約33ミリ秒)を大きく超えて待機した場合は失敗
+    if failures > 0 or max(latencies) > 0.1:
+        print("test failed")
+        sys.exit(1)
+
+    print("test passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# srf02_benchmark.py
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "robot_lib"))
+
+from srf02 import Srf02
+
+# 計測に用いる超音波センサのアドレス
+SRF02_ADDR_LIST = [0x70]
+# 各方法で計測する回数
+NUM_TRIALS = 50
+
+def benchmark(srf02, addr_list, num_trials):
+    """測距に要する時間を計測"""
+
+    # 各回の測距に要した時間(ミリ秒)
+    latencies = []
+    # 測距に失敗した回数
+    failures = 0
+
+    for i in range(num_trials):
+        start_time = time.monotonic()
+        results = srf02.get_values_multi(addr_list)
+        latencies.append((time.monotonic() - start_time) * 1000.0)
+
+        failures += sum(1 for result in results.values() if result is None)
+
+        # 前回の音波の残響の影響を受けないように少し待機
+        time.sleep(0.02)
+
+    return latencies, failures
+
+def main(argv=sys.argv[1:]):
+    addr_list = [int(addr, 0) for addr in argv] if argv else SRF02_ADDR_LIST
+
+    print("starting up srf02 benchmark program ...")
+    print("addr: {0}, trials: {1}".format(
+          ", ".join("{0:#x}".format(addr) for addr in addr_list), NUM_TRIALS))
+
+    for ranging_mode in Srf02.RANGING_MODES:
+        srf02 = Srf02(ranging_mode)
+        latencies, failures = benchmark(srf02, addr_list, NUM_TRIALS)
+
+        print("{0:>5}: average: {1:.2f} ms, min: {2:.2f} ms, max: {3:.2f} ms, failures: {4}"
+              .format(ranging_mode, sum(latencies) / len(latencies),
+                      min(latencies), max(latencies), failures))
+
+if __name__ == "__main__":
+    main()